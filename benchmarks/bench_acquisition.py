@@ -0,0 +1,339 @@
+# end-to-end acquisition benchmarks against the local simulator and a temporary database.
+#
+# Measures spectra/s through raw_spectrum_logger, per-spectrum latency from the server update to the
+# DB commit (p50/p99), peak samples/s through start_trend_sampling, write_spectrum_csv cost,
+# process_and_store_data throughput and database/store growth per hour at the real sampling rates.
+# Results are written as JSON (one file per run, named after the commit) so runs can be compared:
+#
+#   python benchmarks/bench_acquisition.py [--spectra 200] [--spectrum-interval 0.02] [--output FILE]
+#   python benchmarks/bench_acquisition.py --compare benchmarks/results/old.json benchmarks/results/new.json
+import os
+import sys
+import json
+import logging
+import time
+import shutil
+import sqlite3
+import argparse
+import platform
+import tempfile
+import threading
+import contextlib
+import subprocess
+from datetime import datetime
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from opcua import Client
+
+from simulator import IRSimulator
+from spectrum_logger import raw_spectrum_logger
+from spectrum_store import SpectrumStore
+from common_utils import write_spectrum_csv, get_current_timestamp_str
+from processing_utils import process_and_store_data
+from db_utils import setup_database, create_new_document, create_new_trend, start_trend_sampling
+from db_writer import DBWriter
+from error_logger import set_error_log_path
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+PORT = 48500
+REAL_SPECTRUM_INTERVAL = 30     # seconds between spectra on the real instrument
+REAL_TREND_INTERVAL = 2         # main.py trend sampling interval
+
+
+class CommitTimingWriter(DBWriter):
+    """ DBWriter that records when the Samples rows of each group were committed, by SampleCount."""
+
+    def __init__(self, db_path, **kwargs):
+        super().__init__(db_path, **kwargs)
+        self.committed_at = {}
+        self._last_sample_id = 0
+
+    def _commit_batch(self, conn, batch):
+        super()._commit_batch(conn, batch)
+        now = time.perf_counter()
+        rows = conn.execute("SELECT SampleID, SampleCount FROM Samples WHERE SampleID > ?", (self._last_sample_id,)).fetchall()
+        for sample_id, sample_count in rows:
+            self.committed_at[sample_count] = now
+            self._last_sample_id = max(self._last_sample_id, sample_id)
+
+
+def _percentile(values, q):
+    return float(np.percentile(values, q)) if values else None
+
+
+def _db_bytes(db_path):
+    """ bytes in use in the database file (page space minus free space), so growth is not rounded to pages."""
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        try:
+            return conn.execute("SELECT SUM(pgsize - unused) FROM dbstat").fetchone()[0] or 0
+        except sqlite3.OperationalError:
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+            return page_size * conn.execute("PRAGMA page_count").fetchone()[0]
+
+
+def _folder_bytes(folder):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(folder) for name in files)
+
+
+def bench_logger(tmp, spectra, interval, points, peaks):
+    """ spectra/s and update-to-commit latency through raw_spectrum_logger (subscription, store format, DBWriter)."""
+    endpoint = f"opc.tcp://127.0.0.1:{PORT}/bench"
+    db_path = os.path.join(tmp, "logger.db")
+    run_dir = os.path.join(tmp, "logger_run")
+    setup_database(db_path)
+    db_bytes_before = _db_bytes(db_path)
+
+    simulator = IRSimulator(endpoint, probes=1, interval=interval, spectra=spectra, points=points, peaks=peaks, start_delay=1.0)
+    probe = simulator.probes[0]
+    published_at = {}
+    publish = probe.publish
+
+    def timed_publish(raw, treated, peak_values):
+        publish(raw, treated, peak_values)
+        published_at[probe.sample_count] = time.perf_counter()
+
+    probe.publish = timed_publish
+    simulator.start()
+
+    client = Client(endpoint)
+    client.connect()
+    writer = CommitTimingWriter(db_path).start()
+    logged = []
+    try:
+        document_id = create_new_document(db_path, "benchmark", None, writer=writer)
+        start = time.perf_counter()
+        raw_spectrum_logger(
+            client=client,
+            probe_status_id="ns=2;s=Local.iCIR.Probe1.ProbeStatus",
+            raw_spectrum_id="ns=2;s=Local.iCIR.Probe1.SpectraRaw",
+            output_dir=run_dir,
+            db_path=db_path,
+            document_ids={"DocumentID": document_id},
+            probe1_node_id="ns=2;s=Local.iCIR.Probe1",
+            use_subscription=True,
+            publishing_interval=max(10, int(interval * 1000)),
+            spectrum_format="store",
+            callback=lambda data: logged.append(time.perf_counter()),
+            db_writer=writer
+        )
+    finally:
+        writer_stats = writer.stop()
+        client.disconnect()
+        simulator.stop()
+
+    # the logger starts waiting before the probe runs, so time from the first published spectrum.
+    first = min(published_at.values()) if published_at else start
+    elapsed = (logged[-1] - first) if logged else 0.0
+    latencies = [(writer.committed_at[count] - published) * 1000 for count, published in published_at.items() if count in writer.committed_at]
+    return {
+        "published": len(published_at),
+        "logged": len(logged),
+        "missed": len(published_at) - len(logged),
+        "offered_per_sec": 1 / interval if interval else None,
+        "spectra_per_sec": len(logged) / elapsed if elapsed else 0.0,
+        "latency_ms_p50": _percentile(latencies, 50),
+        "latency_ms_p99": _percentile(latencies, 99),
+        "latency_ms_max": max(latencies) if latencies else None,
+        "commits": writer_stats["commits"],
+        "mean_commit_ms": writer_stats["mean_commit_ms"],
+        "db_bytes_per_spectrum": (_db_bytes(db_path) - db_bytes_before) / len(logged) if logged else None,
+        "store_bytes_per_spectrum": _folder_bytes(run_dir) / len(logged) if logged else None,
+    }
+
+
+def bench_trend_sampling(tmp, seconds, tick_interval, peaks):
+    """ peak samples/s through start_trend_sampling reading the simulator's trend nodes."""
+    endpoint = f"opc.tcp://127.0.0.1:{PORT + 1}/bench"
+    db_path = os.path.join(tmp, "trend.db")
+    setup_database(db_path)
+    db_bytes_before = _db_bytes(db_path)
+
+    simulator = IRSimulator(endpoint, probes=1, interval=1.0, peaks=peaks, start_delay=0.0).start()
+    client = Client(endpoint)
+    client.connect()
+    writer = DBWriter(db_path).start()
+    stop_event = threading.Event()
+    tick_stats = {}
+    try:
+        trend_id = create_new_trend(db_path, None, "benchmark", writer=writer)
+        trends = client.get_node("ns=2;s=Local.iCIR.Probe1.Trends")
+        peak_nodes = []
+        for child in trends.get_children():
+            label = child.get_display_name().Text
+            peak_nodes.extend((node, label) for node in child.get_children() if str(node.nodeid.Identifier).endswith(".TreatedValue"))
+
+        timer = threading.Timer(seconds, stop_event.set)
+        timer.start()
+        start = time.perf_counter()
+        start_trend_sampling(db_path, trend_id, client.get_node("ns=2;s=Local.iCIR.Probe1"), trends, "Probe 1", peak_nodes,
+                             interval_sec=tick_interval, tick_stats=tick_stats, report_every=0, writer=writer, stop_event=stop_event)
+        elapsed = time.perf_counter() - start
+    finally:
+        writer.stop()
+        client.disconnect()
+        simulator.stop()
+
+    samples = tick_stats["ticks"] * (len(peak_nodes) + 1)
+    return {
+        "peaks": len(peak_nodes),
+        "ticks": tick_stats["ticks"],
+        "samples_per_sec": samples / elapsed,
+        "tick_ms_mean": tick_stats["mean_ms"],
+        "tick_ms_max": tick_stats["max_ms"],
+        "overruns": tick_stats["overruns"],
+        "db_bytes_per_tick": (_db_bytes(db_path) - db_bytes_before) / tick_stats["ticks"] if tick_stats["ticks"] else None,
+    }
+
+
+def bench_spectrum_writes(tmp, count, points):
+    """ cost of one spectrum as its own CSV (write_spectrum_csv, fsynced) vs a SpectrumStore row."""
+    wavenumbers = np.linspace(4000, 650, points).round(2).tolist()
+    spectrum = np.random.default_rng(0).random(points).tolist()
+    csv_dir = os.path.join(tmp, "csv_writes")
+    os.makedirs(csv_dir)
+
+    start = time.perf_counter()
+    for i in range(count):
+        write_spectrum_csv(wavenumbers, spectrum, os.path.join(csv_dir, f"raw_spectrum_{i}.csv"))
+    csv_ms = (time.perf_counter() - start) * 1000 / count
+
+    store = SpectrumStore(os.path.join(tmp, "store_writes"), "raw")
+    store.set_wavenumbers(wavenumbers)
+    start = time.perf_counter()
+    for _ in range(count):
+        store.append(spectrum)
+    store.close()
+    store_ms = (time.perf_counter() - start) * 1000 / count
+
+    return {"points": points, "csv_ms_per_spectrum": csv_ms, "store_ms_per_spectrum": store_ms,
+            "csv_bytes_per_spectrum": _folder_bytes(csv_dir) / count}
+
+
+def bench_processing(tmp, count, points):
+    """ spectra/s through process_and_store_data (smoothing, no plots) for a CSV run."""
+    run_dir = os.path.join(tmp, "processing_run")
+    os.makedirs(run_dir)
+    wavenumbers = np.linspace(4000, 650, points).round(2).tolist()
+    rng = np.random.default_rng(1)
+    base = datetime(2025, 1, 1, 8, 0, 0).timestamp()
+    for i in range(count):
+        timestamp = get_current_timestamp_str(datetime.fromtimestamp(base + i * 30))
+        write_spectrum_csv(wavenumbers, rng.random(points).tolist(), os.path.join(run_dir, f"raw_spectrum_{timestamp}.csv"))
+
+    summary = process_and_store_data(run_dir, os.path.join(tmp, "processing_out"), smooth=True, window_length=11, polyorder=2,
+                                     workers=os.cpu_count() or 1, plot=False)
+    return {"spectra": count, "workers": os.cpu_count() or 1, "wall_time_s": summary["wall_time"],
+            "spectra_per_sec": summary["processed"] / summary["wall_time"] if summary["wall_time"] else None}
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def run_suite(args):
+    results = {}
+    tmp = tempfile.mkdtemp(prefix="reactir_bench_")
+    set_error_log_path(os.path.join(tmp, "error_log.txt"))
+    logging.getLogger("opcua").setLevel(logging.ERROR)
+    try:
+        # the logger and processing functions print per spectrum; keep that out of the report.
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            results["logger"] = bench_logger(tmp, args.spectra, args.spectrum_interval, args.points, args.peaks)
+            results["trend_sampling"] = bench_trend_sampling(tmp, args.trend_seconds, args.tick_interval, args.trend_peaks)
+            results["spectrum_writes"] = bench_spectrum_writes(tmp, args.write_count, args.points)
+            results["processing"] = bench_processing(tmp, args.process_count, args.points)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    logger, trend = results["logger"], results["trend_sampling"]
+    spectra_per_hour = 3600 / REAL_SPECTRUM_INTERVAL
+    ticks_per_hour = 3600 / REAL_TREND_INTERVAL
+    results["growth_per_hour"] = {
+        "spectrum_interval_s": REAL_SPECTRUM_INTERVAL,
+        "trend_interval_s": REAL_TREND_INTERVAL,
+        "db_bytes": (logger["db_bytes_per_spectrum"] or 0) * spectra_per_hour
+                    + (trend["db_bytes_per_tick"] or 0) * ticks_per_hour * (args.peaks + 1) / (trend["peaks"] + 1),
+        "store_bytes": (logger["store_bytes_per_spectrum"] or 0) * spectra_per_hour,
+    }
+
+    return {
+        "commit": _git_commit(),
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "params": vars(args),
+        "results": results,
+    }
+
+
+def _flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def print_report(report, baseline=None):
+    current = _flatten(report["results"])
+    previous = _flatten(baseline["results"]) if baseline else {}
+    header = f"{'metric':<44}{'value':>16}"
+    if baseline:
+        header += f"{'baseline':>16}{'change':>10}"
+        print(f"\n{baseline['commit']} -> {report['commit']}")
+    print(header)
+    for name, value in current.items():
+        line = f"{name:<44}{value:>16.3f}"
+        if baseline and name in previous:
+            old = previous[name]
+            change = f"{(value - old) / old * 100:+.1f}%" if old else "n/a"
+            line += f"{old:>16.3f}{change:>10}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end acquisition benchmarks (simulator + temporary database).")
+    parser.add_argument("--spectra", type=int, default=200, help="spectra published to the logger")
+    parser.add_argument("--spectrum-interval", type=float, default=0.02, help="seconds between simulated spectra")
+    parser.add_argument("--points", type=int, default=839, help="points per spectrum")
+    parser.add_argument("--peaks", type=int, default=3, help="trend peaks of a real run (for growth per hour)")
+    parser.add_argument("--trend-seconds", type=float, default=5, help="duration of the trend sampling benchmark")
+    parser.add_argument("--tick-interval", type=float, default=0.01, help="trend sampling interval in seconds")
+    parser.add_argument("--trend-peaks", type=int, default=20, help="peaks read per trend tick")
+    parser.add_argument("--write-count", type=int, default=200, help="spectra written in the write benchmark")
+    parser.add_argument("--process-count", type=int, default=200, help="spectra in the processing benchmark")
+    parser.add_argument("--output", default=None, help="JSON result file (default: benchmarks/results/<time>_<commit>.json)")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"), help="compare two result files instead of running")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0], "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        with open(args.compare[1], "r", encoding="utf-8") as f:
+            current = json.load(f)
+        print_report(current, baseline)
+        return
+
+    report = run_suite(args)
+    output = args.output or os.path.join(RESULTS_DIR, f"{datetime.now().strftime('%Y%m%d-%H%M%S')}_{report['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+    print_report(report)
+    print(f"\nResults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
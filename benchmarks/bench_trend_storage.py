@@ -0,0 +1,143 @@
+# compares the original PeakSamples/ProbeTempSamples layout with TrendSeries/TrendPoints:
+# bytes on disk per sample and the time of a timestamp-range query for one peak.
+#
+#   python benchmarks/bench_trend_storage.py [--hours 12] [--peaks 10] [--interval 2]
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db_utils import setup_database, create_new_trend, _create_trend_series, _insert_trend_points
+from spectrum_store import datetime_to_ms
+
+# the trend tables as they were before schema version 3.
+LEGACY_SCHEMA = """
+CREATE TABLE ProbeTempSamples (
+    SampleID INTEGER PRIMARY KEY AUTOINCREMENT, TrendID INTEGER, Timestamp TEXT, Description TEXT,
+    Source TEXT, Value REAL, TreatedValue REAL
+);
+CREATE TABLE PeakSamples (
+    SampleID INTEGER PRIMARY KEY AUTOINCREMENT, TrendID integer, Timestamp TEXT, NodeID TEXT, Value REAL, Label TEXT
+);
+CREATE INDEX idx_probe_temp_trend ON ProbeTempSamples (TrendID);
+CREATE INDEX idx_peak_samples_trend ON PeakSamples (TrendID);
+CREATE INDEX idx_probe_temp_timestamp ON ProbeTempSamples (Timestamp);
+CREATE INDEX idx_peak_samples_timestamp ON PeakSamples (Timestamp);
+"""
+
+PROBE_SOURCE = "ns=2;s=Local.iCIR.Probe1.Temperature"
+
+
+def _peak_nodes(num_peaks):
+    return [(f"ns=2;s=Local.iCIR.Probe1.Trends.Peak {i}.TreatedValue", f"Peak {i}") for i in range(num_peaks)]
+
+
+def _ticks(hours, interval_sec):
+    start = datetime(2025, 1, 1, 8, 0, 0)
+    return [start + timedelta(seconds=i * interval_sec) for i in range(int(hours * 3600 / interval_sec))]
+
+
+def _db_size(path):
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.execute("VACUUM")
+    conn.close()
+    return os.path.getsize(path)
+
+
+def _time_query(path, sql, params, repeat=20):
+    conn = sqlite3.connect(path)
+    rows = conn.execute(sql, params).fetchall()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        conn.execute(sql, params).fetchall()
+    elapsed = (time.perf_counter() - start) / repeat
+    conn.close()
+    return elapsed * 1000, len(rows)
+
+
+def build_legacy(path, ticks, peaks):
+    conn = sqlite3.connect(path)
+    conn.executescript(LEGACY_SCHEMA)
+    for timestamp in ticks:
+        iso = timestamp.isoformat()
+        conn.execute("INSERT INTO ProbeTempSamples (TrendID, Timestamp, Description, Source, Value, TreatedValue) VALUES (?, ?, ?, ?, ?, ?)",
+                     (1, iso, "Probe 1", PROBE_SOURCE, 25.0, 25.1))
+        conn.executemany("INSERT INTO PeakSamples (TrendID, Timestamp, NodeID, Value, Label) VALUES (?, ?, ?, ?, ?)",
+                         [(1, iso, node_id, float(i), label) for i, (node_id, label) in enumerate(peaks)])
+    conn.commit()
+    conn.close()
+
+
+def build_compact(path, ticks, peaks):
+    setup_database(path)
+    trend_id = create_new_trend(path, None, "benchmark")
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    probe_series, peak_series = _create_trend_series(cursor, trend_id, PROBE_SOURCE, "Probe 1", peaks)
+    rows = []
+    for timestamp in ticks:
+        time_ms = datetime_to_ms(timestamp)
+        rows.append((probe_series, time_ms, 25.0, 25.1))
+        rows.extend((series_id, time_ms, float(i), None) for i, series_id in enumerate(peak_series))
+    _insert_trend_points(cursor, rows)
+    conn.commit()
+    conn.close()
+    return trend_id, peak_series
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Trend storage layout benchmark (legacy vs TrendPoints).")
+    parser.add_argument("--hours", type=float, default=12)
+    parser.add_argument("--peaks", type=int, default=10)
+    parser.add_argument("--interval", type=float, default=2)
+    parser.add_argument("--window-min", type=float, default=30, help="length of the range query in minutes")
+    args = parser.parse_args()
+
+    ticks = _ticks(args.hours, args.interval)
+    peaks = _peak_nodes(args.peaks)
+    samples = len(ticks) * (args.peaks + 1)
+    window_start = ticks[len(ticks) // 2]
+    window_end = window_start + timedelta(minutes=args.window_min)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, "legacy.db")
+        compact_path = os.path.join(tmp, "compact.db")
+
+        build_legacy(legacy_path, ticks, peaks)
+        _, peak_series = build_compact(compact_path, ticks, peaks)
+
+        legacy_size = _db_size(legacy_path)
+        compact_size = _db_size(compact_path)
+
+        legacy_ms, legacy_rows = _time_query(
+            legacy_path,
+            "SELECT Timestamp, Value FROM PeakSamples WHERE TrendID = ? AND Label = ? AND Timestamp BETWEEN ? AND ? ORDER BY Timestamp",
+            (1, peaks[0][1], window_start.isoformat(), window_end.isoformat()))
+        compact_ms, compact_rows = _time_query(
+            compact_path,
+            "SELECT TimeMs, Value FROM TrendPoints WHERE SeriesID = ? AND TimeMs BETWEEN ? AND ? ORDER BY TimeMs",
+            (peak_series[0], datetime_to_ms(window_start), datetime_to_ms(window_end)))
+
+        # upgrade the legacy file in place to check the migration keeps every sample.
+        start = time.perf_counter()
+        setup_database(legacy_path)
+        migrate_sec = time.perf_counter() - start
+        conn = sqlite3.connect(legacy_path)
+        migrated = conn.execute("SELECT COUNT(*) FROM TrendPoints").fetchone()[0]
+        conn.close()
+
+    print(f"\n{samples} samples ({len(ticks)} ticks x {args.peaks} peaks + probe), {args.window_min:g} min range query")
+    print(f"{'layout':<10}{'size (MB)':>12}{'bytes/sample':>15}{'range query (ms)':>19}{'rows':>8}")
+    print(f"{'legacy':<10}{legacy_size / 1e6:>12.2f}{legacy_size / samples:>15.1f}{legacy_ms:>19.3f}{legacy_rows:>8}")
+    print(f"{'compact':<10}{compact_size / 1e6:>12.2f}{compact_size / samples:>15.1f}{compact_ms:>19.3f}{compact_rows:>8}")
+    print(f"migrated {migrated} of {samples} legacy samples in {migrate_sec:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
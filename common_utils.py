@@ -2,9 +2,26 @@ import os
 import csv
 from datetime import datetime
 
-def get_current_timestamp_str():
-    """Returns current timestamp formatted as string."""
-    return datetime.now().strftime("%d-%m-%Y_%H-%M-%S_%f")[:-3]
+# per-spectrum progress lines are only printed when verbose output is switched on.
+VERBOSE = False
+
+def set_verbose(enabled: bool):
+    """Switches per-spectrum (debug) console output on or off."""
+    global VERBOSE
+    VERBOSE = bool(enabled)
+
+def debug_print(*args):
+    """print() that only prints in verbose mode."""
+    if VERBOSE:
+        print(*args)
+
+def get_current_timestamp_str(now=None):
+    """Returns current timestamp (or the given datetime) formatted as string."""
+    return (now or datetime.now()).strftime("%d-%m-%Y_%H-%M-%S_%f")[:-3]
+
+def parse_timestamp_str(timestamp_str):
+    """Inverse of get_current_timestamp_str, returns a datetime."""
+    return datetime.strptime(timestamp_str, "%d-%m-%Y_%H-%M-%S_%f")
 
 def write_spectrum_csv(wavenumbers, spectrum, filepath):
     """Writes wavenumber and transmittance values to a CSV file."""
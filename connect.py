@@ -1,7 +1,10 @@
 import time
-from opcua import Client
+import random
+import threading
+from opcua import Client, ua
 
 from error_logger import log_error_to_file
+import metrics
 
 # OPC UA server endpoint for the Mettler Toldeo IR Flow cell. 
 SERVER_URL = "opc.tcp://localhost:62552/iCOpcUaServer"
@@ -22,7 +25,7 @@ def try_connect(server_url=SERVER_URL, max_retries=3, delay=2, error_log_path=No
             error_message = f"Attempt {attempt} failed to connect to {server_url}"
             print(f"{error_message}: {e}")
             if error_log_path:
-                log_error_to_file(error_log_path, error_message, e)
+                log_error_to_file(context_message=error_message, exception=e)
             
             if attempt < max_retries:
                 time.sleep(delay)   # wait before next attempt
@@ -30,3 +33,212 @@ def try_connect(server_url=SERVER_URL, max_retries=3, delay=2, error_log_path=No
                 print("All connection attempts failed.")
                 return None
 
+
+
+class ManagedSubscription:
+    """ Stands in for an opcua Subscription created through ManagedClient. It remembers its
+        monitored items so the subscription can be created again on a new session after a reconnect.
+    """
+
+    def __init__(self, managed_client, period, handler):
+        self.managed_client = managed_client
+        self.period = period
+        self.handler = handler
+        self.items = []    # (node, queuesize) in subscription order
+        self.subscription = None
+
+    def _create(self, client):
+        self.subscription = client.create_subscription(self.period, self.handler)
+        for node, queuesize in self.items:
+            self.subscription.subscribe_data_change(node, queuesize=queuesize)
+
+    def subscribe_data_change(self, node, queuesize=0):
+        self.items.append((node, queuesize))
+        return self.subscription.subscribe_data_change(node, queuesize=queuesize)
+
+    def delete(self):
+        self.managed_client._forget_subscription(self)
+        if self.subscription is not None:
+            self.subscription.delete()
+
+
+class ManagedClient:
+    """ OPC UA client that keeps itself connected for a whole run.
+
+        A watchdog thread reads the server's current time every watchdog_interval seconds, which doubles
+        as the latency measurement. When that read fails the client reconnects with exponential backoff
+        and jitter, and re-creates every subscription made through create_subscription(). Node handles
+        stay valid across reconnects because the underlying Client object is reused, so get_node() and
+        the nodes it returns can be kept for the whole run. Calls made while the server is unreachable
+        fail as before and are expected to be retried or skipped by the caller.
+    """
+
+    def __init__(self, server_url=SERVER_URL, base_delay=1.0, max_delay=30.0, watchdog_interval=2.0):
+        self.server_url = server_url
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.watchdog_interval = watchdog_interval
+        self.client = Client(server_url)
+        self.connected = False
+        self.on_reconnect = []      # callables run after every successful reconnect
+        self._nodes = {}
+        self._subscriptions = []
+        self._lock = threading.Lock()
+        self._closing = threading.Event()
+        self._watchdog = None
+        self._down_since = None
+        self.stats = {"reconnects": 0, "failed_attempts": 0, "downtime_s": 0.0, "last_error": None,
+                      "latency_ms": 0.0, "mean_latency_ms": 0.0, "max_latency_ms": 0.0, "checks": 0}
+
+    def start(self, max_attempts=3):
+        """ connect (up to max_attempts tries, None = until it works) and start the watchdog.
+            Returns True if connected.
+        """
+        if not self._connect(max_attempts):
+            print("All connection attempts failed.")
+            return False
+        self._watchdog = threading.Thread(target=self._watch, name=f"opcua-watchdog {self.server_url}", daemon=True)
+        self._watchdog.start()
+        return True
+
+    def get_node(self, node_id):
+        """ cached node handle, valid across reconnects."""
+        node = self._nodes.get(node_id)
+        if node is None:
+            node = self._nodes[node_id] = self.client.get_node(node_id)
+        return node
+
+    def get_objects_node(self):
+        return self.client.get_objects_node()
+
+    def create_subscription(self, period, handler):
+        subscription = ManagedSubscription(self, period, handler)
+        with self._lock:
+            subscription._create(self.client)
+            self._subscriptions.append(subscription)
+        return subscription
+
+    def _forget_subscription(self, subscription):
+        with self._lock:
+            if subscription in self._subscriptions:
+                self._subscriptions.remove(subscription)
+
+    def health(self):
+        """ connection state, reconnect count, downtime and watchdog read latency."""
+        health = dict(self.stats, url=self.server_url, connected=self.connected)
+        if self._down_since is not None:
+            health["downtime_s"] += time.monotonic() - self._down_since
+        return health
+
+    def disconnect(self):
+        """ stop the watchdog and close the session."""
+        self._closing.set()
+        if self._watchdog is not None:
+            self._watchdog.join()
+            self._watchdog = None
+        if self.connected:
+            self.connected = False
+            try:
+                self.client.disconnect()
+            except Exception as e:
+                self._drop_connection()
+                log_error_to_file(context_message=f"Error during disconnection from {self.server_url}", exception=e)
+
+    def _backoff(self, attempt):
+        """ exponential backoff with jitter, so several clients do not retry in lockstep."""
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(delay / 2, delay)
+
+    def _connect(self, max_attempts=None):
+        attempt = 0
+        while not self._closing.is_set():
+            attempt += 1
+            try:
+                self.client.connect()
+                self.connected = True
+                print(f"Connected to OPC UA server at {self.server_url} (Attempt {attempt})")
+                return True
+            except Exception as e:
+                self.stats["failed_attempts"] += 1
+                metrics.count("opc_connect_failures")
+                self.stats["last_error"] = repr(e)
+                self._drop_connection()
+                error_message = f"Attempt {attempt} failed to connect to {self.server_url}"
+                print(f"{error_message}: {e}")
+                log_error_to_file(context_message=error_message, exception=e)
+                if max_attempts is not None and attempt >= max_attempts:
+                    return False
+                self._closing.wait(self._backoff(attempt))
+        return False
+
+    def _drop_connection(self):
+        """ close whatever is left of a broken session without waiting on the dead server."""
+        try:
+            self.client.disconnect_socket()
+        except Exception:
+            pass
+
+    def _check(self):
+        """ one watchdog read of the server time, returns its latency in ms."""
+        # the receive thread ends as soon as the server closes the socket; checking it first notices a
+        # dead server without waiting for the read to time out.
+        receiver = getattr(getattr(self.client.uaclient, "_uasocket", None), "_thread", None)
+        if receiver is not None and not receiver.is_alive():
+            raise ConnectionError("connection closed by server")
+        start = time.perf_counter()
+        self.client.get_node(ua.NodeId(ua.ObjectIds.Server_ServerStatus_CurrentTime)).get_value()
+        return (time.perf_counter() - start) * 1000
+
+    def _watch(self):
+        while not self._closing.wait(self.watchdog_interval):
+            try:
+                latency_ms = self._check()
+            except Exception as e:
+                if self._closing.is_set():
+                    break
+                self._reconnect(e)
+                continue
+
+            stats = self.stats
+            stats["checks"] += 1
+            stats["latency_ms"] = latency_ms
+            stats["mean_latency_ms"] += (latency_ms - stats["mean_latency_ms"]) / stats["checks"]
+            stats["max_latency_ms"] = max(stats["max_latency_ms"], latency_ms)
+
+    def _reconnect(self, error):
+        self.connected = False
+        self._down_since = time.monotonic()
+        self.stats["last_error"] = repr(error)
+        print(f"⚠️ Lost connection to {self.server_url}: {error!r}. Reconnecting...")
+        log_error_to_file(context_message=f"Lost connection to OPC UA server at {self.server_url}", exception=error)
+
+        # python-opcua's own keepalive thread would keep failing on the dead session.
+        try:
+            if self.client.keepalive is not None:
+                self.client.keepalive.stop()
+        except Exception:
+            pass
+        self._drop_connection()
+
+        if not self._connect():
+            return  # closing
+
+        with self._lock:
+            for subscription in self._subscriptions:
+                try:
+                    subscription._create(self.client)
+                except Exception as e:
+                    log_error_to_file(context_message=f"Could not re-create subscription on {self.server_url}", exception=e)
+
+        downtime = time.monotonic() - self._down_since
+        self._down_since = None
+        self.stats["reconnects"] += 1
+        metrics.count("opc_reconnects")
+        self.stats["downtime_s"] += downtime
+        print(f"🔁 Reconnected to {self.server_url} after {downtime:.1f} s, {len(self._subscriptions)} subscription(s) restored.")
+
+        for callback in self.on_reconnect:
+            try:
+                callback(self)
+            except Exception as e:
+                log_error_to_file(context_message="Error in on_reconnect callback", exception=e)
@@ -0,0 +1,289 @@
+# versioned schema migrations for ReactIR.db.
+#
+# The schema version of a database file is kept in PRAGMA user_version. setup_database() creates
+# missing tables in their current shape and then calls migrate_database(), which runs every migration
+# newer than the file's version in order, each in its own transaction together with the version bump.
+# Migrations must also work on a freshly created database where the change is already in place.
+#
+# To change the schema: update the CREATE statement in db_utils.setup_database() and append a
+# migration here that brings older files to the same shape. Views and triggers are only created here.
+import sqlite3
+
+from error_logger import log_error_to_file
+
+
+def _columns(cursor, table):
+    cursor.execute(f"PRAGMA table_info({table})")
+    return [row[1] for row in cursor.fetchall()]
+
+
+def _add_missing_column(cursor, table, column, column_type):
+    """ ALTER TABLE ADD COLUMN if the column is not there yet."""
+    if column not in _columns(cursor, table):
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+
+def _add_run_columns(cursor):
+    """ columns added after the first release (previously ALTER TABLE cells in problem_solving.ipynb)."""
+    _add_missing_column(cursor, "Documents", "ErrorLogPath", "TEXT")
+    _add_missing_column(cursor, "Spectra", "RowOffset", "INTEGER")
+
+
+def _add_spectrum_blobs(cursor):
+    """ spectra as float32 BLOBs: DocumentID/AxisID/Encoding/Intensities on Spectra, a nullable
+        FilePath, the 'treated' type, and the shared WavenumberAxes table.
+    """
+    if "Intensities" not in _columns(cursor, "Spectra"):
+        # SQLite can not change a CHECK constraint or NOT NULL in place, so the table is rebuilt.
+        cursor.execute("""
+            CREATE TABLE Spectra_new (
+                SpectraID INTEGER PRIMARY KEY,
+                SampleID INTEGER,
+                DocumentID INTEGER,
+                Type TEXT CHECK (Type IN ('raw', 'background', 'processed', 'reference', 'treated')),
+                FilePath TEXT,
+                RowOffset INTEGER,
+                RecordedAt TEXT,
+                AxisID INTEGER,
+                Encoding TEXT,
+                Intensities BLOB,
+                FOREIGN KEY (SampleID) REFERENCES Samples(SampleID),
+                FOREIGN KEY (DocumentID) REFERENCES Documents(DocumentID),
+                FOREIGN KEY (AxisID) REFERENCES WavenumberAxes(AxisID)
+            )
+        """)
+        cursor.execute("""
+            INSERT INTO Spectra_new (SpectraID, SampleID, DocumentID, Type, FilePath, RowOffset, RecordedAt)
+            SELECT s.SpectraID, s.SampleID, p.DocumentID, s.Type, s.FilePath, s.RowOffset, s.RecordedAt
+            FROM Spectra s
+            LEFT JOIN Samples sa ON sa.SampleID = s.SampleID
+            LEFT JOIN Probes p ON p.ProbeID = sa.ProbeID
+        """)
+        cursor.execute("DROP TABLE Spectra")
+        cursor.execute("ALTER TABLE Spectra_new RENAME TO Spectra")
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS WavenumberAxes (
+            AxisID INTEGER PRIMARY KEY,
+            DocumentID INTEGER,
+            AxisHash TEXT NOT NULL,
+            NumPoints INTEGER NOT NULL,
+            Axis BLOB NOT NULL,
+            FOREIGN KEY (DocumentID) REFERENCES Documents(DocumentID)
+        )
+    """)
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_axes_document_hash ON WavenumberAxes (DocumentID, AxisHash);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_spectra_document ON Spectra (DocumentID, Type, RecordedAt);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_spectra_sample ON Spectra (SampleID);")
+
+
+def _is_table(cursor, name):
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,))
+    return cursor.fetchone() is not None
+
+
+# local ISO text <-> epoch-ms, matching datetime.timestamp() on the machine that logged the data.
+_ISO_TO_MS = "CAST(ROUND((julianday({0}, 'utc') - 2440587.5) * 86400000) AS INTEGER)"
+_MS_TO_ISO = "strftime('%Y-%m-%dT%H:%M:%f', {0} / 1000.0, 'unixepoch', 'localtime')"
+
+
+def _compact_trend_samples(cursor):
+    """ PeakSamples/ProbeTempSamples -> TrendSeries (one row per trend/node/label) plus narrow
+        TrendPoints rows keyed by (SeriesID, TimeMs). The old names become views with INSTEAD OF
+        INSERT triggers, so existing queries and inserts keep working.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS TrendSeries (
+            SeriesID INTEGER PRIMARY KEY,
+            TrendID INTEGER NOT NULL,
+            Kind TEXT NOT NULL CHECK (Kind IN ('peak', 'probe')),
+            NodeID TEXT NOT NULL DEFAULT '',
+            Label TEXT NOT NULL DEFAULT '',
+            Description TEXT,
+            UNIQUE (TrendID, Kind, NodeID, Label),
+            FOREIGN KEY (TrendID) REFERENCES Trends(TrendID)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS TrendPoints (
+            SeriesID INTEGER NOT NULL,
+            TimeMs INTEGER NOT NULL,
+            Value REAL,
+            TreatedValue REAL,
+            PRIMARY KEY (SeriesID, TimeMs)
+        ) WITHOUT ROWID
+    """)
+
+    if _is_table(cursor, "PeakSamples"):
+        cursor.execute("""
+            INSERT OR IGNORE INTO TrendSeries (TrendID, Kind, NodeID, Label)
+            SELECT DISTINCT TrendID, 'peak', COALESCE(NodeID, ''), COALESCE(Label, '') FROM PeakSamples
+            WHERE TrendID IS NOT NULL
+        """)
+        cursor.execute(f"""
+            INSERT OR IGNORE INTO TrendPoints (SeriesID, TimeMs, Value)
+            SELECT ts.SeriesID, {_ISO_TO_MS.format("p.Timestamp")}, p.Value
+            FROM PeakSamples p
+            JOIN TrendSeries ts ON ts.TrendID = p.TrendID AND ts.Kind = 'peak'
+                AND ts.NodeID = COALESCE(p.NodeID, '') AND ts.Label = COALESCE(p.Label, '')
+            WHERE p.Timestamp IS NOT NULL
+        """)
+        cursor.execute("DROP TABLE PeakSamples")
+
+    if _is_table(cursor, "ProbeTempSamples"):
+        cursor.execute("""
+            INSERT OR IGNORE INTO TrendSeries (TrendID, Kind, NodeID, Description)
+            SELECT TrendID, 'probe', COALESCE(Source, ''), MAX(Description) FROM ProbeTempSamples
+            WHERE TrendID IS NOT NULL
+            GROUP BY TrendID, COALESCE(Source, '')
+        """)
+        cursor.execute(f"""
+            INSERT OR IGNORE INTO TrendPoints (SeriesID, TimeMs, Value, TreatedValue)
+            SELECT ts.SeriesID, {_ISO_TO_MS.format("p.Timestamp")}, p.Value, p.TreatedValue
+            FROM ProbeTempSamples p
+            JOIN TrendSeries ts ON ts.TrendID = p.TrendID AND ts.Kind = 'probe' AND ts.NodeID = COALESCE(p.Source, '')
+            WHERE p.Timestamp IS NOT NULL
+        """)
+        cursor.execute("DROP TABLE ProbeTempSamples")
+
+    cursor.execute(f"""
+        CREATE VIEW IF NOT EXISTS PeakSamples AS
+        SELECT ts.TrendID, {_MS_TO_ISO.format("tp.TimeMs")} AS Timestamp, ts.NodeID, tp.Value, ts.Label
+        FROM TrendPoints tp JOIN TrendSeries ts ON ts.SeriesID = tp.SeriesID
+        WHERE ts.Kind = 'peak'
+    """)
+    cursor.execute(f"""
+        CREATE VIEW IF NOT EXISTS ProbeTempSamples AS
+        SELECT ts.TrendID, {_MS_TO_ISO.format("tp.TimeMs")} AS Timestamp, ts.Description, ts.NodeID AS Source,
+               tp.Value, tp.TreatedValue
+        FROM TrendPoints tp JOIN TrendSeries ts ON ts.SeriesID = tp.SeriesID
+        WHERE ts.Kind = 'probe'
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS PeakSamples_insert INSTEAD OF INSERT ON PeakSamples
+        BEGIN
+            INSERT OR IGNORE INTO TrendSeries (TrendID, Kind, NodeID, Label)
+            VALUES (NEW.TrendID, 'peak', COALESCE(NEW.NodeID, ''), COALESCE(NEW.Label, ''));
+            INSERT OR IGNORE INTO TrendPoints (SeriesID, TimeMs, Value)
+            SELECT SeriesID, {_ISO_TO_MS.format("NEW.Timestamp")}, NEW.Value FROM TrendSeries
+            WHERE TrendID = NEW.TrendID AND Kind = 'peak' AND NodeID = COALESCE(NEW.NodeID, '') AND Label = COALESCE(NEW.Label, '');
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS ProbeTempSamples_insert INSTEAD OF INSERT ON ProbeTempSamples
+        BEGIN
+            INSERT OR IGNORE INTO TrendSeries (TrendID, Kind, NodeID, Description)
+            VALUES (NEW.TrendID, 'probe', COALESCE(NEW.Source, ''), NEW.Description);
+            INSERT OR IGNORE INTO TrendPoints (SeriesID, TimeMs, Value, TreatedValue)
+            SELECT SeriesID, {_ISO_TO_MS.format("NEW.Timestamp")}, NEW.Value, NEW.TreatedValue FROM TrendSeries
+            WHERE TrendID = NEW.TrendID AND Kind = 'probe' AND NodeID = COALESCE(NEW.Source, '') AND Label = '';
+        END
+    """)
+
+
+def _share_probe_rows(cursor):
+    """ One Probes row per (DocumentID, Description) instead of one per spectrum: duplicates are collapsed
+        into the oldest row, their Samples re-pointed to it, and their temperature readings moved to
+        the ProbeTemperatures time series. A unique index then keeps new inserts from duplicating it.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS ProbeTemperatures (
+            ProbeID INTEGER NOT NULL,
+            TimeMs INTEGER NOT NULL,
+            Celsius REAL,
+            PRIMARY KEY (ProbeID, TimeMs)
+        ) WITHOUT ROWID
+    """)
+
+    cursor.execute("DROP TABLE IF EXISTS temp.probe_map")
+    cursor.execute("""
+        CREATE TEMP TABLE probe_map (ProbeID INTEGER PRIMARY KEY, KeepID INTEGER NOT NULL)
+    """)
+    cursor.execute("""
+        INSERT INTO temp.probe_map (ProbeID, KeepID)
+        SELECT p.ProbeID, k.KeepID
+        FROM Probes p
+        JOIN (SELECT DocumentID, Description, MIN(ProbeID) AS KeepID FROM Probes GROUP BY DocumentID, Description) k
+            ON k.DocumentID IS p.DocumentID AND k.Description = p.Description
+    """)
+
+    cursor.execute(f"""
+        INSERT OR IGNORE INTO ProbeTemperatures (ProbeID, TimeMs, Celsius)
+        SELECT m.KeepID, {_ISO_TO_MS.format("p.LatestTemperatureTime")}, p.LatestTemperatureCelsius
+        FROM Probes p JOIN temp.probe_map m ON m.ProbeID = p.ProbeID
+        WHERE p.LatestTemperatureCelsius IS NOT NULL AND julianday(p.LatestTemperatureTime) IS NOT NULL
+    """)
+    cursor.execute("""
+        UPDATE Samples SET ProbeID = (SELECT KeepID FROM temp.probe_map m WHERE m.ProbeID = Samples.ProbeID)
+        WHERE ProbeID IN (SELECT ProbeID FROM temp.probe_map WHERE ProbeID != KeepID)
+    """)
+    cursor.execute("DELETE FROM Probes WHERE ProbeID IN (SELECT ProbeID FROM temp.probe_map WHERE ProbeID != KeepID)")
+    cursor.execute("DROP TABLE temp.probe_map")
+
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_probes_document_description ON Probes (DocumentID, Description);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_samples_probe ON Samples (ProbeID);")
+
+
+def _index_lookup_names(cursor):
+    """ Indexes for the name lookups of db_utils.get_or_create(). Project and experiment names are made
+        unique (so get_or_create can upsert them) unless an existing file already has duplicates;
+        document names repeat by design (one document per run of an experiment) and only get a plain index.
+    """
+    for table in ("Projects", "Experiments"):
+        cursor.execute(f"SELECT 1 FROM {table} GROUP BY Name HAVING COUNT(*) > 1 LIMIT 1")
+        if cursor.fetchone() is None:
+            cursor.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{table.lower()}_name ON {table} (Name);")
+        else:
+            log_error_to_file(context_message=f"{table} has duplicate names, created a non-unique name index instead")
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table.lower()}_name ON {table} (Name);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_documents_name ON Documents (Name);")
+
+
+# (version, description, migration). Versions are consecutive and never reused.
+MIGRATIONS = [
+    (1, "run columns (Documents.ErrorLogPath, Spectra.RowOffset)", _add_run_columns),
+    (2, "spectrum BLOBs and wavenumber axes", _add_spectrum_blobs),
+    (3, "compact trend time series (TrendSeries/TrendPoints)", _compact_trend_samples),
+    (4, "one Probes row per document probe, temperatures in ProbeTemperatures", _share_probe_rows),
+    (5, "name indexes for users/projects/experiments/documents lookups", _index_lookup_names),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate_database(db_path="ReactIR.db"):
+    """ Bring a database file up to SCHEMA_VERSION. Returns the list of versions applied."""
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    applied = []
+    try:
+        cursor = conn.cursor()
+        current = get_schema_version(conn)
+        for version, description, migration in MIGRATIONS:
+            if version <= current:
+                continue
+            cursor.execute("BEGIN")
+            try:
+                migration(cursor)
+                cursor.execute(f"PRAGMA user_version = {version}")
+                cursor.execute("COMMIT")
+            except Exception as e:
+                cursor.execute("ROLLBACK")
+                log_error_to_file(context_message=f"Schema migration {version} ({description}) failed", exception=e)
+                raise
+            applied.append(version)
+            print(f"Applied schema migration {version}: {description}")
+    finally:
+        conn.close()
+    return applied
+
+
+if __name__ == "__main__":
+    import sys
+
+    path = sys.argv[1] if len(sys.argv) > 1 else "ReactIR.db"
+    applied = migrate_database(path)
+    print(f"{path} is at schema version {SCHEMA_VERSION} ({len(applied)} migrations applied).")
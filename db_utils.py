@@ -1,16 +1,25 @@
 import sqlite3
 import os
+from collections import OrderedDict
+import zlib
+import hashlib
 from datetime import datetime
 import time
 from opcua import Client
 import traceback
+import numpy as np
 
 from error_logger import log_error_to_file
+from common_utils import debug_print
+import metrics
+from node_utils import read_values
+from db_migrations import migrate_database
+from spectrum_store import RunSpectra, SPECTRUM_DTYPE, TIMESTAMP_DTYPE, datetime_to_ms
 
 db_path = "ReactIR.db"
 PROBE_COLUMNS = ["Description", "DocumentID", "LatestTemperatureCelsius", "LatestTemperatureTime"]
 SAMPLE_COLUMNS = ["ProbeID", "SampleCount", "LastSampleTime", "CurrentSamplingInterval"]
-SPECTRA_COLUMNS = ["SampleID", "Type", "FilePath", "RecordedAt"]
+SPECTRA_COLUMNS = ["SampleID", "DocumentID", "Type", "FilePath", "RowOffset", "RecordedAt", "AxisID", "Encoding", "Intensities"]
 
 def setup_database(db_path="ReactIR.db"):
     """ set up the database structure and the tables for the SQL db."""
@@ -67,6 +76,14 @@ def setup_database(db_path="ReactIR.db"):
             FOREIGN KEY (DocumentID) REFERENCES Documents(DocumentID)
         );
 
+        -- Create ProbeTemperatures table (probe temperature readings, one row per new reading of a probe)
+        CREATE TABLE IF NOT EXISTS ProbeTemperatures (
+            ProbeID INTEGER NOT NULL,
+            TimeMs INTEGER NOT NULL,
+            Celsius REAL,
+            PRIMARY KEY (ProbeID, TimeMs)
+        ) WITHOUT ROWID;
+
         -- Create Samples table
         CREATE TABLE IF NOT EXISTS Samples (
             SampleID INTEGER PRIMARY KEY,
@@ -77,14 +94,31 @@ def setup_database(db_path="ReactIR.db"):
             FOREIGN KEY (ProbeID) REFERENCES Probes(ProbeID)
         );
 
-        -- Create Spectra table
+        -- Create Spectra table (FilePath/RowOffset for spectra on disk, Intensities for spectra kept in the db)
         CREATE TABLE IF NOT EXISTS Spectra (
             SpectraID INTEGER PRIMARY KEY,
             SampleID INTEGER,
-            Type TEXT CHECK (Type IN ('raw', 'background', 'processed', 'reference')),
-            FilePath TEXT NOT NULL,
+            DocumentID INTEGER,
+            Type TEXT CHECK (Type IN ('raw', 'background', 'processed', 'reference', 'treated')),
+            FilePath TEXT,
+            RowOffset INTEGER,
             RecordedAt TEXT,
-            FOREIGN KEY (SampleID) REFERENCES Samples(SampleID)
+            AxisID INTEGER,
+            Encoding TEXT,
+            Intensities BLOB,
+            FOREIGN KEY (SampleID) REFERENCES Samples(SampleID),
+            FOREIGN KEY (DocumentID) REFERENCES Documents(DocumentID),
+            FOREIGN KEY (AxisID) REFERENCES WavenumberAxes(AxisID)
+        );
+
+        -- Create WavenumberAxes table (one shared axis per run for spectra stored as BLOBs)
+        CREATE TABLE IF NOT EXISTS WavenumberAxes (
+            AxisID INTEGER PRIMARY KEY,
+            DocumentID INTEGER,
+            AxisHash TEXT NOT NULL,
+            NumPoints INTEGER NOT NULL,
+            Axis BLOB NOT NULL,
+            FOREIGN KEY (DocumentID) REFERENCES Documents(DocumentID)
         );
 
         -- Create Reagents table
@@ -107,36 +141,34 @@ def setup_database(db_path="ReactIR.db"):
             FOREIGN KEY (DocumentID) REFERENCES Documents(DocumentID)
         );
 
-        -- Create Probe Temps table linked to Trends (Stores time-series probe data linked to a trend)
-        CREATE TABLE IF NOT EXISTS ProbeTempSamples (
-            SampleID INTEGER PRIMARY KEY AUTOINCREMENT,
-            TrendID INTEGER,
-            Timestamp TEXT,
+        -- Create TrendSeries table (one row per sampled series of a trend: probe temperature or a peak)
+        CREATE TABLE IF NOT EXISTS TrendSeries (
+            SeriesID INTEGER PRIMARY KEY,
+            TrendID INTEGER NOT NULL,
+            Kind TEXT NOT NULL CHECK (Kind IN ('peak', 'probe')),
+            NodeID TEXT NOT NULL DEFAULT '',
+            Label TEXT NOT NULL DEFAULT '',
             Description TEXT,
-            Source TEXT,
-            Value REAL,
-            TreatedValue REAL,
+            UNIQUE (TrendID, Kind, NodeID, Label),
             FOREIGN KEY (TrendID) REFERENCES Trends(TrendID)
         );
-        
-        -- Create Peak table (stores time-series user peak data (multiple OPC nodes per sample))
-        CREATE TABLE IF NOT EXISTS PeakSamples (
-            SampleID INTEGER PRIMARY KEY AUTOINCREMENT,
-            TrendID integer,
-            Timestamp TEXT,
-            NodeID TEXT,
+
+        -- Create TrendPoints table (narrow time-series rows, clustered by series and epoch-ms time;
+        -- PeakSamples and ProbeTempSamples are views over it, see db_migrations.py)
+        CREATE TABLE IF NOT EXISTS TrendPoints (
+            SeriesID INTEGER NOT NULL,
+            TimeMs INTEGER NOT NULL,
             Value REAL,
-            Label TEXT,
-            FOREIGN KEY (TrendID) REFERENCES Trends(TrendID)
-        );
+            TreatedValue REAL,
+            PRIMARY KEY (SeriesID, TimeMs)
+        ) WITHOUT ROWID;
         """)
 
         conn.commit()
 
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_probe_temp_trend ON ProbeTempSamples (TrendID);")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_peak_samples_trend ON PeakSamples (TrendID);")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_probe_temp_timestamp ON ProbeTempSamples (Timestamp);")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_peak_samples_timestamp ON PeakSamples (Timestamp);")
+        # bring older database files up to the current schema (see db_migrations.py).
+        migrate_database(db_path)
+
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_documents_experiment ON Documents (ExperimentID);")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_probes_document ON Probes (DocumentID);")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_trends_document ON Trends (DocumentID);")
@@ -147,240 +179,608 @@ def setup_database(db_path="ReactIR.db"):
     except Exception as e: 
         log_error_to_file(e, "Error in setup_database()")
 
-def create_new_document(db_path: str, name: str, experiment_id: int, error_log_path=None) -> int:
-    """ Insert a new document entry and return the new DocumentID."""
+def encode_spectrum(values, compress=False):
+    """ spectrum -> (Encoding, BLOB) as little-endian float32, zlib compressed if requested."""
+    blob = np.ascontiguousarray(values, dtype=SPECTRUM_DTYPE).tobytes()
+    if compress:
+        return "f32+zlib", zlib.compress(blob)
+    return "f32", blob
+
+def decode_spectrum(encoding, blob):
+    """ (Encoding, BLOB) -> float32 array."""
+    if encoding == "f32+zlib":
+        blob = zlib.decompress(blob)
+    elif encoding != "f32":
+        raise ValueError(f"Unknown spectrum encoding '{encoding}'.")
+    return np.frombuffer(blob, dtype=SPECTRUM_DTYPE)
+
+def get_or_create_axis(cursor, document_id, wavenumbers):
+    """ AxisID of the run's wavenumber axis, stored once per document and axis."""
+    axis_blob = np.ascontiguousarray(wavenumbers, dtype="<f8").tobytes()
+    axis_hash = hashlib.blake2b(axis_blob, digest_size=16).hexdigest()
+    cursor.execute("SELECT AxisID FROM WavenumberAxes WHERE DocumentID IS ? AND AxisHash = ?", (document_id, axis_hash))
+    row = cursor.fetchone()
+    if row:
+        return row[0]
+    cursor.execute(
+        "INSERT INTO WavenumberAxes (DocumentID, AxisHash, NumPoints, Axis) VALUES (?, ?, ?, ?)",
+        (document_id, axis_hash, len(wavenumbers), axis_blob)
+    )
+    return cursor.lastrowid
+
+def _insert_document(cursor, name, experiment_id, error_log_path):
+    cursor.execute(
+        """ INSERT INTO Documents (Name, ExperimentID, ErrorLogPath) VALUES (?, ?, ?)""",
+        (name, experiment_id, error_log_path)
+    )
+    return cursor.lastrowid
+
+def create_new_document(db_path: str, name: str, experiment_id: int, error_log_path=None, writer=None) -> int:
+    """ Insert a new document entry and return the new DocumentID.
+        With a DBWriter the insert goes through its connection instead of opening a new one.
+    """
     try:
+        if writer is not None:
+            return writer.execute(lambda cursor: _insert_document(cursor, name, experiment_id, error_log_path))
+
         with sqlite3.connect(db_path) as conn:
             cursor = conn.cursor()
-            cursor.execute(
-                """ INSERT INTO Documents (Name, ExperimentID, ErrorLogPath) VALUES (?, ?, ?)""",
-                (name, experiment_id, error_log_path)
-            )
+            document_id = _insert_document(cursor, name, experiment_id, error_log_path)
             conn.commit()
-            document_id = cursor.lastrowid
             return document_id
     except Exception as e:
         log_error_to_file(e, "Error in create_new_document()")
         return -1
 
+# tables get_or_create() may look up: table -> (id column, lookup column, other columns it may set).
+LOOKUP_TABLES = {
+    "Users": ("UserID", "Username", ()),
+    "Projects": ("ProjectID", "Name", ("UserID",)),
+    "Experiments": ("ExperimentID", "Name", ("ProjectID",)),
+    "Documents": ("DocumentID", "Name", ("ExperimentID", "ErrorLogPath")),
+}
+ID_CACHE_SIZE = 4096
+
+# (database file, table, value) -> id, most recently used last.
+_id_cache = OrderedDict()
+
+def clear_id_cache():
+    """ forget every cached get_or_create() id, e.g. after rows were deleted or a transaction rolled back."""
+    _id_cache.clear()
+
+def _database_file(cursor):
+    return cursor.execute("PRAGMA database_list").fetchone()[2]
+
+def _has_unique_index(cursor, table, column):
+    """ True if column alone has a unique index, i.e. it can be an ON CONFLICT target."""
+    for _, index_name, unique, *_ in cursor.execute(f"PRAGMA index_list({table})").fetchall():
+        if unique and [row[2] for row in cursor.execute(f"PRAGMA index_info({index_name})").fetchall()] == [column]:
+            return True
+    return False
+
 def get_or_create(cursor, table, unique_col, unique_val, defaults=None):
-    """ Get the ID if exists, otherwise insert and return the new ID."""
-    
-    try: 
-        table_id_column = f"{table[:-1]}ID" if table.endswith("s") else f"{table}ID"
-        cursor.execute(f"SELECT {table_id_column} FROM {table} WHERE {unique_col} = ?", (unique_val,))
-        row = cursor.fetchone()
-        if row:
-            return row[0]
+    """ Get the ID if exists, otherwise insert and return the new ID.
+        Resolved ids are kept in an in-process LRU cache. Where the lookup column has a unique index
+        (Users, Projects, Experiments, see db_migrations.py) the lookup and insert are one
+        INSERT ... ON CONFLICT ... RETURNING statement; Document names repeat, so those return the oldest match.
+    """
+    try:
+        if table not in LOOKUP_TABLES or LOOKUP_TABLES[table][1] != unique_col:
+            raise ValueError(f"get_or_create() does not support {table}.{unique_col}")
+        id_column, _, allowed = LOOKUP_TABLES[table]
+        defaults = defaults or {}
+        if any(column not in allowed for column in defaults):
+            raise ValueError(f"get_or_create() can not set {sorted(set(defaults) - set(allowed))} on {table}")
+
+        database = _database_file(cursor)
+        key = (database, table, unique_val)
+        if database and key in _id_cache:
+            _id_cache.move_to_end(key)
+            return _id_cache[key]
+
+        columns = [unique_col] + list(defaults.keys())
+        values = [unique_val] + list(defaults.values())
+        insert_sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in values)})"
+
+        if _has_unique_index(cursor, table, unique_col):
+            # the no-op update makes RETURNING give back the existing row on a conflict.
+            cursor.execute(f"{insert_sql} ON CONFLICT ({unique_col}) DO UPDATE SET {unique_col} = excluded.{unique_col} "
+                           f"RETURNING {id_column}", values)
+            row_id = cursor.fetchone()[0]
         else:
-            columns = [unique_col] + (list(defaults.keys()) if defaults else [])
-            values = [unique_val] + (list(defaults.values()) if defaults else [])
-            placeholders = ', '.join(['?'] * len(values))
-            cursor.execute(
-                f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})",
-                values
-            )
-            return cursor.lastrowid
-    except Exception as e: 
-        log_error_to_file(e, f"Error in get_or_create() for table '{table}' with value '{unique_val}'")
+            cursor.execute(f"SELECT {id_column} FROM {table} WHERE {unique_col} = ? ORDER BY {id_column} LIMIT 1", (unique_val,))
+            row = cursor.fetchone()
+            if row:
+                row_id = row[0]
+            else:
+                cursor.execute(insert_sql, values)
+                row_id = cursor.lastrowid
+
+        if database:
+            _id_cache[key] = row_id
+            if len(_id_cache) > ID_CACHE_SIZE:
+                _id_cache.popitem(last=False)
+        return row_id
+    except Exception as e:
+        log_error_to_file(context_message=f"Error in get_or_create() for table '{table}' with value '{unique_val}'", exception=e)
         raise
 
-def setup_experiment_metadata(db_path, username, project_name, experiment_name, document_name):
-    """ Called once at the start before logging. Returns all parent-level IDs (User, Project, Eperiment, Document.)"""
-    try: 
-        conn = sqlite3.connect(db_path)
+def _experiment_ids(cursor, username, project_name, experiment_name, document_name):
+    user_id = get_or_create(cursor, "Users", "Username", username)
+    project_id = get_or_create(cursor, "Projects", "Name", project_name, {"UserID": user_id})
+    experiment_id = get_or_create(cursor, "Experiments", "Name", experiment_name, {"ProjectID": project_id})
+    document_id = get_or_create(cursor, "Documents", "Name", document_name, {"ExperimentID": experiment_id})
+    return {
+        "UserID": user_id,
+        "ProjectID": project_id,
+        "ExperimentID": experiment_id,
+        "DocumentID": document_id
+    }
+
+def register_experiments(db_path, entries):
+    """ setup_experiment_metadata() for many (username, project, experiment, document) entries in one
+        transaction, e.g. when importing historical runs. Returns the id dicts in the same order.
+        The write lock is taken up front, so concurrent registrations never create the same row twice.
+    """
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
         cursor = conn.cursor()
-
-        # Insert or get each ID
-        user_id = get_or_create(cursor, "Users", "Username", username)
-        project_id = get_or_create(cursor, "Projects", "Name", project_name, {"UserID": user_id})
-        experiment_id = get_or_create(cursor, "Experiments", "Name", experiment_name, {"ProjectID": project_id})
-        document_id = get_or_create(cursor, "Documents", "Name", document_name, {"ExperimentID": experiment_id})
-
-        conn.commit()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            results = [_experiment_ids(cursor, *entry) for entry in entries]
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            # ids created in the rolled back transaction may be cached.
+            clear_id_cache()
+            raise
+        return results
+    finally:
         conn.close()
 
-        return {
-            "UserID": user_id,
-            "ProjectID": project_id,
-            "ExperimentID": experiment_id,
-            "DocumentID": document_id
-        }
+def setup_experiment_metadata(db_path, username, project_name, experiment_name, document_name):
+    """ Called once at the start before logging. Returns all parent-level IDs (User, Project, Eperiment, Document.)"""
+    try:
+        return register_experiments(db_path, [(username, project_name, experiment_name, document_name)])[0]
     except Exception as e:
-        log_error_to_file(e, "Error in setup_experiment_metadata()")
+        log_error_to_file(context_message="Error in setup_experiment_metadata()", exception=e)
         return {}
 
-def insert_probe_sample_and_spectrum(db_path, document_id, metadata_dict, spectrum_csv_path):
-    """Called during the experiment for each spectrum to insert. Probe, Sample, Spectrum file path and timestamp."""
-
+def _spectrum_recorded_at(spectrum_csv_path):
+    """ Extract timestamp from filename, fallback to now"""
     try:
-        with sqlite3.connect(db_path) as conn:
-            cursor = conn.cursor()
-       
-            # Prepare probe data to be inserted. 
-            probe_values = [
-                metadata_dict.get("Probe Description", "No description"),
-                document_id,
-                metadata_dict.get("LatestTemperatureCelsius"),
-                metadata_dict.get("LatestTemperatureTime")
-            ]
-            probe_sql = f"INSERT INTO Probes ({', '.join(PROBE_COLUMNS)}) VALUES ({', '.join('?' for _ in PROBE_COLUMNS)})"
-            cursor.execute(probe_sql, probe_values)
-            probe_id = cursor.lastrowid
-
-            # Prepare values for Samples
-            sample_values = [
-                probe_id,
-                metadata_dict.get("Sample Count", 0),
-                metadata_dict.get("Last Sample Time"),
-                metadata_dict.get("Current Sampling Interval")
-            ]
-            sample_sql = f"INSERT INTO Samples ({', '.join(SAMPLE_COLUMNS)}) VALUES ({', '.join('?' for _ in SAMPLE_COLUMNS)})"
-            cursor.execute(sample_sql, sample_values)
-            sample_id = cursor.lastrowid
-
-        # Extract timestamp from filename, fallback to now
-        try:
-            base = os.path.basename(spectrum_csv_path)
-            ts_str = base.split("_", 2)[2].rsplit('.', 1)[0]
-            recorded_at = datetime.strptime(ts_str, "%d-%m-%Y_%H-%M-%S_%f").isoformat()
-        except Exception:
-                recorded_at = datetime.now().isoformat()
-
-        # Insert spectrum
-        spectra_values = [
-            sample_id,
-            "raw",
-            spectrum_csv_path,
-            recorded_at
-        ]
-        spectral_sql = f"INSERT INTO Spectra ({', '.join(SPECTRA_COLUMNS)}) VALUES  ({', '.join('?' for _ in SPECTRA_COLUMNS)})"
-        cursor.execute(spectral_sql, spectra_values)
+        base = os.path.basename(spectrum_csv_path)
+        ts_str = base.split("_", 2)[2].rsplit('.', 1)[0]
+        return datetime.strptime(ts_str, "%d-%m-%Y_%H-%M-%S_%f").isoformat()
+    except Exception:
+        return datetime.now().isoformat()
+
+def get_or_create_probe(cursor, document_id, description, temperature=None, temperature_time=None):
+    """ ProbeID of the probe of a document. Every probe has one row per document (unique index from
+        schema migration 4); the temperature is only stored when the row is created, readings go to ProbeTemperatures.
+    """
+    description = description or "No description"
+    probe_sql = f"INSERT OR IGNORE INTO Probes ({', '.join(PROBE_COLUMNS)}) VALUES ({', '.join('?' for _ in PROBE_COLUMNS)})"
+    cursor.execute(probe_sql, (description, document_id, temperature, temperature_time))
+    cursor.execute("SELECT ProbeID FROM Probes WHERE DocumentID IS ? AND Description = ? ORDER BY ProbeID LIMIT 1", (document_id, description))
+    return cursor.fetchone()[0]
+
+def create_probe(db_path, document_id, metadata_dict, writer=None):
+    """ get or create the Probes row of a document once per session, so each spectrum only references it.
+        Returns the ProbeID, or None if it could not be created.
+    """
+    values = (
+        document_id,
+        metadata_dict.get("Probe Description"),
+        metadata_dict.get("LatestTemperatureCelsius"),
+        metadata_dict.get("LatestTemperatureTime")
+    )
+    conn = None
+    try:
+        if writer is not None:
+            return writer.execute(lambda cursor: get_or_create_probe(cursor, *values))
 
+        conn = sqlite3.connect(db_path)
+        probe_id = get_or_create_probe(conn.cursor(), *values)
+        conn.commit()
+        return probe_id
+    except Exception as e:
+        log_error_to_file(context_message="Error in create_probe()", exception=e)
+        return None
+    finally:
+        if conn is not None:
+            conn.close()
+
+def _temperature_reading(metadata_dict):
+    """ (epoch-ms, celsius) of the probe's latest temperature reading, or None if there is none."""
+    celsius = metadata_dict.get("LatestTemperatureCelsius")
+    reading_time = metadata_dict.get("LatestTemperatureTime")
+    if celsius is None or not isinstance(reading_time, datetime):
+        return None
+    return datetime_to_ms(reading_time), celsius
+
+def _insert_probe_sample_and_spectrum(cursor, document_id, metadata_dict, spectrum_csv_path, row_offset, recorded_at, blobs=None,
+                                      probe_id=None, temperature=None):
+    """ the INSERTs for one spectrum, on whichever connection the cursor belongs to.
+        blobs is None or (wavenumbers, [(type, encoding, blob), ...]) for spectra kept in the db.
+        probe_id is the session's Probes row (looked up from the metadata if None); temperature is
+        None or an (epoch-ms, celsius) reading to add to ProbeTemperatures.
+    """
+    if probe_id is None:
+        probe_id = get_or_create_probe(cursor, document_id, metadata_dict.get("Probe Description"),
+                                       metadata_dict.get("LatestTemperatureCelsius"), metadata_dict.get("LatestTemperatureTime"))
+    if temperature is not None:
+        cursor.execute("INSERT OR IGNORE INTO ProbeTemperatures (ProbeID, TimeMs, Celsius) VALUES (?, ?, ?)", (probe_id, *temperature))
+
+    # Prepare values for Samples
+    sample_values = [
+        probe_id,
+        metadata_dict.get("Sample Count", 0),
+        metadata_dict.get("Last Sample Time"),
+        metadata_dict.get("Current Sampling Interval")
+    ]
+    sample_sql = f"INSERT INTO Samples ({', '.join(SAMPLE_COLUMNS)}) VALUES ({', '.join('?' for _ in SAMPLE_COLUMNS)})"
+    cursor.execute(sample_sql, sample_values)
+    sample_id = cursor.lastrowid
+
+    # Insert spectrum (and the treated spectrum when intensities are kept in the db)
+    spectral_sql = f"INSERT INTO Spectra ({', '.join(SPECTRA_COLUMNS)}) VALUES  ({', '.join('?' for _ in SPECTRA_COLUMNS)})"
+    if blobs is None:
+        cursor.execute(spectral_sql, [sample_id, document_id, "raw", spectrum_csv_path, row_offset, recorded_at, None, None, None])
+        return cursor.lastrowid
+
+    wavenumbers, encoded_spectra = blobs
+    axis_id = get_or_create_axis(cursor, document_id, wavenumbers)
+    cursor.executemany(spectral_sql, [
+        [sample_id, document_id, spectrum_type, spectrum_csv_path, row_offset, recorded_at, axis_id, encoding, blob]
+        for spectrum_type, encoding, blob in encoded_spectra
+    ])
+    return cursor.lastrowid
+
+def insert_probe_sample_and_spectrum(db_path, document_id, metadata_dict, spectrum_csv_path, row_offset=None, recorded_at=None, writer=None,
+                                     wavenumbers=None, intensities=None, treated_intensities=None, compress=False, probe_id=None,
+                                     new_temperature=True):
+    """Called during the experiment for each spectrum to insert. Probe, Sample, Spectrum file path and timestamp.
+       For spectra kept in a binary spectrum store, spectrum_csv_path is the store file and row_offset its row.
+       Passing intensities (and wavenumbers) stores the spectrum itself as a float32 BLOB, plus a 'treated'
+       row for treated_intensities; compress=True zlib compresses the BLOBs.
+       With a DBWriter the insert is queued and committed with the next group, so the caller never waits
+       for the database; errors are then logged by the writer.
+       Pass the session's probe_id (see create_probe) to skip the Probes lookup; the temperature reading in
+       the metadata is added to ProbeTemperatures unless new_temperature=False (reading already stored).
+    """
+    if recorded_at is None:
+        recorded_at = _spectrum_recorded_at(spectrum_csv_path)
+    metadata_dict = dict(metadata_dict)
+    temperature = _temperature_reading(metadata_dict) if new_temperature else None
+
+    blobs = None
+    if intensities is not None:
+        # encode here so the writer thread only has to run the INSERTs.
+        encoded_spectra = [("raw", *encode_spectrum(intensities, compress))]
+        if treated_intensities is not None:
+            encoded_spectra.append(("treated", *encode_spectrum(treated_intensities, compress)))
+        blobs = (np.asarray(wavenumbers, dtype=np.float64), encoded_spectra)
+
+    if writer is not None:
+        writer.submit(lambda cursor: _insert_probe_sample_and_spectrum(
+            cursor, document_id, metadata_dict, spectrum_csv_path, row_offset, recorded_at, blobs, probe_id, temperature))
+        return
+
+    conn = None
+    try:
+        conn = sqlite3.connect(db_path)
+        _insert_probe_sample_and_spectrum(conn.cursor(), document_id, metadata_dict, spectrum_csv_path, row_offset, recorded_at, blobs,
+                                          probe_id, temperature)
         conn.commit()
-        print(f"✅ Inserted 1 spectrum for DocumentID {document_id}.")
+        debug_print(f"✅ Inserted 1 spectrum for DocumentID {document_id}.")
 
     except Exception as e:
         log_error_to_file(e, "Error in insert_probe_samples_and_spectra_batch()")
         print(f"❌ Error during inserting spectrum: {e}")
 
     finally:
-        conn.close()
-
-def create_new_trend(db_path, document_id, user_note=("")):
+        if conn is not None:
+            conn.close()
+
+def load_document_spectra(db_path, document_id, spectrum_type="raw"):
+    """ All BLOB spectra of one document as a RunSpectra (matrix, wavenumbers, epoch-ms timestamps),
+        with one indexed query for the spectra and a single np.frombuffer for uncompressed ones.
+    """
+    with sqlite3.connect(db_path) as conn:
+        rows = conn.execute("""
+            SELECT RecordedAt, AxisID, Encoding, Intensities FROM Spectra
+            WHERE DocumentID = ? AND Type = ? AND Intensities IS NOT NULL
+            ORDER BY RecordedAt
+        """, (document_id, spectrum_type)).fetchall()
+        if not rows:
+            return RunSpectra(np.empty((0, 0), dtype=SPECTRUM_DTYPE), np.empty(0), np.empty(0, dtype=TIMESTAMP_DTYPE))
+
+        axis_ids = {row[1] for row in rows}
+        if len(axis_ids) > 1:
+            raise ValueError(f"Document {document_id} has spectra on {len(axis_ids)} different wavenumber axes.")
+        axis_blob, = conn.execute("SELECT Axis FROM WavenumberAxes WHERE AxisID = ?", (axis_ids.pop(),)).fetchone()
+
+    wavenumbers = np.frombuffer(axis_blob, dtype="<f8")
+    if all(row[2] == "f32" for row in rows):
+        matrix = np.frombuffer(b"".join(row[3] for row in rows), dtype=SPECTRUM_DTYPE)
+    else:
+        matrix = np.concatenate([decode_spectrum(row[2], row[3]) for row in rows])
+    timestamps = np.array([round(datetime.fromisoformat(row[0]).timestamp() * 1000) for row in rows], dtype=TIMESTAMP_DTYPE)
+    return RunSpectra(matrix.reshape(len(rows), len(wavenumbers)), wavenumbers, timestamps)
+
+def _insert_trend(cursor, document_id, user_note):
+    cursor.execute("""
+        INSERT INTO Trends (DocumentID, StartTime, Usernote)
+        VALUES (?, ?, ?)
+    """, (document_id, datetime.now().isoformat(), user_note))
+    return cursor.lastrowid
+
+def create_new_trend(db_path, document_id, user_note=(""), writer=None):
     """insert new trend into the trends table"""
+    conn = None
     try:
+        if writer is not None:
+            return writer.execute(lambda cursor: _insert_trend(cursor, document_id, user_note))
+
         conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO Trends (DocumentID, StartTime, Usernote)
-            VALUES (?, ?, ?)
-        """, (document_id, datetime.now().isoformat(), user_note))
-        trend_id = cursor.lastrowid
+        trend_id = _insert_trend(conn.cursor(), document_id, user_note)
         conn.commit()
-        conn.close()
         return trend_id
     except Exception as e: 
         log_error_to_file(e, "Error in create_new_trend()")
         return -1
     finally:
-        conn.close()
+        if conn is not None:
+            conn.close()
+
+def _update_tick_stats(tick_stats, tick_ms, interval_sec):
+    """ keep running latency figures for the trend sampling loop."""
+    tick_stats["ticks"] += 1
+    tick_stats["last_ms"] = tick_ms
+    tick_stats["mean_ms"] += (tick_ms - tick_stats["mean_ms"]) / tick_stats["ticks"]
+    tick_stats["max_ms"] = max(tick_stats["max_ms"], tick_ms)
+    if tick_ms > interval_sec * 1000:
+        tick_stats["overruns"] += 1
+        metrics.count("trend_overruns")
+
+def get_or_create_series(cursor, trend_id, kind, node_id="", label="", description=None):
+    """ SeriesID of one sampled series (kind 'probe' or 'peak') of a trend."""
+    cursor.execute(
+        "INSERT OR IGNORE INTO TrendSeries (TrendID, Kind, NodeID, Label, Description) VALUES (?, ?, ?, ?, ?)",
+        (trend_id, kind, node_id or "", label or "", description)
+    )
+    cursor.execute(
+        "SELECT SeriesID FROM TrendSeries WHERE TrendID = ? AND Kind = ? AND NodeID = ? AND Label = ?",
+        (trend_id, kind, node_id or "", label or "")
+    )
+    return cursor.fetchone()[0]
+
+def _create_trend_series(cursor, trend_id, probe_source, probe_description, peak_node_ids):
+    """ SeriesIDs for the probe series and every peak, in the order of peak_node_ids."""
+    probe_series = get_or_create_series(cursor, trend_id, "probe", probe_source, description=probe_description)
+    return probe_series, [get_or_create_series(cursor, trend_id, "peak", node_id, label) for node_id, label in peak_node_ids]
+
+def _insert_trend_points(cursor, point_rows):
+    cursor.executemany("""
+        INSERT OR IGNORE INTO TrendPoints (SeriesID, TimeMs, Value, TreatedValue)
+        VALUES (?, ?, ?, ?)
+    """, point_rows)
+
+def start_trend_sampling(db_path, trend_id, probe_node, treated_node, probe_description, peak_nodes, interval_sec=2, batch_size=1, tick_stats=None, report_every=30, writer=None, stop_event=None):
+    """ Samples both probe and peak values at a fixed interval and stores in db.
+        All nodes are read with one batched Read call per tick. The achieved tick latency is
+        printed every report_every ticks and kept in tick_stats if a dict is passed in.
+        With a DBWriter the samples are queued to it instead of this thread holding its own connection.
+        Sampling runs until Ctrl + C or until stop_event is set; either way the buffer is flushed and the trend ended.
+    """
+
+    conn = None
+    if writer is None:
+        conn = sqlite3.connect(db_path)
 
-def start_trend_sampling(db_path, trend_id, probe_node, treated_node, probe_description, peak_nodes, interval_sec=2, batch_size=1):
-    """ Samples both probe and peak values at a fixed interval and stores in db."""
+    def flush(point_rows):
+        if writer is not None:
+            writer.submit(lambda cursor: _insert_trend_points(cursor, point_rows))
+        else:
+            _insert_trend_points(conn.cursor(), point_rows)
+            conn.commit()
 
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
     print("Sampling started ... Press Ctrl + C to stop.")
 
-    insert_count = 0
-    probe_temp_buffer = []
-    peak_sample_buffer= []
+    point_buffer = []
+    buffered_ticks = 0
 
-    try:
-        while True:
-            timestamp = datetime.now().isoformat()
-
-            # Read probe temp
-            probe_value = probe_node.get_value()
-            treated_value = treated_node.get_value()
-
-            probe_temp_buffer.append((
-                trend_id,
-                timestamp,
-                probe_description, 
-                probe_node.nodeid.to_string(),
-                probe_value,
-                treated_value
-            ))
-
-            for node_obj, label in peak_nodes:
-                peak_val = node_obj.get_value()
-                peak_sample_buffer.append((
-                    trend_id,
-                    timestamp,
-                    node_obj.nodeid.to_string(),
-                    peak_val,
-                    label
-                ))
-
-            if len(probe_temp_buffer) >= batch_size:
-                cursor.executemany("""
-                    INSERT INTO ProbeTempSamples (TrendID, Timestamp, Description, Source, Value, TreatedValue)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                """, probe_temp_buffer)
-
-                cursor.executemany("""
-                    INSERT INTO PeakSamples (TrendID, Timestamp, NodeID, Value, Label)
-                    VALUES (?, ?, ?, ?, ?)
-                """, peak_sample_buffer)
+    # NodeId strings never change during a trend so only serialise them once.
+    probe_source = probe_node.nodeid.to_string()
+    peak_node_ids = [(node_obj.nodeid.to_string(), label) for node_obj, label in peak_nodes]
+    nodes_to_read = [probe_node, treated_node] + [node_obj for node_obj, _ in peak_nodes]
 
-                conn.commit()
-                probe_temp_buffer.clear()
-                peak_sample_buffer.clear()
+    # every series is stored once in TrendSeries, each sample is then just (series, time, value).
+    create_series = lambda cursor: _create_trend_series(cursor, trend_id, probe_source, probe_description, peak_node_ids)
+    if writer is not None:
+        probe_series, peak_series = writer.execute(create_series)
+    else:
+        probe_series, peak_series = create_series(conn.cursor())
+        conn.commit()
 
-            time.sleep(interval_sec)
+    if tick_stats is None:
+        tick_stats = {}
+    tick_stats.update({"ticks": 0, "last_ms": 0.0, "mean_ms": 0.0, "max_ms": 0.0, "overruns": 0, "errors": 0})
+    next_tick = time.monotonic()
+
+    def wait_for_next_tick():
+        # sleep until the next scheduled tick so read/insert time does not add up as drift.
+        nonlocal next_tick
+        next_tick += interval_sec
+        now = time.monotonic()
+        if next_tick < now:
+            next_tick = now
+        if stop_event:
+            stop_event.wait(next_tick - now)
+        else:
+            time.sleep(next_tick - now)
 
-    except KeyboardInterrupt:
-        print("Sampling stopped.")
-        # Flush remaining
-        if probe_temp_buffer:
-            cursor.executemany("""
-                INSERT INTO ProbeTempSamples (TrendID, Timestamp, Description, Source, Value, TreatedValue)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, probe_temp_buffer)
-
-        if peak_sample_buffer:
-            cursor.executemany("""
-                INSERT INTO PeakSamples (TrendID, Timestamp, NodeID, Value, Label)
-                VALUES (?, ?, ?, ?, ?)
-            """, peak_sample_buffer)
+    try:
+        while not (stop_event and stop_event.is_set()):
+            tick_start = time.monotonic()
+            time_ms = datetime_to_ms(datetime.now())
+
+            # Read probe temp, treated value and all peaks in one round trip
+            try:
+                with metrics.timed("trend_read"):
+                    values = read_values(nodes_to_read)
+            except Exception as e:
+                # e.g. the connection dropped: skip this tick and keep sampling once it is back.
+                tick_stats["errors"] += 1
+                metrics.count("trend_read_errors")
+                log_error_to_file(context_message=f"Trend read failed, tick skipped ({tick_stats['errors']} so far)", exception=e)
+                wait_for_next_tick()
+                continue
+
+            probe_value, treated_value = values[0], values[1]
+
+            point_buffer.append((probe_series, time_ms, probe_value, treated_value))
+            point_buffer.extend((series_id, time_ms, peak_val, None) for series_id, peak_val in zip(peak_series, values[2:]))
+            buffered_ticks += 1
+            metrics.count("trend_samples", len(values))
+
+            if buffered_ticks >= batch_size:
+                flush(point_buffer)
+                point_buffer = []
+                buffered_ticks = 0
+
+            tick_ms = (time.monotonic() - tick_start) * 1000
+            _update_tick_stats(tick_stats, tick_ms, interval_sec)
+            if report_every and tick_stats["ticks"] % report_every == 0:
+                queue_info = f", writer queue {writer.queue_depth()}" if writer is not None else ""
+                print(f"Trend tick latency: last {tick_ms:.1f} ms, mean {tick_stats['mean_ms']:.1f} ms, "
+                      f"max {tick_stats['max_ms']:.1f} ms, {tick_stats['overruns']} overruns "
+                      f"({len(nodes_to_read)} nodes/tick{queue_info})")
+
+            wait_for_next_tick()
 
-        conn.commit()
+        print("Sampling stopped.")
 
-        end_time = datetime.now().isoformat()
-        cursor.execute("UPDATE Trends SET EndTime = ? WHERE TrendID = ?", (end_time, trend_id))
-        conn.commit()
+    except KeyboardInterrupt:
+        print("Sampling stopped.")
 
     except Exception as e:
-        log_error_to_file(e, "Error in start_trend_sampling()")
+        log_error_to_file(context_message="Error in start_trend_sampling()", exception=e)
         print(f"Error during sampling: {e}")
-        conn.rollback()
+        if conn is not None:
+            conn.rollback()
+            conn.close()
+        return
+
+    try:
+        # Flush remaining
+        if point_buffer:
+            flush(point_buffer)
 
+        end_time = datetime.now().isoformat()
+        if writer is not None:
+            writer.submit(lambda cursor: _set_trend_end(cursor, trend_id, end_time))
+        else:
+            _set_trend_end(conn.cursor(), trend_id, end_time)
+            conn.commit()
+    except Exception as e:
+        log_error_to_file(context_message="Error in start_trend_sampling()", exception=e)
     finally:
-        conn.close()
+        if conn is not None:
+            conn.close()
 
-def end_trend(db_path, trend_id):
+def _primary_key_order(conn, table):
+    """ ORDER BY clause for a table's primary key: rowid, or the key columns of a WITHOUT ROWID table."""
+    try:
+        conn.execute(f'SELECT rowid FROM "{table}" LIMIT 0')
+        return "rowid"
+    except sqlite3.OperationalError:
+        columns = sorted((row[5], row[1]) for row in conn.execute(f'PRAGMA table_info("{table}")') if row[5])
+        return ", ".join(f'"{name}"' for _, name in columns)
+
+def table_tail(conn, table, num_rows=5):
+    """ Column names and the last num_rows rows of a table by primary key, oldest first.
+        Walks the primary key b-tree backwards, so the cost does not depend on the table size.
+    """
+    order = _primary_key_order(conn, table)
+    descending = ", ".join(f"{column} DESC" for column in order.split(", "))
+    cursor = conn.execute(f'SELECT * FROM "{table}" ORDER BY {descending} LIMIT ?', (num_rows,))
+    columns = [description[0] for description in cursor.description]
+    return columns, cursor.fetchall()[::-1]
+
+# rowid tables up to this MAX(rowid) are counted exactly by storage_stats, a COUNT(*) of at most
+# this many rows is fast.
+EXACT_COUNT_MAX_ROWID = 100_000
+
+def storage_stats(conn, exact_counts=False):
+    """ Rows and bytes on disk per table and index as a list of dicts (name, type, table, rows, bytes).
+
+        Bytes come from the dbstat virtual table when SQLite has it (it reads page headers, not rows),
+        otherwise they are None. Rows are exact with exact_counts=True (a full COUNT per table);
+        otherwise they come from sqlite_stat1 (after ANALYZE) and are marked estimated. Rowid tables
+        without statistics are counted when MAX(rowid) is at most EXACT_COUNT_MAX_ROWID; larger ones
+        report MAX(rowid), a high-water mark that deletes do not lower, marked rowid_high_water.
+    """
+    objects = conn.execute(
+        "SELECT name, type, tbl_name FROM sqlite_master WHERE type IN ('table', 'index') ORDER BY tbl_name, type DESC, name"
+    ).fetchall()
+
+    sizes = {}
+    try:
+        sizes = dict(conn.execute("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name"))
+    except sqlite3.OperationalError:
+        pass
+
+    analyzed = {}
+    try:
+        for table, index, stat in conn.execute("SELECT tbl, idx, stat FROM sqlite_stat1"):
+            analyzed[index or table] = int(stat.split()[0])
+    except sqlite3.OperationalError:
+        pass
+
+    stats = []
+    table_rows = (None, False, False)
+    for name, object_type, table in objects:
+        rows, estimated, high_water = None, False, False
+        if object_type == "table":
+            if exact_counts:
+                rows = conn.execute(f'SELECT COUNT(*) FROM "{name}"').fetchone()[0]
+            elif name in analyzed:
+                rows, estimated = analyzed[name], True
+            elif _primary_key_order(conn, name) == "rowid":
+                rows = conn.execute(f'SELECT MAX(rowid) FROM "{name}"').fetchone()[0] or 0
+                if rows <= EXACT_COUNT_MAX_ROWID:
+                    rows = conn.execute(f'SELECT COUNT(*) FROM "{name}"').fetchone()[0]
+                else:
+                    estimated = high_water = True
+        elif name in analyzed:
+            rows, estimated = analyzed[name], True
+        else:
+            # an index (none of ours are partial) has one entry per row of its table.
+            rows, estimated, high_water = table_rows
+        if object_type == "table":
+            table_rows = (rows, estimated, high_water)
+        stats.append({"name": name, "type": object_type, "table": table, "rows": rows,
+                      "estimated": estimated, "rowid_high_water": high_water, "bytes": sizes.get(name)})
+    return stats
+
+def _set_trend_end(cursor, trend_id, end_time):
+    cursor.execute(
+        "UPDATE Trends SET EndTime = ? WHERE TrendID = ?",
+        (end_time, trend_id)
+    )
+
+def end_trend(db_path, trend_id, writer=None):
     """ Marks the end of trend with a timestamp."""
     try:
-        with sqlite3.connect(db_path) as conn:
-            cursor = conn.cursor()
-            end_time = datetime.now().isoformat()
-            cursor.execute(
-                "UPDATE Trends SET EndTime = ? WHERE TrendID = ?",
-                (end_time, trend_id)
-            )
-            conn.commit()
-            print(f"Trend {trend_id} marked as ended at {end_time}.")
+        end_time = datetime.now().isoformat()
+        if writer is not None:
+            writer.execute(lambda cursor: _set_trend_end(cursor, trend_id, end_time))
+        else:
+            with sqlite3.connect(db_path) as conn:
+                _set_trend_end(conn.cursor(), trend_id, end_time)
+                conn.commit()
+        print(f"Trend {trend_id} marked as ended at {end_time}.")
     except Exception as e: 
         log_error_to_file(e, f"Error in end_trend() for TrendID {trend_id}")
@@ -0,0 +1,157 @@
+# single long-lived database writer for the acquisition path.
+#
+# Every thread that wants to write hands a job (a function taking a cursor) to the writer's queue.
+# One background thread owns the only write connection, runs the jobs in order and commits them in
+# groups: a commit happens once max_batch jobs are pending or max_delay seconds after the first one,
+# whichever comes first. Jobs run inside their own SAVEPOINT so one failing job never rolls back the
+# others in its group.
+import time
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future
+
+from error_logger import log_error_to_file
+import metrics
+
+_STOP = object()
+
+
+class DBWriter:
+    """ Owns one persistent SQLite connection on its own thread and group-commits queued jobs."""
+
+    def __init__(self, db_path, max_batch=64, max_delay=0.5, report_every=0):
+        self.db_path = db_path
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.report_every = report_every
+        self.queue = queue.Queue()
+        self.stats = {"jobs": 0, "failed": 0, "commits": 0, "last_batch": 0,
+                      "last_commit_ms": 0.0, "mean_commit_ms": 0.0, "max_commit_ms": 0.0}
+        self._thread = None
+
+    def start(self):
+        """ open the connection and start the writer thread."""
+        ready = Future()
+        self._thread = threading.Thread(target=self._run, args=(ready,), name="db-writer", daemon=True)
+        self._thread.start()
+        ready.result()  # re-raises if the database could not be opened
+        return self
+
+    def submit(self, job, urgent=False):
+        """ Queue job(cursor) and return a Future with its return value once it is committed.
+            urgent=True commits the group straight away instead of waiting for the batch to fill,
+            for callers that block on the result (e.g. to get a new row id).
+        """
+        future = Future()
+        self.queue.put((job, future, urgent))
+        return future
+
+    def execute(self, job):
+        """ run job(cursor) through the writer and wait for its committed result."""
+        return self.submit(job, urgent=True).result()
+
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def stop(self, timeout=None):
+        """ commit everything still queued and close the connection."""
+        if self._thread is not None:
+            self.queue.put(_STOP)
+            self._thread.join(timeout)
+            self._thread = None
+        return dict(self.stats)
+
+    def _connect(self):
+        # the connection is only used from the writer thread; transactions are managed explicitly.
+        conn = sqlite3.connect(self.db_path, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        conn.execute("PRAGMA temp_store=MEMORY;")
+        conn.execute("PRAGMA busy_timeout=5000;")
+        return conn
+
+    def _run(self, ready):
+        try:
+            conn = self._connect()
+        except Exception as e:
+            log_error_to_file(context_message=f"DB writer could not open '{self.db_path}'", exception=e)
+            ready.set_exception(e)
+            return
+        ready.set_result(True)
+
+        stopping = False
+        try:
+            while not stopping:
+                item = self.queue.get()
+                if item is _STOP:
+                    break
+
+                # collect a group until it is full, urgent, or max_delay has passed.
+                batch = [item]
+                deadline = time.monotonic() + self.max_delay
+                while len(batch) < self.max_batch and not batch[-1][2]:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = self.queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                    if item is _STOP:
+                        stopping = True
+                        break
+                    batch.append(item)
+
+                self._commit_batch(conn, batch)
+        finally:
+            conn.close()
+
+    def _commit_batch(self, conn, batch):
+        start = time.perf_counter()
+        cursor = conn.cursor()
+        results = []
+
+        try:
+            cursor.execute("BEGIN")
+            for job, future, _ in batch:
+                cursor.execute("SAVEPOINT job")
+                try:
+                    results.append((future, job(cursor), None))
+                    cursor.execute("RELEASE job")
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO job")
+                    cursor.execute("RELEASE job")
+                    results.append((future, None, e))
+            cursor.execute("COMMIT")
+        except Exception as e:
+            # the commit itself failed, nothing of this group was written.
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            log_error_to_file(context_message=f"DB writer failed to commit a group of {len(batch)} jobs", exception=e)
+            results = [(future, None, e) for _, future, _ in batch]
+
+        commit_s = time.perf_counter() - start
+        commit_ms = commit_s * 1000
+        metrics.observe("db_commit", commit_s)
+        metrics.count("db_jobs", len(batch))
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                # fire-and-forget callers never look at the future, so failures are always logged here.
+                self.stats["failed"] += 1
+                metrics.count("db_failed_jobs")
+                log_error_to_file(context_message="DB writer job failed", exception=error)
+                future.set_exception(error)
+
+        stats = self.stats
+        stats["jobs"] += len(batch)
+        stats["commits"] += 1
+        stats["last_batch"] = len(batch)
+        stats["last_commit_ms"] = commit_ms
+        stats["mean_commit_ms"] += (commit_ms - stats["mean_commit_ms"]) / stats["commits"]
+        stats["max_commit_ms"] = max(stats["max_commit_ms"], commit_ms)
+        if self.report_every and stats["commits"] % self.report_every == 0:
+            print(f"DB writer: {stats['jobs']} jobs in {stats['commits']} commits, last {len(batch)} jobs in "
+                  f"{commit_ms:.1f} ms, mean {stats['mean_commit_ms']:.1f} ms, queue depth {self.queue_depth()}")
@@ -1,9 +1,34 @@
+# error log backend.
+#
+# log_error_to_file() only puts the error on a queue, a background thread formats it and appends it
+# to the log file, so logging from the acquisition loops never waits on the disk. The log path is read
+# when the error is logged, so errors stay in the file that was current at the time even if the path
+# changes before they are written.
+#
+# The writer keeps the file open, rotates it once it passes max_bytes (error_log.txt -> error_log.txt.1
+# -> ...) and de-duplicates bursts: an error with the same context and message as one logged less than
+# dedup_window seconds ago is only counted, and a single "repeated N times" entry is written when the
+# window closes.
 import os
+import time
+import queue
+import atexit
+import threading
 import traceback
 from datetime import datetime
 
 current_error_log_path = None
 
+MAX_BYTES = 5 * 1024 * 1024
+BACKUP_COUNT = 3
+DEDUP_WINDOW = 60.0
+
+_FLUSH = object()
+_queue = queue.SimpleQueue()
+_writer = None
+_writer_lock = threading.Lock()
+
+
 def set_error_log_path(path: str):
     """ Sets the global error log path for all logging operations. Ensures the dir exists."""
     global current_error_log_path
@@ -17,35 +42,165 @@ def get_error_log_path() -> str:
     """ get current error log file path."""
     return current_error_log_path
 
+def configure_error_logger(max_bytes: int = None, backup_count: int = None, dedup_window: float = None):
+    """ change the rotation size, number of rotated files kept and de-duplication window (seconds, 0 = off)."""
+    global MAX_BYTES, BACKUP_COUNT, DEDUP_WINDOW
+    if max_bytes is not None:
+        MAX_BYTES = max_bytes
+    if backup_count is not None:
+        BACKUP_COUNT = backup_count
+    if dedup_window is not None:
+        DEDUP_WINDOW = dedup_window
+
 def log_error_to_file(context_message: str = "No context provided", exception: Exception = None, logging_error=None):
-    """Logs error with timestamp, optional context, and stack trace."""
-    try:
-        if not current_error_log_path:
-            print(f"Error logger has not been configured with a path.")
-            return 
-
-        timestamp = datetime.now().strftime("%d-%m%Y_%H-%M-%S")
-
-        log_entry = (
-            f"\n--- ERROR LOG ---\n"
-            f"Timestamp: {timestamp}\n"
-            f"Context: {context_message}\n"
-        )
+    """Logs error with timestamp, optional context, and stack trace (queued, written by a background thread)."""
+    if not current_error_log_path:
+        print(f"Error logger has not been configured with a path.")
+        return
+
+    # an exception carries its own traceback; otherwise keep whatever is being handled right now.
+    trace = None
+    if exception is not None and not isinstance(exception, BaseException):
+        trace = traceback.format_exc()
+
+    _ensure_writer()
+    _queue.put((current_error_log_path, time.time(), str(context_message), exception, trace))
 
+def flush_error_log(timeout: float = 5.0) -> bool:
+    """ wait until every error logged so far has been written. Returns False on timeout."""
+    if _writer is None or not _writer.is_alive():
+        return True
+    done = threading.Event()
+    _queue.put((_FLUSH, done))
+    return done.wait(timeout)
+
+def _ensure_writer():
+    global _writer
+    if _writer is not None and _writer.is_alive():
+        return
+    with _writer_lock:
+        if _writer is None or not _writer.is_alive():
+            _writer = threading.Thread(target=_ErrorLogWriter().run, name="error-log-writer", daemon=True)
+            _writer.start()
+
+
+def _format_entry(timestamp, context_message, exception, trace, repeated=None):
+    log_entry = (
+        f"\n--- ERROR LOG ---\n"
+        f"Timestamp: {datetime.fromtimestamp(timestamp).strftime('%d-%m%Y_%H-%M-%S')}\n"
+        f"Context: {context_message}\n"
+    )
+
+    if repeated:
+        count, first, last = repeated
         if exception:
-            log_entry += (
-                f"Exception: {str(exception)}\n"
-                f"Traceback:\n{traceback.format_exc()}"
-            )
-        
-        log_entry += "-" * 60 + "\n"
-
-        with open(current_error_log_path, 'a', encoding='utf-8') as f:
+            log_entry += f"Exception: {exception}\n"
+        log_entry += (
+            f"Repeated {count} more time(s) between {datetime.fromtimestamp(first).strftime('%H-%M-%S')} "
+            f"and {datetime.fromtimestamp(last).strftime('%H-%M-%S')} (not written individually).\n"
+        )
+    elif exception is not None:
+        if isinstance(exception, BaseException):
+            trace = "".join(traceback.format_exception(type(exception), exception, exception.__traceback__))
+        log_entry += (
+            f"Exception: {str(exception)}\n"
+            f"Traceback:\n{trace}"
+        )
+
+    log_entry += "-" * 60 + "\n"
+    return log_entry
+
+
+class _ErrorLogWriter:
+    """ Runs on the writer thread: appends entries, rotates the file and folds repeated errors."""
+
+    def __init__(self):
+        self.files = {}     # path -> open file
+        self.recent = {}    # (path, context, message) -> [window start, repeats, first repeat, last repeat]
+
+    def run(self):
+        while True:
+            try:
+                item = _queue.get(timeout=1.0)
+            except queue.Empty:
+                self.close_windows(time.time())
+                continue
+
+            if item[0] is _FLUSH:
+                self.close_windows(None)
+                for f in self.files.values():
+                    f.flush()
+                item[1].set()
+                continue
+
+            self.handle(*item)
+            # write out everything already queued before flushing the file once.
+            while True:
+                try:
+                    item = _queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item[0] is _FLUSH:
+                    _queue.put(item)
+                    break
+                self.handle(*item)
+            self.close_windows(time.time())
+            for f in self.files.values():
+                f.flush()
+
+    def handle(self, path, timestamp, context_message, exception, trace):
+        message = str(exception) if exception is not None else ""
+        if DEDUP_WINDOW > 0:
+            key = (path, context_message, message)
+            window = self.recent.get(key)
+            if window is not None and timestamp - window[0] < DEDUP_WINDOW:
+                window[1] += 1
+                window[2] = window[2] or timestamp
+                window[3] = timestamp
+                return
+            if window is not None:
+                self.close_window(key, window)
+            self.recent[key] = [timestamp, 0, None, None]
+
+        self.write(path, _format_entry(timestamp, context_message, exception, trace))
+
+    def close_window(self, key, window):
+        path, context_message, message = key
+        if window[1]:
+            self.write(path, _format_entry(window[3], context_message, message, None, repeated=(window[1], window[2], window[3])))
+
+    def close_windows(self, now):
+        """ write the repeat counts of windows that have expired (all of them if now is None)."""
+        for key, window in list(self.recent.items()):
+            if now is None or now - window[0] >= DEDUP_WINDOW:
+                self.close_window(key, window)
+                del self.recent[key]
+
+    def write(self, path, log_entry):
+        try:
+            f = self.files.get(path)
+            if f is None:
+                f = self.files[path] = open(path, 'a', encoding='utf-8')
             f.write(log_entry)
+            if MAX_BYTES and f.tell() >= MAX_BYTES:
+                f.close()
+                del self.files[path]
+                self.rotate(path)
+
+        except Exception as logging_error:
+            # need to include so logger doesn't crash
+            print("Failed to write to log file.")
+            print(f"Log entry: {log_entry.strip()}")
+            print(f"Logging Error: {logging_error}")
+
+    def rotate(self, path):
+        if BACKUP_COUNT <= 0:
+            os.remove(path)
+            return
+        for index in range(BACKUP_COUNT - 1, 0, -1):
+            if os.path.exists(f"{path}.{index}"):
+                os.replace(f"{path}.{index}", f"{path}.{index + 1}")
+        os.replace(path, f"{path}.1")
+
 
-    except Exception as logging_error:
-        # need to include so logger doesn't crash
-        print("Failed to write to log file.")
-        print(f"Context: {context_message}")
-        print(f"Original Exception: {exception}")
-        print(f"Logging Error: {logging_error}")
+atexit.register(flush_error_log)
@@ -0,0 +1,374 @@
+# bulk import of historical runs from the logs/ tree into the database.
+#
+# Walks logs/<experiment>/spectra/spectrum_run_<timestamp>[_ProbeN] folders and registers every raw
+# and treated spectrum (CSV files, or the rows of a binary spectrum store) that is not in the Spectra
+# table yet. Recording times come from the file names (raw_spectrum_<dd-mm-YYYY_HH-MM-SS_fff>.csv)
+# or the store's timestamp index. The CSV files are parsed in a process pool with the vectorised
+# reader of spectrum_store, which also keeps truncated files from crashed runs out of the database,
+# and the rows are written with executemany in a few large transactions.
+#
+# Re-running the import is safe: spectra are matched on their path (separators normalised, so rows
+# logged on Windows match) and row offset, only the missing ones are inserted, and a run whose
+# spectra are already (partly) registered keeps its Document.
+import os
+import time
+import sqlite3
+import argparse
+import warnings
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+
+from common_utils import parse_timestamp_str
+from db_utils import (setup_database, get_or_create, get_or_create_probe, get_or_create_axis, encode_spectrum,
+                      _insert_document, clear_id_cache, SAMPLE_COLUMNS, SPECTRA_COLUMNS)
+from spectrum_store import SpectrumStore, store_exists, ms_to_timestamp_str, _read_csv_columns
+from error_logger import log_error_to_file
+
+RUN_PREFIX = "spectrum_run_"
+SPECTRUM_TYPES = ("raw", "treated")
+
+# one spectrum to register: row_offset is None for CSV files, recorded_at an ISO string.
+ImportEntry = namedtuple("ImportEntry", ["spectrum_type", "file_path", "row_offset", "recorded_at"])
+ImportRun = namedtuple("ImportRun", ["experiment", "run_dir", "run_timestamp", "namespaced", "entries"])
+
+
+def _path_key(path, depth=4):
+    """ experiment/spectra/run/file with '/' separators, the same for relative, absolute and Windows paths."""
+    return "/".join(path.replace("\\", "/").split("/")[-depth:])
+
+
+def _run_key(file_path):
+    """ experiment/spectra/run of a spectrum path."""
+    return _path_key(file_path, depth=4).rsplit("/", 1)[0]
+
+
+def _csv_entries(run_dir):
+    entries = []
+    for file_name in os.listdir(run_dir):
+        for spectrum_type in SPECTRUM_TYPES:
+            prefix = f"{spectrum_type}_spectrum_"
+            if file_name.startswith(prefix) and file_name.endswith(".csv"):
+                try:
+                    recorded_at = parse_timestamp_str(file_name[len(prefix):-len(".csv")])
+                except ValueError:
+                    continue  # not a logged spectrum (e.g. renamed by hand)
+                entries.append(ImportEntry(spectrum_type, os.path.join(run_dir, file_name), None, recorded_at.isoformat()))
+    return entries
+
+
+def _store_entries(run_dir):
+    entries = []
+    for spectrum_type in SPECTRUM_TYPES:
+        if not store_exists(run_dir, spectrum_type):
+            continue
+        store = SpectrumStore(run_dir, spectrum_type)
+        for row_offset, timestamp_ms in enumerate(store.timestamps()):
+            recorded_at = parse_timestamp_str(ms_to_timestamp_str(int(timestamp_ms)))
+            entries.append(ImportEntry(spectrum_type, store.data_path, row_offset, recorded_at.isoformat()))
+    return entries
+
+
+def find_runs(logs_dir="logs"):
+    """ Every spectrum_run_* folder under logs_dir (processed output folders are left out) with its spectra."""
+    runs = []
+    for folder, dir_names, _ in os.walk(logs_dir):
+        dir_names.sort()
+        if os.path.basename(folder) == "processed":
+            dir_names[:] = []
+            continue
+        run_name = os.path.basename(folder)
+        if not run_name.startswith(RUN_PREFIX):
+            continue
+        dir_names[:] = []
+
+        parent = os.path.dirname(folder)
+        if os.path.basename(parent) == "spectra":
+            parent = os.path.dirname(parent)
+        run_timestamp = run_name[len(RUN_PREFIX):len(RUN_PREFIX) + len("dd-mm-YYYY_HH-MM-SS")]
+        entries = _store_entries(folder) + _csv_entries(folder)
+        entries.sort(key=lambda entry: (entry.recorded_at, entry.spectrum_type, entry.row_offset or 0))
+        runs.append(ImportRun(os.path.basename(parent), folder, run_timestamp, run_name != RUN_PREFIX + run_timestamp, entries))
+    return runs
+
+
+def _parse_files(file_paths, keep_intensities, compress):
+    """ worker entry point: parses the CSV files and returns (file_path, wavenumbers, (encoding, blob), error)
+        for each, wavenumbers and blob only when keep_intensities is set.
+    """
+    results = []
+    for file_path in file_paths:
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", UserWarning)  # loadtxt warns about empty files, reported as failed instead
+                wavenumbers, values = _read_csv_columns(file_path)
+            if keep_intensities:
+                results.append((file_path, wavenumbers, encode_spectrum(values, compress), None))
+            else:
+                results.append((file_path, None, None, None))
+        except IndexError:
+            results.append((file_path, None, None, "no data rows"))
+        except Exception as e:
+            results.append((file_path, None, None, f"{type(e).__name__}: {e}"))
+    return results
+
+
+def _store_rows(entries, keep_intensities, compress):
+    """ (file_path/row, wavenumbers, blob, error) for store rows, read with one read per store."""
+    results = []
+    stores = {}
+    for entry in entries:
+        if not keep_intensities:
+            results.append((entry, None, None, None))
+            continue
+        if entry.file_path not in stores:
+            store = SpectrumStore(os.path.dirname(entry.file_path), entry.spectrum_type)
+            stores[entry.file_path] = store.read_all()
+        wavenumbers, _, matrix = stores[entry.file_path]
+        results.append((entry, wavenumbers, encode_spectrum(matrix[entry.row_offset], compress), None))
+    return results
+
+
+class _Importer:
+    """ Keeps the state of one import: what is registered already, and the runs' documents and probes."""
+
+    def __init__(self, db_path, hierarchy):
+        self.hierarchy = hierarchy
+        self.conn = sqlite3.connect(db_path, timeout=30)
+        self.conn.execute("PRAGMA synchronous=NORMAL;")
+        self.existing = set()       # (path key, row offset)
+        self.run_documents = {}     # run key -> DocumentID
+        self.samples = {}           # (DocumentID, recorded_at) -> SampleID
+        self.run_ids = {}           # run key -> (DocumentID, ProbeID)
+        self.axes = {}              # (DocumentID, number of points) -> AxisID
+        self._load_existing()
+
+    def _load_existing(self):
+        """ one scan of Spectra, a year of runs is a few million short rows."""
+        cursor = self.conn.execute("SELECT FilePath, RowOffset, DocumentID, SampleID, RecordedAt FROM Spectra WHERE FilePath IS NOT NULL")
+        for file_path, row_offset, document_id, sample_id, recorded_at in cursor:
+            self.existing.add((_path_key(file_path), row_offset))
+            if document_id is not None:
+                self.run_documents.setdefault(_run_key(file_path), document_id)
+                self.samples.setdefault((document_id, recorded_at), sample_id)
+
+    def new_entries(self, run):
+        return [entry for entry in run.entries if (_path_key(entry.file_path), entry.row_offset) not in self.existing]
+
+    def _document(self, cursor, run, run_key):
+        document_id = self.run_documents.get(run_key)
+        if document_id is not None:
+            return document_id
+
+        # a run logged before its spectra were registered still has its Document (same error log timestamp).
+        if not run.namespaced:
+            error_log_name = f"error_log_{run.run_timestamp}.txt"
+            cursor.execute("SELECT DocumentID, ErrorLogPath FROM Documents WHERE Name = ? ORDER BY DocumentID", (run.experiment,))
+            for document_id, error_log_path in cursor.fetchall():
+                if error_log_path and error_log_path.replace("\\", "/").rsplit("/", 1)[-1] == error_log_name:
+                    return document_id
+
+        experiment_id = None
+        if self.hierarchy is not None:
+            username, project_name = self.hierarchy
+            user_id = get_or_create(cursor, "Users", "Username", username)
+            project_id = get_or_create(cursor, "Projects", "Name", project_name, {"UserID": user_id})
+            experiment_id = get_or_create(cursor, "Experiments", "Name", run.experiment, {"ProjectID": project_id})
+        error_log_path = os.path.join(os.path.dirname(os.path.dirname(run.run_dir)), f"error_log_{run.run_timestamp}.txt")
+        return _insert_document(cursor, run.experiment, experiment_id, error_log_path)
+
+    def _run_ids(self, cursor, run, run_key):
+        """ (DocumentID, ProbeID) of a run, creating them for runs that were never registered."""
+        document_id = self._document(cursor, run, run_key)
+        cursor.execute("SELECT ProbeID FROM Probes WHERE DocumentID = ? ORDER BY ProbeID LIMIT 1", (document_id,))
+        row = cursor.fetchone()
+        probe_id = row[0] if row else get_or_create_probe(cursor, document_id, None)
+        return document_id, probe_id
+
+    def write(self, batch):
+        """ Insert a batch of (run, [(entry, wavenumbers, (encoding, blob))]) in one transaction."""
+        cursor = self.conn.cursor()
+        run_ids = {}
+        axes = {}
+        samples = {}
+        sample_rows = []
+        spectra_rows = []
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            # ids are handed out here so Samples and Spectra can both go out with executemany.
+            cursor.execute("SELECT COALESCE(MAX(SampleID), 0) FROM Samples")
+            next_sample_id = cursor.fetchone()[0] + 1
+
+            for run, parsed in batch:
+                run_key = _path_key(run.run_dir, depth=3)
+                if run_key not in self.run_ids and run_key not in run_ids:
+                    run_ids[run_key] = self._run_ids(cursor, run, run_key)
+                document_id, probe_id = self.run_ids.get(run_key) or run_ids[run_key]
+
+                for entry, wavenumbers, encoded in parsed:
+                    axis_id = None
+                    if wavenumbers is not None:
+                        axis_key = (document_id, len(wavenumbers))
+                        axis_id = axes.get(axis_key) or self.axes.get(axis_key)
+                        if axis_id is None:
+                            axis_id = axes[axis_key] = get_or_create_axis(cursor, document_id, wavenumbers)
+
+                    sample_key = (document_id, entry.recorded_at)
+                    sample_id = samples.get(sample_key) or self.samples.get(sample_key)
+                    if sample_id is None:
+                        sample_id = samples[sample_key] = next_sample_id
+                        next_sample_id += 1
+                        sample_rows.append((sample_id, probe_id, 0, None, None))
+
+                    encoding, blob = encoded if encoded is not None else (None, None)
+                    spectra_rows.append((sample_id, document_id, entry.spectrum_type, entry.file_path, entry.row_offset,
+                                         entry.recorded_at, axis_id, encoding, blob))
+
+            cursor.executemany(
+                f"INSERT INTO Samples (SampleID, {', '.join(SAMPLE_COLUMNS)}) VALUES (?, {', '.join('?' for _ in SAMPLE_COLUMNS)})",
+                sample_rows
+            )
+            cursor.executemany(
+                f"INSERT INTO Spectra ({', '.join(SPECTRA_COLUMNS)}) VALUES ({', '.join('?' for _ in SPECTRA_COLUMNS)})",
+                spectra_rows
+            )
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            # documents, probes and experiments created in the batch are gone again.
+            clear_id_cache()
+            raise
+
+        self.run_ids.update(run_ids)
+        self.axes.update(axes)
+        self.samples.update(samples)
+        for row in spectra_rows:
+            self.existing.add((_path_key(row[3]), row[4]))
+        return len(spectra_rows)
+
+    def close(self):
+        self.conn.close()
+
+
+def import_logs(logs_dir="logs", db_path="ReactIR.db", workers=None, chunksize=256, batch_size=20000,
+                spectra_in_db=False, compress=False, username=None, project_name=None):
+    """ Register every spectrum under logs_dir that is not in the database yet.
+
+        CSV files are parsed by a pool of workers processes (default: one per CPU) in chunks of
+        chunksize files, files that cannot be parsed are reported and skipped. Rows are written in
+        transactions of about batch_size spectra. spectra_in_db=True also stores the intensities as
+        BLOBs (zlib compressed with compress=True), like the logger's spectrum_format "db".
+        New Documents are attached to an Experiment named after the experiment folder, under
+        project_name of username, when both are given.
+        Returns a summary dict with the runs, imported, skipped and failed (path, error) spectra and the wall time.
+    """
+    start_time = time.perf_counter()
+    summary = {"runs": 0, "imported": 0, "skipped": 0, "failed": [], "wall_time": 0.0}
+
+    setup_database(db_path)
+    runs = find_runs(logs_dir)
+    summary["runs"] = len(runs)
+    hierarchy = (username, project_name) if username and project_name else None
+    importer = _Importer(db_path, hierarchy)
+
+    tasks = []   # (run, store entries, csv entries)
+    for run in runs:
+        entries = importer.new_entries(run)
+        summary["skipped"] += len(run.entries) - len(entries)
+        if entries:
+            tasks.append((run, [entry for entry in entries if entry.row_offset is not None],
+                          [entry for entry in entries if entry.row_offset is None]))
+
+    num_new = sum(len(store_entries) + len(csv_entries) for _, store_entries, csv_entries in tasks)
+    print(f"📂 {len(runs)} runs under {logs_dir}: {summary['skipped']} spectra already registered, {num_new} to import.")
+
+    batch = []
+    batch_rows = 0
+
+    def flush():
+        nonlocal batch, batch_rows
+        if batch:
+            summary["imported"] += importer.write(batch)
+            print(f"💾 {summary['imported']}/{num_new} spectra imported ...")
+        batch = []
+        batch_rows = 0
+
+    def collect(run, results):
+        nonlocal batch_rows
+        parsed = []
+        for entry, wavenumbers, encoded, error in results:
+            if error:
+                summary["failed"].append((entry.file_path, error))
+                continue
+            parsed.append((entry, wavenumbers, encoded))
+        if parsed:
+            batch.append((run, parsed))
+            batch_rows += len(parsed)
+        if batch_rows >= batch_size:
+            flush()
+
+    workers = workers or os.cpu_count() or 1
+    try:
+        executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        try:
+            futures = {}
+
+            def collect_future(future):
+                run, chunk = futures.pop(future)
+                collect(run, [(entry, *result[1:]) for entry, result in zip(chunk, future.result())])
+
+            for run, store_entries, csv_entries in tasks:
+                if store_entries:
+                    collect(run, _store_rows(store_entries, spectra_in_db, compress))
+                for index in range(0, len(csv_entries), chunksize):
+                    chunk = csv_entries[index:index + chunksize]
+                    file_paths = [entry.file_path for entry in chunk]
+                    if executor is None:
+                        results = _parse_files(file_paths, spectra_in_db, compress)
+                        collect(run, [(entry, *result[1:]) for entry, result in zip(chunk, results)])
+                        continue
+                    # keep a bounded number of chunks in flight so parsed BLOBs are not all held in memory.
+                    if len(futures) >= workers * 2:
+                        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            collect_future(future)
+                    futures[executor.submit(_parse_files, file_paths, spectra_in_db, compress)] = (run, chunk)
+
+            for future in as_completed(list(futures)):
+                collect_future(future)
+            flush()
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+    except Exception as e:
+        log_error_to_file(context_message=f"Error importing '{logs_dir}' into '{db_path}'", exception=e)
+        raise
+    finally:
+        importer.close()
+
+    for file_path, error in summary["failed"]:
+        print(f"⚠️ Could not import '{file_path}': {error}")
+    summary["wall_time"] = time.perf_counter() - start_time
+    print(f"✅ Import finished: {summary['imported']} imported, {summary['skipped']} already registered, "
+          f"{len(summary['failed'])} failed in {summary['wall_time']:.1f} s.")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Register the spectra of historical runs in the logs/ tree in the database.")
+    parser.add_argument("logs_dir", nargs="?", default="logs")
+    parser.add_argument("--db", default="ReactIR.db", help="database file (created/migrated if needed)")
+    parser.add_argument("--workers", type=int, default=None, help="parser processes (default: one per CPU)")
+    parser.add_argument("--chunksize", type=int, default=256, help="CSV files per parser task")
+    parser.add_argument("--batch-size", type=int, default=20000, help="spectra per transaction")
+    parser.add_argument("--spectra-in-db", action="store_true", help="also store the intensities as BLOBs")
+    parser.add_argument("--compress", action="store_true", help="zlib compress the BLOBs")
+    parser.add_argument("--user", default=None, help="with --project, attach new documents to experiments of this user")
+    parser.add_argument("--project", default=None)
+    args = parser.parse_args()
+
+    import_logs(args.logs_dir, args.db, workers=args.workers, chunksize=args.chunksize, batch_size=args.batch_size,
+                spectra_in_db=args.spectra_in_db, compress=args.compress, username=args.user, project_name=args.project)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,50 +1,104 @@
-# querying the nodes on the IR to get the metadata of the reaction. 
+# querying the nodes on the IR to get the metadata of the reaction.
 from opcua import ua
 import traceback
 from opcua.ua.uaerrors import UaStatusCodeError
 from opcua.ua import uaerrors
 
 from error_logger import log_error_to_file
+from node_utils import read_attributes
 
-def get_probe1_data (client, probe1_node_id):
-    """ queries selected child nodes of Probe1 node and returns 
-        their nodes and values.
+# Probe1 children that change with every spectrum. Everything else (names, description, ...)
+# is static for a run and only needs to be read once.
+PER_SPECTRUM_FIELDS = [
+    "Probe Status",
+    "Sample Count",
+    "Current Sampling Interval",
+    "Last Sample Time",
+    "Last Sample Treated Spectra",
+    "LatestTemperatureCelsius",
+    "LatestTemperatureTime",
+]
+
+
+class ProbeMetadataReader:
+    """ Browses the children of a probe node and resolves their display names once per session.
+        Each call to read() then fetches the requested values in a single batched request.
     """
 
-    probe1_results = []
+    def __init__(self, client, probe_node_id):
+        self.client = client
+        self.probe_node_id = probe_node_id
+        self.fields = {}    # display name -> child node, in browse order
+        self.values = {}    # display name -> last value read
 
-    try:
-        probe_node = client.get_node(probe1_node_id)
+    def browse(self):
+        """ (re)browse the probe node and resolve all child display names in one request."""
+        probe_node = self.client.get_node(self.probe_node_id)
         child_nodes = probe_node.get_children()
 
-        for child in child_nodes:
-            try: 
-                display_name = child.get_display_name().Text
-                value_of_node = child.get_value()
+        self.fields = {}
+        for child, data_value in zip(child_nodes, read_attributes(child_nodes, ua.AttributeIds.DisplayName)):
+            if not data_value.StatusCode.is_good():
+                log_error_to_file(context_message=f"Could not read display name of child node '{child}'. Skipped.")
+                continue
+            self.fields.setdefault(data_value.Value.Value.Text, child)
 
-                display_value = value_of_node
-                
-                probe1_results.append((display_name, display_value))
+        return list(self.fields)
 
-            except uaerrors.BadAttributeIdInvalid as e:
-                log_error_to_file(
-                    context_message=f"Child node '{child}' does not support attribute 'Value'. Skipped. (BadAttributeIdInvalid)",
-                    exception=e
-                )
-            except UaStatusCodeError as e:
-                log_error_to_file(context_message=f"UaStatusCodeError when reading child node'{child}'",
-                exception=e
-                )
-            except Exception as e:
+    def read(self, fields=None):
+        """ Reads the values of the given display names (all fields if None) in one round trip and
+            returns (display name, value) pairs for every field read so far this session.
+        """
+        if not self.fields:
+            self.browse()
+
+        names = list(self.fields) if fields is None else [name for name in fields if name in self.fields]
+
+        for name, data_value in zip(names, read_attributes([self.fields[name] for name in names])):
+            status = data_value.StatusCode
+            if status.is_good():
+                self.values[name] = data_value.Value.Value
+            elif status.value == ua.StatusCodes.BadAttributeIdInvalid:
+                # object nodes have no Value attribute, never ask for them again.
+                del self.fields[name]
                 log_error_to_file(
-                    context_message=f"Unexpected error while reading child node '{child}'",
-                    exception=e
+                    context_message=f"Child node '{name}' does not support attribute 'Value'. Skipped. (BadAttributeIdInvalid)"
                 )
+            else:
+                log_error_to_file(context_message=f"Bad status {status.name} when reading child node '{name}'")
+
+        return [(name, self.values[name]) for name in self.fields if name in self.values]
+
+    def cached(self):
+        """ the (display name, value) pairs of the last reads, without asking the server."""
+        return [(name, self.values[name]) for name in self.fields if name in self.values]
+
+
+def get_probe_data(client, probe_node_id):
+    """ queries the child nodes of a probe node (e.g. ns=2;s=Local.iCIR.Probe2) and returns
+        their display names and values.
+    """
+
+    probe_results = []
+
+    try:
+        probe_results = ProbeMetadataReader(client, probe_node_id).read()
+
+    except UaStatusCodeError as e:
+        log_error_to_file(context_message=f"UaStatusCodeError when reading probe node '{probe_node_id}'",
+        exception=e
+        )
     except Exception as e:
         log_error_to_file(
-            context_message=f"Failed to read Probe 1 node '{probe1_node_id}'",
-            exception=e,
-            trace=traceback.format_exc()
+            context_message=f"Failed to read probe node '{probe_node_id}'",
+            exception=e
         )
 
-    return probe1_results
+    return probe_results
+
+
+def get_probe1_data (client, probe1_node_id):
+    """ queries selected child nodes of Probe1 node and returns
+        their nodes and values.
+    """
+    return get_probe_data(client, probe1_node_id)
@@ -0,0 +1,212 @@
+# low overhead acquisition metrics.
+#
+# Stage timers (calls, total and max seconds) and counters are kept in one process-wide registry and
+# updated from the acquisition threads with a lock held for a few dict operations. Live values such
+# as queue depths are registered as gauges: callables that are only evaluated when metrics are
+# exported. Metrics can be exported as Prometheus text on a local HTTP endpoint
+# (start_http_endpoint, GET /metrics) and/or written as a JSON snapshot file at a fixed interval
+# (SnapshotWriter).
+import os
+import json
+import time
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from error_logger import log_error_to_file
+
+PREFIX = "reactir"
+
+_lock = threading.Lock()
+_stages = {}     # stage -> [calls, total seconds, max seconds]
+_counters = {}   # name -> value
+_gauges = {}     # (name, labels) -> callable
+
+
+class _Timer:
+    """ context manager that adds the time spent in its block to a stage."""
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+def timed(stage):
+    """ with timed("opc_read"): ... times the block as one call of the stage (also when it raises)."""
+    return _Timer(stage)
+
+
+def observe(stage, seconds):
+    """ record one call of stage that took seconds."""
+    with _lock:
+        entry = _stages.get(stage)
+        if entry is None:
+            _stages[stage] = [1, seconds, seconds]
+        else:
+            entry[0] += 1
+            entry[1] += seconds
+            if seconds > entry[2]:
+                entry[2] = seconds
+
+
+def count(name, amount=1):
+    """ add amount to counter name (spectra logged, bytes written, retries, drops, ...)."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def set_gauge(name, value_fn, **labels):
+    """ register value_fn() as the current value of gauge name (with optional labels, e.g. probe="Probe 1")."""
+    with _lock:
+        _gauges[(name, tuple(sorted(labels.items())))] = value_fn
+
+
+def remove_gauge(name, **labels):
+    with _lock:
+        _gauges.pop((name, tuple(sorted(labels.items()))), None)
+
+
+def reset():
+    """ clear all stages, counters and gauges."""
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+        _gauges.clear()
+
+
+def _read_gauges(gauges):
+    values = []
+    for (name, labels), value_fn in gauges:
+        try:
+            values.append((name, labels, value_fn()))
+        except Exception:
+            continue  # e.g. the object behind it has already gone away
+    return values
+
+
+def snapshot():
+    """ all metrics as a JSON serialisable dict."""
+    with _lock:
+        stages = {stage: list(entry) for stage, entry in _stages.items()}
+        counters = dict(_counters)
+        gauges = list(_gauges.items())
+
+    return {
+        "timestamp": datetime.now().isoformat(timespec="milliseconds"),
+        "stages": {
+            stage: {"calls": calls, "total_s": total, "mean_ms": total / calls * 1000, "max_ms": max_s * 1000}
+            for stage, (calls, total, max_s) in stages.items()
+        },
+        "counters": counters,
+        "gauges": [{"name": name, **dict(labels), "value": value} for name, labels, value in _read_gauges(gauges)],
+    }
+
+
+def _label_str(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{str(value)}"' for key, value in labels) + "}"
+
+
+def prometheus_text():
+    """ all metrics in the Prometheus text exposition format."""
+    with _lock:
+        stages = sorted((stage, list(entry)) for stage, entry in _stages.items())
+        counters = sorted(_counters.items())
+        gauges = sorted(_gauges.items(), key=lambda item: item[0])
+
+    lines = [
+        f"# HELP {PREFIX}_stage_seconds Time spent per acquisition stage.",
+        f"# TYPE {PREFIX}_stage_seconds summary",
+    ]
+    for stage, (calls, total, _) in stages:
+        lines.append(f'{PREFIX}_stage_seconds_count{{stage="{stage}"}} {calls}')
+        lines.append(f'{PREFIX}_stage_seconds_sum{{stage="{stage}"}} {total:.6f}')
+    lines.append(f"# TYPE {PREFIX}_stage_seconds_max gauge")
+    for stage, (_, _, max_s) in stages:
+        lines.append(f'{PREFIX}_stage_seconds_max{{stage="{stage}"}} {max_s:.6f}')
+
+    for name, value in counters:
+        lines.append(f"# TYPE {PREFIX}_{name}_total counter")
+        lines.append(f"{PREFIX}_{name}_total {value}")
+
+    typed = set()
+    for name, labels, value in _read_gauges(gauges):
+        if name not in typed:
+            lines.append(f"# TYPE {PREFIX}_{name} gauge")
+            typed.add(name)
+        lines.append(f"{PREFIX}_{name}{_label_str(labels)} {float(value)}")
+
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes every few seconds would flood the console
+
+
+def start_http_endpoint(port=9464, host="127.0.0.1"):
+    """ Serve prometheus_text() at http://host:port/metrics from a daemon thread.
+        Returns the server, stop it with server.shutdown().
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-endpoint", daemon=True).start()
+    return server
+
+
+class SnapshotWriter:
+    """ Writes snapshot() to a JSON file every interval seconds (replacing it atomically) and once more on stop()."""
+
+    def __init__(self, path, interval=10.0):
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="metrics-snapshot", daemon=True)
+        self._thread.start()
+        return self
+
+    def write(self):
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(snapshot(), f, indent=2, default=str)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            log_error_to_file(context_message=f"Could not write metrics snapshot '{self.path}'", exception=e)
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.write()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
@@ -0,0 +1,31 @@
+# batched OPC UA reads so that many nodes cost a single round trip to the server.
+from opcua import ua
+
+
+def read_attributes(nodes, attribute=ua.AttributeIds.Value):
+    """ Reads one attribute of every node in a single Read service call and returns the DataValues
+        in the same order as the nodes.
+    """
+    if not nodes:
+        return []
+
+    params = ua.ReadParameters()
+    for node in nodes:
+        rv = ua.ReadValueId()
+        rv.NodeId = node.nodeid
+        rv.AttributeId = attribute
+        params.NodesToRead.append(rv)
+
+    # all nodes of one session share the same server/session object.
+    return nodes[0].server.read(params)
+
+
+def read_values(nodes, attribute=ua.AttributeIds.Value):
+    """ Reads the value of every node in one round trip. Nodes with a bad status code come back as None."""
+    values = []
+    for data_value in read_attributes(nodes, attribute):
+        if data_value.StatusCode.is_good():
+            values.append(data_value.Value.Value)
+        else:
+            values.append(None)
+    return values
@@ -0,0 +1,103 @@
+# asyncio building blocks for main.py's run orchestration.
+#
+# python-opcua is a blocking library, so its calls (and the long running spectrum logger and trend
+# sampler loops) run in worker threads through asyncio.to_thread. The orchestration itself is event
+# driven: probe status changes arrive through an OPC UA subscription and are turned into asyncio
+# events, readiness checks back off instead of sleeping a fixed time, and shutdown waits for the
+# tasks to drain rather than for a fixed delay.
+import time
+import asyncio
+
+from error_logger import log_error_to_file
+from spectrum_logger import _is_running
+
+
+class ProbeStatusWatcher:
+    """ Subscribes to the probe status node and mirrors it into asyncio events: running is set once
+        the probe reports 'Running', stopped once it reports anything else after having run.
+    """
+
+    def __init__(self, loop=None, label="Probe"):
+        self.loop = loop or asyncio.get_running_loop()
+        self.label = label
+        self.status = None
+        self.running = asyncio.Event()
+        self.stopped = asyncio.Event()
+        self.subscription = None
+
+    def datachange_notification(self, node, val, data):
+        """ called by the subscription thread, hands the value over to the event loop."""
+        try:
+            self.loop.call_soon_threadsafe(self._update, val)
+        except RuntimeError:
+            pass  # the loop has already closed, the run is over.
+
+    def status_change_notification(self, status):
+        log_error_to_file(context_message=f"OPC UA probe status subscription changed: {status}")
+
+    def _update(self, status):
+        if status != self.status:
+            print(f"\n🟢 {self.label} status changed: {status}")
+            self.status = status
+        if _is_running(status):
+            self.running.set()
+        elif self.running.is_set():
+            self.stopped.set()
+
+    async def start(self, client, probe_status_id, publishing_interval=500):
+        """ create the subscription. The server sends the current status straight away."""
+        def subscribe():
+            subscription = client.create_subscription(publishing_interval, self)
+            subscription.subscribe_data_change(client.get_node(probe_status_id))
+            return subscription
+
+        self.subscription = await asyncio.to_thread(subscribe)
+        return self
+
+    async def close(self):
+        if self.subscription is None:
+            return
+        try:
+            await asyncio.to_thread(self.subscription.delete)
+        except Exception as e:
+            log_error_to_file(context_message="Error deleting probe status subscription", exception=e)
+        self.subscription = None
+
+
+async def wait_for_children(node, timeout=90.0, first_delay=0.5, max_delay=5.0):
+    """ Browse node until it has children, backing off between attempts, and return them.
+        Returns [] if it still has none after timeout seconds.
+    """
+    deadline = time.monotonic() + timeout
+    delay = first_delay
+    attempt = 0
+
+    while True:
+        attempt += 1
+        try:
+            children = await asyncio.to_thread(node.get_children)
+            if children:
+                return children
+            print(f"⚠️ Attempt {attempt}: node found but has no children yet.")
+        except Exception as e:
+            print(f"❌ Attempt {attempt}: error browsing node: {e}")
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return []
+        await asyncio.sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
+
+
+async def drain(task, timeout, stop_event=None):
+    """ Give task up to timeout seconds to finish on its own, then set stop_event and wait for it to
+        exit. Returns True if it finished without being told to stop.
+    """
+    try:
+        await asyncio.wait_for(asyncio.shield(task), timeout)
+        return True
+    except asyncio.TimeoutError:
+        if stop_event is not None:
+            stop_event.set()
+        await task
+        return False
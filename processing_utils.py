@@ -1,8 +1,21 @@
 import os
 import csv
+import json
+import time
+import queue
+import hashlib
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 import numpy as np
 from scipy.signal import savgol_filter
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+
+from spectrum_store import SpectrumStore, store_exists, ms_to_timestamp_str, load_run
+from error_logger import log_error_to_file
+import metrics
+
+# sidecar file in each processed output folder recording what was processed and how.
+PROCESSED_INDEX_FILE = "processed_index.json"
 
 def adjust_window_length(window_length, data_length):
     """Ensure the window_length is an odd number, less than data_length, and at least 3."""
@@ -16,93 +29,436 @@ def adjust_window_length(window_length, data_length):
     return window_length
 
 def plot_and_save_spectrum(wavenumbers, transmittance, output_path):
-    """ plotting the transmittance vs wavenumber and saving that file as a pdf and a png within the specified directory."""
+    """ plotting the transmittance vs wavenumber and saving that file as a pdf and a png within the specified directory.
+        Uses its own Figure instead of pyplot's global state, so several threads can plot at once.
+    """
     
-    plt.figure(figsize=(14, 9))  
-    plt.plot(wavenumbers, transmittance, color='darkblue', linewidth=2)
+    fig = Figure(figsize=(14, 9))
+    ax = fig.add_subplot()
+    ax.plot(wavenumbers, transmittance, color='darkblue', linewidth=2)
     # Axis configuration as IR spectra typically show wavenumber decreasing left to right
-    plt.gca().invert_xaxis() 
-    plt.title("Infrared Spectrum", fontsize=28, weight='bold')
-    plt.xlabel("Wavenumber (cm⁻¹)", fontsize=24, labelpad=15)
-    plt.ylabel("Transmittance (%)", fontsize=24, labelpad=15)
-    plt.xticks(fontsize=20)
-    plt.yticks(fontsize=20)
-    plt.grid(False)
+    ax.invert_xaxis()
+    ax.set_title("Infrared Spectrum", fontsize=28, weight='bold')
+    ax.set_xlabel("Wavenumber (cm⁻¹)", fontsize=24, labelpad=15)
+    ax.set_ylabel("Transmittance (%)", fontsize=24, labelpad=15)
+    ax.tick_params(axis="both", labelsize=20)
+    ax.grid(False)
     # Tight layout for full visibility
-    plt.tight_layout()
+    fig.tight_layout()
 
     # Save to file
-    plt.savefig(f"{output_path}.png", dpi=300)
-    plt.savefig(f"{output_path}.pdf", dpi=300)
-    plt.close()
+    fig.savefig(f"{output_path}.png", dpi=300)
+    fig.savefig(f"{output_path}.pdf", dpi=300)
+
+def read_spectrum_csv(input_path):
+    """ load wavenumber and transmittance columns from a spectrum CSV, with or without header."""
+    wavenumbers = []
+    transmittance = []
+
+    with open(input_path, 'r', newline='') as file: 
+        # look through the first bit of file and check if there is a header, then go back to the beginning to read carefully.
+        sample_data = file.read(1024)
+        file.seek(0)
+        has_header = csv.Sniffer().has_header(sample_data)
+        reader = csv.reader(file)
+
+        if has_header:
+            next(reader)
+
+        for row in reader: 
+            try:
+                wavenumbers.append(float(row[0]))
+                transmittance.append(float(row[1]))
+            except (ValueError, IndexError):
+                continue
+
+    return np.array(wavenumbers), np.array(transmittance)
+
+def smooth_spectra(spectra, window_length=11, polyorder=2, axis=-1, mode="interp"):
+    """ Savitzky-Golay smoothing of a single spectrum or a whole (n_spectra x n_points) matrix in one
+        call along axis. The window is adjusted once for the number of points, so every spectrum of
+        a run is smoothed with the same window and edge mode.
+    """
+    spectra = np.asarray(spectra, dtype=np.float64)
+    window_length = adjust_window_length(window_length, spectra.shape[axis])
+    return savgol_filter(spectra, window_length, polyorder, axis=axis, mode=mode)
+
+def baseline_correct(spectra, edge_points=10, axis=-1):
+    """ Subtract a straight baseline drawn between the mean of the first and last edge_points of each
+        spectrum. Works on one spectrum or a whole matrix at once.
+    """
+    spectra = np.moveaxis(np.asarray(spectra, dtype=np.float64), axis, -1)
+    num_points = spectra.shape[-1]
+    edge_points = max(1, min(edge_points, num_points // 2))
+
+    start = spectra[..., :edge_points].mean(axis=-1, keepdims=True)
+    end = spectra[..., -edge_points:].mean(axis=-1, keepdims=True)
+    fraction = np.linspace(0.0, 1.0, num_points)
+    corrected = spectra - (start + (end - start) * fraction)
+    return np.moveaxis(corrected, -1, axis)
+
+def processing_params(smooth, window_length, polyorder, baseline=False):
+    """ the parameters that decide the content of a processed spectrum, as stored in the processed index."""
+    return {"smooth": bool(smooth), "window_length": int(window_length), "polyorder": int(polyorder),
+            "baseline": bool(baseline)}
+
+def prepare_spectra(spectra, params):
+    """ apply the smoothing and baseline steps described by processing_params() to one spectrum or a matrix."""
+    spectra = np.asarray(spectra, dtype=np.float64)
+    if params["smooth"] and spectra.shape[-1] >= params["window_length"]:
+        spectra = smooth_spectra(spectra, params["window_length"], params["polyorder"])
+    if params["baseline"]:
+        spectra = baseline_correct(spectra)
+    return spectra
+
+def _stored_or_batched_types(input_dir):
+    """ spectrum types that can be loaded as one run matrix (binary store or timestamped CSV files)."""
+    return [spectrum_type for spectrum_type in ("raw", "treated")
+            if store_exists(input_dir, spectrum_type)
+            or any(f.startswith(f"{spectrum_type}_spectrum_") and f.endswith(".csv") for f in os.listdir(input_dir))]
+
+def _content_hash(data):
+    """ cheap content hash used to tell if an input spectrum changed since it was processed."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def spectrum_hash(values):
+    """ content hash of a spectrum as float32 values, the same for a store row, a CSV row or a live spectrum."""
+    return _content_hash(np.ascontiguousarray(values, dtype=np.float32).tobytes())
+
+def _file_hash(path):
+    with open(path, "rb") as f:
+        return _content_hash(f.read())
+
+def _iter_input_spectra(input_dir, params, skip=None):
+    """ yields (file_name, source, prepared, content_hash) for every spectrum of a run folder for which
+        skip(file_name, content_hash) is not True.
+
+        Raw and treated spectra are loaded as one run matrix (from the binary store or the CSV files)
+        and smoothed/baselined in a single batch; source is then a (wavenumbers, transmittance)
+        pair. Rows are hashed and skipped before that, so only the rows left are smoothed. Stored
+        spectra are named as the CSV they replace so output names stay the same. Any other CSV, or a
+        run whose matrix can not be built, falls back to the CSV path as source.
+    """
+    batched_types = []
+    for spectrum_type in _stored_or_batched_types(input_dir):
+        try:
+            matrix, wavenumbers, timestamps = load_run(input_dir, spectrum_type)
+        except Exception as e:
+            print(f"Could not load {spectrum_type} spectra of '{input_dir}' as one matrix, reading files one by one: {e}")
+            continue
+
+        batched_types.append(spectrum_type)
+        if not len(timestamps):
+            continue
+
+        # hash the float32 rows, so a run hashes the same before and after convert_csv_run().
+        todo = []
+        for row, timestamp_ms in enumerate(timestamps):
+            file_name = f"{spectrum_type}_spectrum_{ms_to_timestamp_str(timestamp_ms)}.csv"
+            content_hash = spectrum_hash(matrix[row])
+            if skip is None or not skip(file_name, content_hash):
+                todo.append((row, file_name, content_hash))
+        if not todo:
+            continue
+
+        prepared = prepare_spectra(matrix[[row for row, _, _ in todo]], params)
+        for (_, file_name, content_hash), transmittance in zip(todo, prepared):
+            yield file_name, (wavenumbers, transmittance), True, content_hash
+
+    for file_name in sorted(f for f in os.listdir(input_dir) if f.endswith(".csv")):
+        if any(file_name.startswith(f"{spectrum_type}_spectrum_") for spectrum_type in batched_types):
+            continue
+        input_path = os.path.join(input_dir, file_name)
+        content_hash = _file_hash(input_path)
+        if skip is None or not skip(file_name, content_hash):
+            yield file_name, input_path, False, content_hash
+
+def count_input_spectra(input_dir):
+    """ number of spectra in a run folder, CSV files plus rows of the spectrum stores."""
+    stored_types = [spectrum_type for spectrum_type in ("raw", "treated") if store_exists(input_dir, spectrum_type)]
+    count = sum(len(SpectrumStore(input_dir, spectrum_type)) for spectrum_type in stored_types)
+    for file_name in os.listdir(input_dir):
+        if file_name.endswith(".csv") and not any(file_name.startswith(f"{t}_spectrum_") for t in stored_types):
+            count += 1
+    return count
+
+def _process_spectrum(file_name, source, prepared, output_dir, params, plot):
+    """ smooth/baseline (unless already done in batch), save and (optionally) plot one spectrum.
+        Output names only depend on file_name.
+    """
+    wavenumbers, transmittance = read_spectrum_csv(source) if isinstance(source, str) else source
+    if not len(transmittance):
+        raise ValueError("no numeric rows found")
+
+    base_filename = os.path.splitext(file_name)[0]
+    output_csv_path = os.path.join(output_dir, f"processed_{file_name}")
+    output_plot_path = os.path.join(output_dir, f"{base_filename}")
+
+    #smooth if requested
+    if not prepared:
+        transmittance = prepare_spectra(transmittance, params)
+
+    # save processed spectrum to CSV
+    with open(output_csv_path, 'w', newline='') as file_out:
+        writer = csv.writer(file_out)
+        writer.writerow(["wavenumber", "transmittance"])
+        for wn, tr in zip(wavenumbers, transmittance):
+            writer.writerow([wn,tr])
+
+    if plot:
+        plot_and_save_spectrum(wavenumbers, transmittance, output_plot_path)
+
+def _process_chunk(chunk, output_dir, params, plot):
+    """ worker entry point: processes a list of (file_name, source, prepared, content_hash) and returns
+        (file_name, error message or None) for each of them, so one bad file never stops the rest.
+    """
+    results = []
+    for file_name, source, prepared, _ in chunk:
+        try:
+            _process_spectrum(file_name, source, prepared, output_dir, params, plot)
+            results.append((file_name, None))
+        except Exception as e:
+            results.append((file_name, f"{type(e).__name__}: {e}"))
+    return results
+
+def load_processed_index(output_dir):
+    """ Load the processed-state index of an output folder: file name -> {hash, params, plotted}."""
+    index_path = os.path.join(output_dir, PROCESSED_INDEX_FILE)
+    if not os.path.exists(index_path):
+        return {}
+    try:
+        with open(index_path, "r", encoding="utf-8") as f:
+            return json.load(f).get("spectra", {})
+    except (ValueError, OSError) as e:
+        print(f"Processed index '{index_path}' could not be read, everything will be reprocessed: {e}")
+        return {}
+
+def save_processed_index(output_dir, index):
+    """ Write the processed-state index atomically so an interrupted run never leaves it half written."""
+    index_path = os.path.join(output_dir, PROCESSED_INDEX_FILE)
+    tmp_path = f"{index_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"format": 1, "spectra": index}, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, index_path)
+
+def is_up_to_date(index, output_dir, file_name, content_hash, params, plot):
+    """ True if file_name was already processed from the same content with the same parameters."""
+    entry = index.get(file_name)
+    return (entry is not None
+            and entry.get("hash") == content_hash
+            and entry.get("params") == params
+            and (entry.get("plotted") or not plot)
+            and os.path.exists(os.path.join(output_dir, f"processed_{file_name}")))
+
+def _iter_chunks(input_dir, chunksize, params, skip=None):
+    """ group the spectra of a run folder into chunks of chunksize, leaving out those for which skip(file_name, content_hash) is True."""
+    chunk = []
+    for task in _iter_input_spectra(input_dir, params, skip):
+        chunk.append(task)
+        if len(chunk) >= chunksize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
 def process_and_store_data(input_dir: str = "logs",
                            output_dir: str = "processed",
                            smooth: bool = False,
                            window_length: int = 11,
-                           polyorder: int = 2) -> None:
+                           polyorder: int = 2,
+                           workers: int = 1,
+                           chunksize: int = 16,
+                           plot: bool = True,
+                           incremental: bool = False,
+                           baseline: bool = False) -> dict:
    
-    """ open csv and process the data by applying smoothing and then save the processed data."""
+    """ open csv (or spectrum store) and process the data by applying smoothing and then save the processed data.
+
+        workers > 1 spreads chunks of chunksize spectra over a process pool. plot=False skips the
+        PNG/PDF figures, they can be rendered later from the processed CSVs with plot_processed_spectra().
+        incremental=True records every processed spectrum (content hash and parameters) in the output
+        folder's processed index after each chunk, and skips spectra that are already up to date, so
+        re-runs only touch new or changed spectra and an interrupted run resumes where it stopped.
+        baseline=True subtracts a linear baseline after smoothing.
+        Returns a summary dict with the processed, skipped and failed (file name, error) spectra and the wall time.
+    """
+    start_time = time.perf_counter()
+    summary = {"total": 0, "processed": 0, "skipped": 0, "failed": [], "wall_time": 0.0}
 
     os.makedirs(output_dir, exist_ok=True)
 
-    files = sorted([f for f in os.listdir(input_dir) if f.endswith(".csv")])
-    if not files:
+    num_spectra = count_input_spectra(input_dir)
+    if not num_spectra:
         print(f"No CSV files found in {input_dir}")
-        return
-    print(f"Processing {len(files)} spectra ...")
+        return summary
+    summary["total"] = num_spectra
+    print(f"Processing {num_spectra} spectra with {workers} worker(s) ...")
 
-    for file_name in files: 
-        input_path = os.path.join(input_dir, file_name)
-        base_filename = os.path.splitext(file_name)[0]
-        output_csv_path = os.path.join(output_dir, f"processed_{file_name}")
-        output_plot_path = os.path.join(output_dir, f"{base_filename}")
-
-        try: 
-            #load spectrum data
-            wavenumbers = []
-            transmittance = []
-
-            with open(input_path, 'r', newline='') as file: 
-                # look through the first bit of file and check if there is a header, then go back to the beginning to read carefully.
-                sample_data = file.read(1024)
-                file.seek(0)
-                has_header = csv.Sniffer().has_header(sample_data)
-                reader = csv.reader(file)
-
-                if has_header:
-                    next(reader)
-
-                for row in reader: 
-                    try:
-                        wavenumbers.append(float(row[0]))
-                        transmittance.append(float(row[1]))
-                    except (ValueError, IndexError):
-                        continue
-            
-            wavenumbers = np.array(wavenumbers)
-            transmittance = np.array(transmittance)
-
-            #smooth if requested
-            if smooth and len(transmittance) >= window_length:
-                # need to make sure window_length is odd.
-                window_length = adjust_window_length(window_length, len(transmittance))
-
-                transmittance = savgol_filter(transmittance, window_length, polyorder)
-
-            # save processed spectrum to CSV
-            with open(output_csv_path, 'w', newline='') as file_out:
-                writer = csv.writer(file_out)
-                writer.writerow(["wavenumber", "transmittance"])
-                for wn, tr in zip(wavenumbers, transmittance):
-                    writer.writerow([wn,tr])
-
-            plot_and_save_spectrum(wavenumbers, transmittance, output_plot_path)
-            print(f"Processed and Plotted: {base_filename}")
+    params = processing_params(smooth, window_length, polyorder, baseline)
+    options = (output_dir, params, plot)
+    index = load_processed_index(output_dir) if incremental else {}
+    hashes = {}
+    results = []
+
+    def skip(file_name, content_hash):
+        if incremental and is_up_to_date(index, output_dir, file_name, content_hash, params, plot):
+            summary["skipped"] += 1
+            return True
+        hashes[file_name] = content_hash
+        return False
+
+    def collect(chunk_results):
+        results.extend(chunk_results)
+        if not incremental:
+            return
+        for file_name, error in chunk_results:
+            if error is None:
+                index[file_name] = {"hash": hashes[file_name], "params": params, "plotted": bool(plot)}
+        save_processed_index(output_dir, index)
+
+    chunks = _iter_chunks(input_dir, chunksize, params, skip)
+    if workers <= 1:
+        for chunk in chunks:
+            collect(_process_chunk(chunk, *options))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = set()
+            for chunk in chunks:
+                # keep a bounded number of chunks in flight so a long run is not held in memory twice.
+                if len(pending) >= workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        collect(future.result())
+                pending.add(executor.submit(_process_chunk, chunk, *options))
+            for future in as_completed(pending):
+                collect(future.result())
+
+    for file_name, error in sorted(results):
+        if error:
+            summary["failed"].append((file_name, error))
+            print(f"Error processing '{file_name}': {error}")
+        else:
+            summary["processed"] += 1
+
+    summary["failed"].sort()
+    summary["wall_time"] = time.perf_counter() - start_time
+    print(f"All spectra have been processed! {summary['processed']} processed, {summary['skipped']} up to date, "
+          f"{len(summary['failed'])} failed in {summary['wall_time']:.1f} s.")
+    return summary
 
+def _plot_chunk(chunk, output_dir):
+    """ worker entry point for deferred plotting of processed CSV files."""
+    results = []
+    for file_name in chunk:
+        try:
+            wavenumbers, transmittance = read_spectrum_csv(os.path.join(output_dir, file_name))
+            base_filename = os.path.splitext(file_name[len("processed_"):])[0]
+            plot_and_save_spectrum(wavenumbers, transmittance, os.path.join(output_dir, base_filename))
+            results.append((file_name, None))
         except Exception as e:
-            print(f"Error processing '{file_name}': {e}")
+            results.append((file_name, f"{type(e).__name__}: {e}"))
+    return results
 
-    print("All spectra have been processed!")
-    return len(files)
+def plot_processed_spectra(output_dir: str, workers: int = 1, chunksize: int = 16) -> dict:
+    """ render the PNG/PDF figures for processed spectra that were written with plot=False.
+        Returns the same kind of summary as process_and_store_data.
+    """
+    start_time = time.perf_counter()
+    files = sorted(f for f in os.listdir(output_dir) if f.startswith("processed_") and f.endswith(".csv"))
+    chunks = [files[i:i + chunksize] for i in range(0, len(files), chunksize)]
 
+    if workers <= 1:
+        results = [result for chunk in chunks for result in _plot_chunk(chunk, output_dir)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = [result for chunk_results in executor.map(_plot_chunk, chunks, [output_dir] * len(chunks)) for result in chunk_results]
+
+    failed = sorted((file_name, error) for file_name, error in results if error)
+    summary = {"total": len(files), "processed": len(files) - len(failed), "failed": failed,
+               "wall_time": time.perf_counter() - start_time}
+    print(f"Plotted {summary['processed']} of {len(files)} processed spectra in {summary['wall_time']:.1f} s.")
+    return summary
+
+
+class SpectrumStreamProcessor:
+    """ Processes spectra while the run is still going. The logger hands every new spectrum to submit(),
+        which only puts it on a bounded queue, and a background thread smooths, baselines and writes it
+        to the processed folder, recording it in the same processed index as process_and_store_data().
+
+        If the consumer falls behind the queue fills up and further spectra are dropped (and counted)
+        instead of blocking acquisition; an incremental process_and_store_data() at the end of the run
+        picks up exactly those, and is a no-op when the stream kept up.
+    """
+
+    def __init__(self, output_dir, smooth=False, window_length=11, polyorder=2, baseline=False,
+                 max_queue=64, plot=False, save_every=10):
+        self.output_dir = output_dir
+        self.params = processing_params(smooth, window_length, polyorder, baseline)
+        self.plot = plot
+        self.save_every = save_every
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.processed = 0
+        self.dropped = 0
+        self.failed = []
+        self._index = {}
+        self._thread = None
+
+    def start(self):
+        """ start the background processing thread."""
+        os.makedirs(self.output_dir, exist_ok=True)
+        self._index = load_processed_index(self.output_dir)
+        self._thread = threading.Thread(target=self._run, name="spectrum-stream-processor", daemon=True)
+        self._thread.start()
+        return self
+
+    def submit(self, file_name, wavenumbers, spectrum):
+        """ Queue one spectrum for processing without ever blocking the caller.
+            file_name is the name the spectrum has in the run folder (raw_spectrum_<timestamp>.csv).
+            Returns False if the queue was full and the spectrum was left for end-of-run processing.
+        """
+        try:
+            self.queue.put_nowait((file_name, np.asarray(wavenumbers, dtype=np.float64), np.asarray(spectrum, dtype=np.float64)))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            metrics.count("stream_dropped")
+            return False
+
+    def stop(self, timeout=None):
+        """ Process what is already queued, save the index and stop the thread. Returns a summary dict."""
+        if self._thread is not None:
+            self.queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+        return {"processed": self.processed, "dropped": self.dropped, "failed": list(self.failed)}
+
+    def _run(self):
+        unsaved = 0
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            file_name, wavenumbers, spectrum = item
+            try:
+                with metrics.timed("stream_process"):
+                    _process_spectrum(file_name, (wavenumbers, spectrum), False, self.output_dir, self.params, self.plot)
+                self._index[file_name] = {"hash": spectrum_hash(spectrum), "params": self.params, "plotted": bool(self.plot)}
+                self.processed += 1
+                unsaved += 1
+            except Exception as e:
+                self.failed.append((file_name, f"{type(e).__name__}: {e}"))
+                log_error_to_file(context_message=f"Error in stream processing of '{file_name}'", exception=e)
+
+            if unsaved >= self.save_every:
+                unsaved = self._save_index()
+
+        if unsaved:
+            self._save_index()
+
+    def _save_index(self):
+        try:
+            save_processed_index(self.output_dir, self._index)
+        except Exception as e:
+            log_error_to_file(context_message="Error saving processed index from stream processor", exception=e)
+        return 0
@@ -0,0 +1,503 @@
+# multi-probe, multi-endpoint acquisition in one process.
+#
+# A session config lists the OPC UA endpoints to connect to and the probe node roots to log on each,
+# or "auto" to log every Local.iCIR.Probe<N> the server exposes:
+#
+#   {
+#       "endpoints": [
+#           {"url": "opc.tcp://localhost:62552/iCOpcUaServer", "probes": ["ns=2;s=Local.iCIR.Probe1"]},
+#           {"url": "opc.tcp://192.168.0.12:62552/iCOpcUaServer", "probes": "auto"}
+#       ],
+#       "db_path": "ReactIR.db"
+#   }
+#
+# AcquisitionSession opens one client per endpoint and one DBWriter for the whole session, and runs
+# every probe as its own ProbeRun (status watcher, spectrum logger and trend sampler tasks) on top of
+# them. Every probe gets its own Document and Trend and reports its own throughput.
+import os
+import re
+import json
+import time
+import asyncio
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from connect import ManagedClient, SERVER_URL
+from metadata_utils import get_probe_data
+from spectrum_logger import raw_spectrum_logger
+from processing_utils import process_and_store_data, plot_processed_spectra, SpectrumStreamProcessor
+from db_utils import setup_database, create_new_document, start_trend_sampling, create_new_trend, create_probe
+from db_writer import DBWriter
+from trend_utils import enable_trend_rollups
+from orchestrator import ProbeStatusWatcher, wait_for_children, drain
+from common_utils import debug_print, set_verbose
+from error_logger import set_error_log_path, get_error_log_path, log_error_to_file
+import metrics
+
+DEFAULT_PROBE_ROOT = "ns=2;s=Local.iCIR.Probe1"
+PROBE_ROOT_PATTERN = re.compile(r"^Local\.iCIR\.Probe\d+$")
+MAX_WORKER_THREADS = 64
+
+DEFAULT_SESSION = {
+    "endpoints": [{"url": SERVER_URL, "probes": [DEFAULT_PROBE_ROOT]}],
+    "db_path": "ReactIR.db",
+    "logs_dir": "logs",
+    "spectrum_format": "store",
+    "trend_interval_sec": 2,
+    "trends_ready_timeout": 90,     # how long a probe's Trends node may take to appear
+    "drain_timeout": 30,            # how long a logger may take to drain after its probe stopped
+    "report_interval_sec": 60,      # per-probe throughput report, 0 = only at the end
+    "connect_attempts": 3,          # initial connection attempts per endpoint (reconnects never give up)
+    "verbose": False,               # print a block per spectrum and the logger's debug lines
+    "metrics_port": None,           # e.g. 9464: serve Prometheus text metrics at http://127.0.0.1:<port>/metrics
+    "metrics_file": None,           # e.g. "logs/metrics.json": JSON metrics snapshot rewritten every metrics_interval_sec
+    "metrics_interval_sec": 10,
+}
+
+
+def probe_node_ids(probe_root):
+    """ node ids of the children of a probe root (e.g. ns=2;s=Local.iCIR.Probe2) the run uses."""
+    return {
+        "root": probe_root,
+        "trends": f"{probe_root}.Trends",
+        "raw_spectrum": f"{probe_root}.SpectraRaw",
+        "status": f"{probe_root}.ProbeStatus",
+        "sampling_interval": f"{probe_root}.CurrentSamplingInterval",
+    }
+
+
+def probe_label(probe_root):
+    """ 'ns=2;s=Local.iCIR.Probe2' -> 'Probe 2'."""
+    match = re.search(r"Probe(\d+)$", probe_root)
+    return f"Probe {match.group(1)}" if match else probe_root.rsplit(".", 1)[-1]
+
+
+def load_session_config(path=None):
+    """ DEFAULT_SESSION updated with the JSON file at path. Without a file (or path=None) this is the
+        original single Probe1 run on connect.SERVER_URL.
+    """
+    config = json.loads(json.dumps(DEFAULT_SESSION))
+    if path and os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            config.update(json.load(f))
+    for endpoint in config["endpoints"]:
+        endpoint.setdefault("probes", "auto")
+    return config
+
+
+def discover_probes(client, max_depth=3):
+    """ node ids of every probe root (Local.iCIR.Probe<N>) within max_depth levels of the Objects
+        folder. Standard (namespace 0) nodes such as Server are not browsed.
+    """
+    found = []
+    level = [client.get_objects_node()]
+    for _ in range(max_depth):
+        next_level = []
+        for node in level:
+            for child in node.get_children():
+                if child.nodeid.NamespaceIndex == 0:
+                    continue
+                identifier = child.nodeid.Identifier
+                if isinstance(identifier, str) and PROBE_ROOT_PATTERN.match(identifier):
+                    found.append(child.nodeid.to_string())
+                else:
+                    next_level.append(child)
+        level = next_level
+    return sorted(set(found), key=lambda node_id: (len(node_id), node_id))
+
+
+def _find_peak_nodes(children):
+    """ (TreatedValue node, label) of every trend child that has one."""
+    peak_nodes = []
+    for child in children:
+        try:
+            label = child.get_display_name().Text
+            grandchildren = child.get_children()
+            for grandchild in grandchildren:
+                node_id_str = str(grandchild.nodeid.Identifier)
+                if node_id_str.endswith(".TreatedValue"):
+                    peak_nodes.append((grandchild, label))
+                    break
+        except Exception as e:
+            log_error_to_file(context_message=f"Error with trend child node {child}", exception=e)
+    return peak_nodes
+
+
+def _print_metadata(label, probe_data):
+    print(f"\n📱 {label} Metadata")
+    print("-" * 50)
+    for name, value in probe_data:
+        if isinstance(value, (list, tuple)) and len(value) > 10:
+            display_value = f"{value[:5]} ... {value[-5:]} (len={len(value)})"
+        elif isinstance(value, str) and len(value) > 100:
+            display_value = f"{value[:100]}... (len={len(value)})"
+        else:
+            display_value = value
+        print(f"{name:<30}: {display_value}")
+    print("-" * 50)
+
+
+class ProbeRun:
+    """ One probe's part of a session: its Document and Trend, its folders, and the logger, sampler
+        and status tasks. client and db_writer are shared with the other probes.
+    """
+
+    def __init__(self, client, probe_root, db_writer, config, timestamp, namespaced=False, workers=1):
+        self.client = client
+        self.probe_root = probe_root
+        self.nodes = probe_node_ids(probe_root)
+        self.label = probe_label(probe_root)
+        self.db_writer = db_writer
+        self.config = config
+        self.timestamp = timestamp
+        self.namespaced = namespaced
+        self.workers = workers    # processes for the end-of-run processing and plotting
+        # with several probes in a session the run folders carry the probe name so they never clash.
+        self.run_name = f"spectrum_run_{timestamp}" + (f"_{self.label.replace(' ', '')}" if namespaced else "")
+        self.stop_event = threading.Event()
+        self.spectra = 0
+        self.sample_stats = {}
+        self.tick_stats = {}
+        self.started = None
+        self.ended = None
+        self.stream_summary = None
+        self.status = "waiting"
+
+    def throughput(self):
+        """ spectra and trend ticks logged so far and their rates per minute."""
+        elapsed = ((self.ended or time.monotonic()) - self.started) if self.started else 0.0
+        minutes = elapsed / 60 if elapsed else None
+        ticks = self.tick_stats.get("ticks", 0)
+        return {
+            "probe": self.label,
+            "status": self.status,
+            "spectra": self.spectra,
+            "spectra_per_min": self.spectra / minutes if minutes else 0.0,
+            "trend_ticks": ticks,
+            "ticks_per_min": ticks / minutes if minutes else 0.0,
+            "mean_tick_ms": self.tick_stats.get("mean_ms", 0.0),
+            "tick_errors": self.tick_stats.get("errors", 0),
+            "dropped": self.stream_summary["dropped"] if self.stream_summary else 0,
+            "duplicates": self.sample_stats.get("duplicates", 0),
+            "missed": self.sample_stats.get("missed", 0),
+        }
+
+    async def run(self):
+        """ wait for the probe, log it until it stops, then post-process its spectra."""
+        error_log_path = get_error_log_path()
+        config = self.config
+        db_path = config["db_path"]
+        status_watcher = None
+        tasks = []
+        try:
+            print(f"\n⏳ Waiting for {self.label} to fully initialise...")
+            treated_node = self.client.get_node(self.nodes["trends"])
+            children = await wait_for_children(treated_node, timeout=config["trends_ready_timeout"])
+            if not children:
+                print(f"❌ {self.label}: Trend node did not initialise in time.")
+                self.status = "failed"
+                return
+            print(f"✅ {self.label}: Trends node ready with {len(children)} children.")
+
+            probe_data = await asyncio.to_thread(get_probe_data, self.client, self.probe_root)
+            _print_metadata(self.label, probe_data)
+            experiment_name = next((value for name, value in probe_data if name == "Experiment Name"), "Unknown_Experiment")
+
+            log_folder = os.path.join(config["logs_dir"], experiment_name)
+            if not self.namespaced:
+                # a single probe run keeps its error log next to its data, a session shares the startup log.
+                error_log_path = os.path.join(log_folder, f"error_log_{self.timestamp}.txt")
+                set_error_log_path(error_log_path)
+                print(f"\n📝 Updated Error log path: {error_log_path}")
+            run_folder = os.path.join(log_folder, "spectra", self.run_name)
+            processed_folder = os.path.join(log_folder, "processed", self.run_name)
+            os.makedirs(run_folder, exist_ok=True)
+            os.makedirs(processed_folder, exist_ok=True)
+
+            document_id = await asyncio.to_thread(
+                create_new_document,
+                db_path,
+                name=experiment_name,
+                experiment_id=None,
+                error_log_path=error_log_path,
+                writer=self.db_writer)
+            # the probe's row is created once here and shared by every spectrum of the run.
+            probe_id = await asyncio.to_thread(create_probe, db_path, document_id, dict(probe_data), writer=self.db_writer)
+            document_ids = {"DocumentID": document_id, "ProbeID": probe_id}
+
+            print(f"\n📊 {self.label}: found {len(children)} children in Trends")
+            peak_nodes = await asyncio.to_thread(_find_peak_nodes, children)
+            if not peak_nodes:
+                print(f"❌ {self.label}: no valid peak nodes found.")
+                self.status = "failed"
+                return
+
+            print(f"\n📈 {self.label} Peaks Detected:")
+            for _, label in peak_nodes:
+                print(f"• {label}")
+
+            trend_id = await asyncio.to_thread(create_new_trend, db_path, document_id, user_note="Automated trend collection", writer=self.db_writer)
+            if trend_id == -1:
+                print(f"❌ {self.label}: failed to create new trend entry.")
+                self.status = "failed"
+                return
+
+            # smooth each spectrum as it arrives, so end-of-run processing only has to catch up on drops.
+            stream = SpectrumStreamProcessor(processed_folder, smooth=True, window_length=11, polyorder=2).start()
+            metrics.set_gauge("stream_queue_depth", stream.queue.qsize, probe=self.label)
+
+            def callback(data):
+                self.spectra += 1
+                timestamp = data.get("timestamp")
+                treated = data.get("treated_spectrum", [])
+
+                stream.submit(data["file_name"], data["wavenumbers"], data["raw_spectrum"])
+                if len(treated):
+                    stream.submit(f"treated_spectrum_{timestamp}.csv", data["wavenumbers"], treated)
+
+                debug_print(f"\n📝 {self.label}: logged spectrum #{self.spectra} at {timestamp}")
+                debug_print(f"• Saved raw     : {data.get('raw_csv_path', '<not saved>')}")
+                debug_print(f"• Saved treated : {data.get('treated_csv_path', '<not saved>')}")
+                debug_print(f"• DB Entry      : Inserted spectrum for DocumentID {data.get('document_id', '?')}")
+                debug_print(f"• Sample preview: {treated[:5]} ... (len={len(treated)})")
+                debug_print("-" * 50)
+
+            def run_raw_logger():
+                try:
+                    raw_spectrum_logger(
+                        client=self.client,
+                        probe_status_id=self.nodes["status"],
+                        raw_spectrum_id=self.nodes["raw_spectrum"],
+                        sampling_interval_id=self.nodes["sampling_interval"],
+                        output_dir=run_folder,
+                        db_path=db_path,
+                        document_ids=document_ids,
+                        probe1_node_id=self.probe_root,
+                        error_log_path=error_log_path,
+                        stop_event=self.stop_event,
+                        default_delay=5.0,
+                        use_subscription=True,
+                        spectrum_format=config["spectrum_format"],
+                        callback=callback,
+                        db_writer=self.db_writer,
+                        sample_stats=self.sample_stats
+                    )
+                except Exception as e:
+                    log_error_to_file(context_message=f"Error in raw_spectrum_logger task of {self.label}", exception=e)
+
+            def run_trend_sampler():
+                try:
+                    print(f"\n🚀 {self.label}: starting trend sampling...")
+                    start_trend_sampling(
+                        db_path=db_path,
+                        trend_id=trend_id,
+                        probe_node=self.client.get_node(self.probe_root),
+                        treated_node=treated_node,
+                        probe_description=self.label,
+                        peak_nodes=peak_nodes,
+                        interval_sec=config["trend_interval_sec"],
+                        batch_size=1,
+                        tick_stats=self.tick_stats,
+                        report_every=0,
+                        writer=self.db_writer,
+                        stop_event=self.stop_event
+                    )
+                except Exception as e:
+                    log_error_to_file(context_message=f"Error in trend sampling task of {self.label}", exception=e)
+
+            self.started = time.monotonic()
+            self.status = "sampling"
+            tasks.append(asyncio.create_task(asyncio.to_thread(run_trend_sampler), name=f"trend-sampler-{self.label}"))
+
+            print(f"\n🔍 Monitoring {self.label} status...")
+            status_watcher = await ProbeStatusWatcher(label=self.label).start(self.client, self.nodes["status"])
+            await status_watcher.running.wait()
+
+            self.status = "running"
+            raw_task = asyncio.create_task(asyncio.to_thread(run_raw_logger), name=f"raw-logger-{self.label}")
+            tasks.append(raw_task)
+
+            # the logger ends by itself once the probe has stopped and every notified spectrum is logged.
+            stopped = asyncio.create_task(status_watcher.stopped.wait())
+            await asyncio.wait([raw_task, stopped], return_when=asyncio.FIRST_COMPLETED)
+            stopped.cancel()
+            if status_watcher.stopped.is_set():
+                print(f"\n⏸️ {self.label} stopped. Logging the spectra still in flight...")
+                if not await drain(raw_task, config["drain_timeout"], self.stop_event):
+                    print(f"⚠️ {self.label}: spectrum logger did not finish within {config['drain_timeout']} s and was stopped.")
+
+            # the sampler flushes its last samples and ends the trend on the way out.
+            self.stop_event.set()
+            await asyncio.gather(*tasks)
+            self.ended = time.monotonic()
+            self.status = "processing"
+
+            self.stream_summary = await asyncio.to_thread(stream.stop)
+            metrics.remove_gauge("stream_queue_depth", probe=self.label)
+            print(f"\n🌊 {self.label}: stream processed {self.stream_summary['processed']} spectra "
+                  f"({self.stream_summary['dropped']} dropped, {len(self.stream_summary['failed'])} failed).")
+
+            # only spectra the stream dropped or failed on are left to process here.
+            print(f"\n🧪 {self.label}: processing raw spectrum files...")
+            processing_summary = await asyncio.to_thread(
+                process_and_store_data,
+                input_dir=run_folder,
+                output_dir=processed_folder,
+                smooth=True,
+                window_length=11,
+                polyorder=2,
+                workers=self.workers,
+                plot=False,
+                incremental=True
+            )
+            print(f"\n✅ {self.label}: processed {processing_summary['processed']} spectrum files "
+                  f"({processing_summary['skipped']} already done by the stream, "
+                  f"{len(processing_summary['failed'])} failed) in {processing_summary['wall_time']:.1f} s.")
+
+            print(f"\n🖼️ {self.label}: plotting processed spectra...")
+            await asyncio.to_thread(plot_processed_spectra, processed_folder, workers=self.workers)
+            self.status = "done"
+
+        except Exception as e:
+            self.status = "failed"
+            log_error_to_file(context_message=f"Unhandled exception in run of {self.label}", exception=e)
+        finally:
+            # also reached on Ctrl+C: let the worker threads finish their current item and flush.
+            self.stop_event.set()
+            if tasks:
+                await asyncio.wait(tasks)
+            if self.started and self.ended is None:
+                self.ended = time.monotonic()
+            if status_watcher is not None:
+                await status_watcher.close()
+
+
+class AcquisitionSession:
+    """ Connects to every endpoint of a session config once, shares one DBWriter between all probes
+        and runs a ProbeRun per probe concurrently until they have all stopped.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.clients = {}   # endpoint url -> connected client
+        self.runs = []
+        self.db_writer = None
+
+    async def connect(self):
+        """ connect every endpoint and resolve its probe list ("auto" = discover). Returns (client, probe root) pairs."""
+        probes = []
+        for endpoint in self.config["endpoints"]:
+            url = endpoint["url"]
+            # reconnects with backoff and restores its subscriptions if the connection drops mid-run.
+            client = ManagedClient(url)
+            if not await asyncio.to_thread(client.start, self.config["connect_attempts"]):
+                print(f"❌ Failed to connect to OPC UA server at {url}.")
+                continue
+            self.clients[url] = client
+            metrics.set_gauge("opc_connected", lambda client=client: int(client.connected), url=url)
+            metrics.set_gauge("opc_latency_ms", lambda client=client: client.stats["latency_ms"], url=url)
+
+            probe_roots = endpoint["probes"]
+            if probe_roots == "auto":
+                probe_roots = await asyncio.to_thread(discover_probes, client)
+                print(f"🔎 Discovered {len(probe_roots)} probe(s) on {url}: {', '.join(probe_roots) or '-'}")
+            probes.extend((client, probe_root) for probe_root in probe_roots)
+        return probes
+
+    def report(self):
+        """ print one throughput line per probe."""
+        print(f"\n{'probe':<12}{'status':<12}{'spectra':>9}{'/min':>8}{'dupes':>7}{'missed':>8}{'ticks':>8}{'/min':>8}{'tick ms':>9}{'dropped':>9}")
+        for run in self.runs:
+            stats = run.throughput()
+            print(f"{stats['probe']:<12}{stats['status']:<12}{stats['spectra']:>9}{stats['spectra_per_min']:>8.1f}"
+                  f"{stats['duplicates']:>7}{stats['missed']:>8}"
+                  f"{stats['trend_ticks']:>8}{stats['ticks_per_min']:>8.1f}{stats['mean_tick_ms']:>9.1f}{stats['dropped']:>9}")
+        for client in self.clients.values():
+            health = client.health()
+            print(f"🔗 {health['url']}: {'connected' if health['connected'] else 'reconnecting'}, "
+                  f"latency {health['latency_ms']:.1f} ms (mean {health['mean_latency_ms']:.1f}, max {health['max_latency_ms']:.1f}), "
+                  f"{health['reconnects']} reconnects, {health['downtime_s']:.1f} s down")
+
+    def start_metrics(self):
+        """ apply the console verbosity and start the configured metrics exports. Returns (http server, snapshot writer)."""
+        config = self.config
+        set_verbose(config.get("verbose", False))
+        metrics_server = snapshot_writer = None
+        if config.get("metrics_port"):
+            try:
+                metrics_server = metrics.start_http_endpoint(config["metrics_port"])
+                print(f"📈 Metrics at http://127.0.0.1:{config['metrics_port']}/metrics")
+            except OSError as e:
+                print(f"⚠️ Could not serve metrics on port {config['metrics_port']}: {e}")
+                log_error_to_file(context_message="Could not start metrics endpoint", exception=e)
+        if config.get("metrics_file"):
+            snapshot_writer = metrics.SnapshotWriter(config["metrics_file"], config.get("metrics_interval_sec", 10)).start()
+        return metrics_server, snapshot_writer
+
+    async def _report_periodically(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            self.report()
+
+    async def run(self):
+        """ run the whole session. Returns the per-probe throughput."""
+        timestamp = datetime.now().strftime("%d-%m-%Y_%H-%M-%S")
+        db_path = self.config["db_path"]
+        reporter = None
+        metrics_server, snapshot_writer = self.start_metrics()
+
+        # every probe keeps two worker threads busy for the whole run (logger and sampler) next to the
+        # short blocking OPC UA/database calls; threads are only created when needed.
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=MAX_WORKER_THREADS))
+
+        try:
+            probes = await self.connect()
+            if not probes:
+                print("❌ No probes to log.")
+                return []
+
+            # creates missing tables/columns so older databases accept the current inserts.
+            await asyncio.to_thread(setup_database, db_path)
+            # 1 minute trend rollups, kept up to date on insert, so long trends plot from a few rows.
+            await asyncio.to_thread(enable_trend_rollups, db_path)
+
+            # one connection for every write of the session, committed in groups on its own thread.
+            self.db_writer = await asyncio.to_thread(DBWriter(db_path, report_every=100).start)
+            metrics.set_gauge("db_writer_queue_depth", self.db_writer.queue_depth)
+
+            namespaced = len(probes) > 1
+            # the probes post-process at the same time, share the CPUs between them instead of each taking all.
+            workers = max(1, (os.cpu_count() or 1) // len(probes))
+            self.runs = [ProbeRun(client, probe_root, self.db_writer, self.config, timestamp, namespaced, workers)
+                         for client, probe_root in probes]
+
+            if self.config.get("report_interval_sec"):
+                reporter = asyncio.create_task(self._report_periodically(self.config["report_interval_sec"]))
+
+            await asyncio.gather(*(run.run() for run in self.runs))
+
+        except Exception as e:
+            log_error_to_file(context_message="Unhandled exception in acquisition session", exception=e)
+        finally:
+            if reporter is not None:
+                reporter.cancel()
+            if self.runs:
+                self.report()
+            if self.db_writer is not None:
+                writer_stats = await asyncio.to_thread(self.db_writer.stop)
+                print(f"\n💾 DB writer: {writer_stats['jobs']} writes in {writer_stats['commits']} commits "
+                      f"(mean {writer_stats['mean_commit_ms']:.1f} ms, max {writer_stats['max_commit_ms']:.1f} ms, "
+                      f"{writer_stats['failed']} failed).")
+            for url, client in self.clients.items():
+                try:
+                    await asyncio.to_thread(client.disconnect)
+                    print(f"\n🔌 Disconnected from OPC UA server at {url}.")
+                except Exception as e:
+                    log_error_to_file(context_message=f"Error during disconnection from {url}", exception=e)
+            if snapshot_writer is not None:
+                await asyncio.to_thread(snapshot_writer.stop)
+            if metrics_server is not None:
+                await asyncio.to_thread(metrics_server.shutdown)
+
+        return [run.throughput() for run in self.runs]
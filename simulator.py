@@ -0,0 +1,285 @@
+# local stand-in for the Mettler Toledo iC OPC UA server.
+#
+# Serves the ns=2;s=Local.iCIR.Probe<N> node tree the logger uses (ProbeStatus, SpectraRaw,
+# CurrentSamplingInterval, the per-spectrum metadata and Trends/<peak>/TreatedValue) and publishes a
+# new spectrum every interval seconds, either synthesised (Gaussian bands that follow simple
+# reactant -> product kinetics) or replayed from recorded runs under logs/.
+#
+#   python simulator.py                                   # one probe, synthetic, 5 s interval
+#   python simulator.py --interval 3 --spectra 200        # 10x the usual 30 s rate, stop after 200
+#   python simulator.py --replay logs/MON5.2_Clone_test_run_2_3_4 --probes 3
+#
+# The default endpoint is the one in connect.py, so main.py runs against it unchanged.
+import os
+import time
+import argparse
+import threading
+from datetime import datetime
+
+import numpy as np
+from opcua import Server, ua
+
+from spectrum_store import load_run, store_exists
+
+SIM_URL = "opc.tcp://0.0.0.0:62552/iCOpcUaServer"
+NAMESPACE_URI = "http://www.mt.com/iCIR/simulator"
+WAVENUMBER_START, WAVENUMBER_END = 4000, 650
+
+# (centre cm-1, width cm-1, absorbance at start, absorbance at end) of the synthetic bands; the
+# first band is consumed and the others formed, so trends visibly move during a run.
+SYNTHETIC_BANDS = [
+    (1720, 12, 0.80, 0.15),
+    (1650, 15, 0.05, 0.60),
+    (1250, 20, 0.10, 0.45),
+    (1050, 18, 0.30, 0.30),
+    (2950, 25, 0.25, 0.25),
+    (1450, 14, 0.05, 0.35),
+]
+
+
+def synthetic_spectra(points=839, peaks=3, half_life=60, noise=0.002, seed=0):
+    """ endless (wavenumbers, raw, treated, peak values) tuples: treated is an absorbance spectrum
+        of the first peaks synthetic bands whose heights relax from start to end values with the
+        given half life (in spectra), raw the matching transmittance.
+    """
+    rng = np.random.default_rng(seed)
+    wavenumbers = np.linspace(WAVENUMBER_START, WAVENUMBER_END, points)
+    bands = [SYNTHETIC_BANDS[i % len(SYNTHETIC_BANDS)] for i in range(peaks)]
+    centre_index = [int(np.abs(wavenumbers - centre).argmin()) for centre, _, _, _ in bands]
+    baseline = 0.02 + 0.01 * (wavenumbers - WAVENUMBER_END) / (WAVENUMBER_START - WAVENUMBER_END)
+
+    sample = 0
+    while True:
+        progress = 1 - 0.5 ** (sample / half_life)
+        treated = baseline + rng.normal(0, noise, points)
+        for centre, width, start, end in bands:
+            treated += (start + (end - start) * progress) * np.exp(-0.5 * ((wavenumbers - centre) / width) ** 2)
+        raw = 10 ** -treated
+        yield wavenumbers, raw, treated, treated[centre_index]
+        sample += 1
+
+
+def _run_folders(path):
+    """ every spectrum_run folder under path (or path itself) that holds raw spectra, oldest first."""
+    folders = []
+    for folder, _, files in os.walk(path):
+        if store_exists(folder) or any(name.startswith("raw_spectrum_") and name.endswith(".csv") for name in files):
+            folders.append(folder)
+    return sorted(folders, key=lambda folder: os.path.basename(folder))
+
+
+def replay_spectra(path, peaks=3, loop=True):
+    """ endless (wavenumbers, raw, treated, peak values) tuples replayed from recorded runs.
+        Peak values are the treated spectrum at evenly spaced points of the axis.
+    """
+    runs = []
+    for folder in _run_folders(path):
+        raw = load_run(folder, "raw")
+        if not len(raw.timestamps):
+            continue
+        treated = load_run(folder, "treated")
+        treated_rows = dict(zip(treated.timestamps.tolist(), range(len(treated.timestamps))))
+        runs.append((raw, treated, treated_rows))
+    if not runs:
+        raise ValueError(f"No recorded spectra found under '{path}'.")
+
+    while True:
+        for raw, treated, treated_rows in runs:
+            for row, timestamp_ms in enumerate(raw.timestamps.tolist()):
+                raw_values = np.asarray(raw.matrix[row], dtype=float)
+                treated_row = treated_rows.get(timestamp_ms)
+                treated_values = raw_values if treated_row is None else np.asarray(treated.matrix[treated_row], dtype=float)
+                peak_index = np.linspace(0, len(treated_values) - 1, peaks + 2)[1:-1].astype(int)
+                yield raw.wavenumbers, raw_values, treated_values, treated_values[peak_index]
+        if not loop:
+            return
+
+
+class SimulatedProbe:
+    """ the node tree of one probe (Local.iCIR.Probe<index>) and the values published per spectrum."""
+
+    def __init__(self, server, namespace, index, peaks, interval, experiment_name):
+        self.server = server
+        self.namespace = namespace
+        self.index = index
+        self.prefix = f"Local.iCIR.Probe{index}"
+        self.peaks = peaks
+        self.sample_count = 0
+
+        parent = server.get_objects_node()
+        self.root = parent.add_object(self._node_id(), f"Probe{index}")
+        self.status = self._variable("ProbeStatus", "Probe Status", "Idle")
+        self.spectrum = self._variable("SpectraRaw", "Spectra Raw", [0.0])
+        self.treated = self._variable("LastSampleTreatedSpectra", "Last Sample Treated Spectra", [0.0])
+        self.count = self._variable("SampleCount", "Sample Count", 0)
+        self.sample_time = self._variable("LastSampleTime", "Last Sample Time", datetime.now())
+        self.interval = self._variable("CurrentSamplingInterval", "Current Sampling Interval", float(interval))
+        self.temperature = self._variable("LatestTemperatureCelsius", "LatestTemperatureCelsius", 25.0)
+        self.temperature_time = self._variable("LatestTemperatureTime", "LatestTemperatureTime", datetime.now())
+        self._variable("ExperimentName", "Experiment Name", experiment_name)
+        self._variable("ProbeDescription", "Probe Description",
+                       f"Simulated ReactIR; Probe {index}; Sampling: {WAVENUMBER_START} to {WAVENUMBER_END} cm-1;")
+        self.root.add_object(self._node_id("Methods"), "Methods")
+        self.root.add_object(self._node_id("Triggers"), "Triggers")
+        self.trends = self.root.add_object(self._node_id("Trends"), "Trends")
+        self.peak_values = []
+
+    def _node_id(self, name=None):
+        return ua.NodeId(self.prefix if name is None else f"{self.prefix}.{name}", self.namespace)
+
+    def _variable(self, name, display_name, value, parent=None):
+        node = (parent or self.root).add_variable(self._node_id(name), display_name, value)
+        node.set_writable()
+        return node
+
+    def add_trends(self):
+        """ create the Trends/<peak> children, which the real server only does once a run is set up."""
+        for i in range(self.peaks):
+            label = f"Peak {i + 1}"
+            peak = self.trends.add_object(self._node_id(f"Trends.{label}"), label)
+            self._variable(f"Trends.{label}.RawValue", "RawValue", 0.0, parent=peak)
+            self.peak_values.append(self._variable(f"Trends.{label}.TreatedValue", "TreatedValue", 0.0, parent=peak))
+
+    def set_status(self, status):
+        self.status.set_value(status)
+
+    def publish(self, raw, treated, peak_values):
+        """ update everything that changes per spectrum; SpectraRaw goes last because its data change
+            is what makes the logger read the rest.
+        """
+        now = datetime.now()
+        self.sample_count += 1
+        self.treated.set_value(ua.Variant(treated.tolist(), ua.VariantType.Double))
+        self.count.set_value(self.sample_count)
+        self.sample_time.set_value(now)
+        self.temperature.set_value(25.0 + 0.5 * np.sin(self.sample_count / 20))
+        self.temperature_time.set_value(now)
+        for node, value in zip(self.peak_values, peak_values):
+            node.set_value(float(value))
+        self.spectrum.set_value(ua.Variant(raw.tolist(), ua.VariantType.Double))
+
+
+class IRSimulator:
+    """ OPC UA server with one or more simulated probes publishing spectra on a fixed schedule.
+
+        Lifecycle per run: status 'Idle', Trends children appear after trends_delay, status 'Running'
+        after start_delay, one spectrum every interval seconds, and 'Stopped' after spectra spectra
+        (or duration seconds; never if both are None). The server keeps serving until stop().
+    """
+
+    def __init__(self, endpoint=SIM_URL, probes=1, interval=5.0, spectra=None, duration=None, points=839, peaks=3,
+                 replay=None, start_delay=2.0, trends_delay=0.0, experiment_name="Simulated_Experiment", seed=0):
+        self.endpoint = endpoint
+        self.interval = interval
+        self.spectra = spectra
+        self.duration = duration
+        self.start_delay = start_delay
+        self.trends_delay = trends_delay
+        self.server = Server()
+        self.server.set_endpoint(endpoint)
+        self.server.set_server_name("iCIR OPC UA simulator")
+        namespace = self.server.register_namespace(NAMESPACE_URI)
+        if namespace != 2:
+            raise RuntimeError(f"Simulator namespace got index {namespace}, the iCIR node ids need ns=2.")
+
+        self.probes = [SimulatedProbe(self.server, namespace, i + 1, peaks, interval, experiment_name) for i in range(probes)]
+        if replay:
+            self.sources = [replay_spectra(replay, peaks) for _ in self.probes]
+        else:
+            self.sources = [synthetic_spectra(points, peaks, seed=seed + i) for i in range(probes)]
+
+        self.stopped = threading.Event()
+        self._closing = threading.Event()
+        self._thread = None
+        self.stats = {"published": 0, "late": 0, "mean_publish_ms": 0.0, "max_publish_ms": 0.0}
+
+    def start(self):
+        """ start serving and run the schedule on a background thread."""
+        self.server.start()
+        self._thread = threading.Thread(target=self._run, name="ir-simulator", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._closing.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.server.stop()
+        return dict(self.stats)
+
+    def _run(self):
+        if self.trends_delay:
+            self._closing.wait(self.trends_delay)
+        for probe in self.probes:
+            probe.add_trends()
+        if self._closing.wait(max(0.0, self.start_delay - self.trends_delay)):
+            return
+        for probe in self.probes:
+            probe.set_status("Running")
+
+        started = time.monotonic()
+        next_tick = started
+        stats = self.stats
+        while not self._closing.is_set():
+            if self.spectra is not None and stats["published"] >= self.spectra * len(self.probes):
+                break
+            if self.duration is not None and time.monotonic() - started >= self.duration:
+                break
+
+            tick_start = time.perf_counter()
+            for probe, source in zip(self.probes, self.sources):
+                _, raw, treated, peak_values = next(source)
+                probe.publish(raw, treated, peak_values)
+                stats["published"] += 1
+            publish_ms = (time.perf_counter() - tick_start) * 1000
+            ticks = stats["published"] // len(self.probes)
+            stats["mean_publish_ms"] += (publish_ms - stats["mean_publish_ms"]) / ticks
+            stats["max_publish_ms"] = max(stats["max_publish_ms"], publish_ms)
+
+            next_tick += self.interval
+            now = time.monotonic()
+            if next_tick < now:
+                stats["late"] += 1
+                next_tick = now
+            self._closing.wait(next_tick - now)
+
+        for probe in self.probes:
+            probe.set_status("Stopped")
+        self.stopped.set()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local OPC UA simulator of the iCIR probe node tree.")
+    parser.add_argument("--endpoint", default=SIM_URL)
+    parser.add_argument("--probes", type=int, default=1, help="number of probes (Local.iCIR.Probe1..N)")
+    parser.add_argument("--interval", type=float, default=5.0, help="seconds between spectra")
+    parser.add_argument("--spectra", type=int, default=None, help="stop the run after this many spectra per probe")
+    parser.add_argument("--duration", type=float, default=None, help="stop the run after this many seconds")
+    parser.add_argument("--points", type=int, default=839, help="points per synthetic spectrum")
+    parser.add_argument("--peaks", type=int, default=3, help="trend peaks per probe")
+    parser.add_argument("--replay", default=None, help="replay recorded runs under this folder instead of synthesising")
+    parser.add_argument("--start-delay", type=float, default=2.0, help="seconds before the probes report Running")
+    parser.add_argument("--trends-delay", type=float, default=0.0, help="seconds before the Trends children appear")
+    parser.add_argument("--experiment", default="Simulated_Experiment", help="Experiment Name reported by the probes")
+    args = parser.parse_args()
+
+    simulator = IRSimulator(args.endpoint, args.probes, args.interval, args.spectra, args.duration, args.points, args.peaks,
+                            args.replay, args.start_delay, args.trends_delay, args.experiment).start()
+    print(f"Simulating {args.probes} probe(s) on {args.endpoint}, one spectrum every {args.interval:g} s. Ctrl+C to stop.")
+    try:
+        while not simulator.stopped.wait(1):
+            pass
+        print(f"Run finished: {simulator.stats['published']} spectra published. Still serving, Ctrl+C to exit.")
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stats = simulator.stop()
+        print(f"Published {stats['published']} spectra ({stats['late']} late ticks, "
+              f"mean {stats['mean_publish_ms']:.1f} ms, max {stats['max_publish_ms']:.1f} ms per tick).")
+
+
+if __name__ == "__main__":
+    main()
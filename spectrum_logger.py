@@ -1,15 +1,370 @@
 import os
 import time
+import queue
+import threading
 import traceback
 import pandas as pd
-from datetime import datetime
+from collections import deque
+from datetime import datetime, timedelta, timezone
 from opcua.ua.uaerrors import UaStatusCodeError
 import numpy as np
 
-from db_utils import insert_probe_sample_and_spectrum
-from metadata_utils import get_probe1_data
-from common_utils import get_current_timestamp_str, write_spectrum_csv
+from db_utils import insert_probe_sample_and_spectrum, create_probe
+from metadata_utils import ProbeMetadataReader, PER_SPECTRUM_FIELDS
+from common_utils import get_current_timestamp_str, write_spectrum_csv, debug_print
+from spectrum_store import SpectrumStore
+from processing_utils import spectrum_hash
+from node_utils import read_values
 from error_logger import log_error_to_file
+import metrics
+
+# probe metadata that belongs to one scan and is therefore captured together with its spectrum;
+# the first three change with every scan.
+SCAN_FIELDS = [name for name in PER_SPECTRUM_FIELDS if name != "Probe Status"]
+EVERY_SCAN_FIELDS = ("Sample Count", "Last Sample Time", "Last Sample Treated Spectra")
+
+
+class SpectrumSubscriptionHandler:
+    """ OPC UA subscription handler for the raw spectrum (and optionally probe status) node.
+        Every new spectrum pushed by the server is queued exactly once for the logger loop.
+
+        The per-scan metadata nodes (scan_nodeids: node id -> display name, e.g. Sample Count and
+        Last Sample Treated Spectra) are monitored in the same subscription and kept with their
+        source timestamps, so scan_metadata() can give a queued spectrum the values of its own scan
+        however far the logger has fallen behind. Reading them from the notification callback is
+        not an option: python-opcua runs it on the thread that receives the read responses.
+    """
+
+    def __init__(self, raw_spectrum_nodeid, probe_status_nodeid=None, scan_nodeids=None):
+        self.raw_spectrum_nodeid = raw_spectrum_nodeid
+        self.probe_status_nodeid = probe_status_nodeid
+        self.scan_nodeids = dict(scan_nodeids or {})
+        self.spectra = queue.Queue()
+        self.probe_status = None
+        self.duplicate_count = 0
+        self._last_source_timestamp = None
+        self._scan_values = {name: deque() for name in self.scan_nodeids.values()}   # name -> (source timestamp, value)
+        self._scan_changed = threading.Condition()
+
+    def datachange_notification(self, node, val, data):
+        """ called by the subscription thread for every data change notification."""
+        if node.nodeid == self.probe_status_nodeid:
+            self.probe_status = val
+            return
+
+        source_timestamp = data.monitored_item.Value.SourceTimestamp
+        name = self.scan_nodeids.get(node.nodeid)
+        if name is not None:
+            with self._scan_changed:
+                self._scan_values[name].append((source_timestamp, val))
+                self._scan_changed.notify_all()
+            return
+
+        if node.nodeid != self.raw_spectrum_nodeid or not val:
+            return
+
+        # the server can re-send the same sample (e.g. after a republish), only queue it once.
+        if source_timestamp is not None and source_timestamp == self._last_source_timestamp:
+            self.duplicate_count += 1
+            metrics.count("duplicate_notifications")
+            return
+        self._last_source_timestamp = source_timestamp
+
+        metrics.count("spectrum_notifications")
+        self.spectra.put((source_timestamp, val, time.perf_counter()))
+
+    def scan_metadata(self, source_timestamp, previous_timestamp=None, wait_for=(), timeout=0.5):
+        """ The per-scan values of the spectrum with this source timestamp: for every field the newest
+            value written at or before it. The server writes them before the spectrum, but their
+            notifications can come after it in the same publish, so this waits up to timeout seconds
+            for the wait_for fields (those that change with every scan) to have a value newer than
+            previous_timestamp, the spectrum logged before. Older values are dropped afterwards.
+        """
+        with self._scan_changed:
+            if source_timestamp is None:
+                # no timestamps to pair on, the newest values are the best there is.
+                return {name: values[-1][1] for name, values in self._scan_values.items() if values}
+
+            def arrived(name):
+                return any(timestamp is not None and timestamp <= source_timestamp and
+                           (previous_timestamp is None or timestamp > previous_timestamp)
+                           for timestamp, _ in self._scan_values[name])
+
+            fields = [name for name in wait_for if name in self._scan_values]
+            if not self._scan_changed.wait_for(lambda: all(arrived(name) for name in fields), timeout):
+                metrics.count("scan_metadata_timeouts")
+
+            scan = {}
+            for name, values in self._scan_values.items():
+                written = [index for index, (timestamp, _) in enumerate(values) if timestamp is None or timestamp <= source_timestamp]
+                if written:
+                    scan[name] = values[written[-1]][1]
+                    # keep the scan's own value, it stays current until the field changes again.
+                    for _ in range(written[-1]):
+                        values.popleft()
+            return scan
+
+    def status_change_notification(self, status):
+        """ called when the server reports a change in the subscription status."""
+        log_error_to_file(context_message=f"OPC UA subscription status changed: {status}")
+
+
+class SampleTracker:
+    """ Decides whether a spectrum read from the server is a new scan, so the same scan is never
+        persisted twice (e.g. a poll faster than the instrument, or clocks drifting apart).
+        A spectrum is a duplicate when Sample Count and Last Sample Time have not moved since the
+        last new scan, or when its content hash equals that scan's. Scans the instrument counted
+        (Sample Count) but the logger never saw are counted as missed. The counts are kept in
+        stats (new, duplicates, missed).
+    """
+
+    def __init__(self, stats=None):
+        self.stats = stats if stats is not None else {}
+        self.stats.update({"new": 0, "duplicates": 0, "missed": 0})
+        self.last_hash = None
+        self.last_count = None
+        self.last_time = None
+        self.last_temperature_time = None
+        self._counting = False
+        self._new_before = 0
+        self._missed_before = 0
+
+    def is_duplicate(self, spectrum, sample_count=None, sample_time=None):
+        """ True if spectrum is the scan already seen last. Otherwise it is recorded as the newest scan."""
+        unchanged = sample_count is not None and sample_count == self.last_count and sample_time == self.last_time
+        digest = None if unchanged else spectrum_hash(spectrum)
+        if unchanged or digest == self.last_hash:
+            self.stats["duplicates"] += 1
+            metrics.count("duplicate_spectra")
+            return True
+
+        self.last_hash = digest
+        self.last_time = sample_time
+        self.stats["new"] += 1
+        self.observe_count(sample_count)
+        return False
+
+    def observe_count(self, sample_count):
+        """ Track the Sample Count of the newest scan (the count of that scan itself, not one read later).
+            The instrument counts scans from 1, so missed is the count minus the number of scans logged
+            since counting started, including the scans produced before the first one logged.
+        """
+        if not isinstance(sample_count, int):
+            return
+        if not self._counting or sample_count < self.last_count:
+            # first count, or the instrument restarted counting (new experiment): start again from it.
+            self._counting = True
+            self._new_before = self.stats["new"] - 1
+            self._missed_before = self.stats["missed"]
+        self.last_count = sample_count
+
+        missed = self._missed_before + max(0, sample_count - (self.stats["new"] - self._new_before))
+        if missed > self.stats["missed"]:
+            metrics.count("missed_samples", missed - self.stats["missed"])
+        self.stats["missed"] = missed
+
+
+    def is_new_temperature(self, reading_time):
+        """ True the first time a temperature reading (by its LatestTemperatureTime) is seen."""
+        if reading_time is None or reading_time == self.last_temperature_time:
+            return False
+        self.last_temperature_time = reading_time
+        return True
+
+
+def subscribe_raw_spectrum(client, raw_spectrum_id, probe_status_id=None, publishing_interval=500, queue_size=10, scan_nodes=None):
+    """ Create a subscription with monitored items on the raw spectrum and probe status nodes, and on
+        the per-scan metadata nodes in scan_nodes (display name -> node, see per_scan_nodes()).
+        Returns the subscription and the handler that holds the queue of new spectra.
+    """
+    raw_spectrum_node = client.get_node(raw_spectrum_id)
+    probe_status_node = client.get_node(probe_status_id) if probe_status_id else None
+    scan_nodes = scan_nodes or {}
+
+    handler = SpectrumSubscriptionHandler(
+        raw_spectrum_node.nodeid,
+        probe_status_node.nodeid if probe_status_node is not None else None,
+        {node.nodeid: name for name, node in scan_nodes.items()}
+    )
+    subscription = client.create_subscription(publishing_interval, handler)
+
+    # server side queues so values produced between two publish cycles are not overwritten.
+    # the metadata items go first, so their initial values are there when the first spectrum arrives.
+    for node in scan_nodes.values():
+        subscription.subscribe_data_change(node, queuesize=queue_size)
+    subscription.subscribe_data_change(raw_spectrum_node, queuesize=queue_size)
+    if probe_status_node is not None:
+        subscription.subscribe_data_change(probe_status_node)
+
+    return subscription, handler
+
+
+def per_scan_nodes(metadata_reader):
+    """ display name -> node of the probe's per-scan metadata (SCAN_FIELDS), browsing the probe node if needed."""
+    if metadata_reader is None:
+        return {}
+    try:
+        if not metadata_reader.fields:
+            metadata_reader.browse()
+    except Exception as e:
+        log_error_to_file(context_message="Could not browse probe node for per-scan metadata", exception=e)
+        return {}
+    return {name: metadata_reader.fields[name] for name in SCAN_FIELDS if name in metadata_reader.fields}
+
+
+def _write_spectrum(spectrum_type, wavenumbers, values, run_dir, stores, recorded_at):
+    """ Write one spectrum either as its own CSV or as a new row of the run's binary store.
+        Returns (file path, row offset) where row offset is None for CSV files.
+    """
+    with metrics.timed("spectrum_write"):
+        if stores:
+            store = stores[spectrum_type]
+            row_offset = store.append(values, recorded_at)
+            metrics.count("bytes_written", store.row_bytes)
+            return store.data_path, row_offset
+
+        timestamp_str = get_current_timestamp_str(recorded_at)
+        csv_path = os.path.join(run_dir, f"{spectrum_type}_spectrum_{timestamp_str}.csv")
+        write_spectrum_csv(wavenumbers, values, csv_path)
+        metrics.count("bytes_written", os.path.getsize(csv_path))
+        return csv_path, None
+
+
+def _log_spectrum(spectrum, wavenumbers, run_dir, db_path, document_ids, metadata_reader, error_log_path, stores=None, callback=None, db_writer=None,
+                  spectra_in_db=False, compress_spectra=False, sample_tracker=None, scan_metadata=None, recorded_at=None):
+    """ Write one raw spectrum (and the matching treated spectrum) to CSV or the spectrum store
+        and insert it in the db. With spectra_in_db the intensities go into the Spectra rows as
+        BLOBs and nothing is written to the run folder.
+        scan_metadata holds the per-scan values (SCAN_FIELDS) captured with the spectrum; they are
+        only read from the probe here when it is None.
+        recorded_at is the time of the scan (now if None), it names the files and store rows.
+        callback, if given, is called with a dict describing the spectrum.
+        sample_tracker, if given, decides whether the temperature reading is new (new scans and their
+        Sample Count are recorded by its is_duplicate() before a spectrum is logged).
+        The session's Probes row is created with the first spectrum and its id kept in document_ids["ProbeID"].
+        Returns a description of where the raw spectrum was written.
+    """
+    # file names and store timestamps both have millisecond resolution, keep them identical.
+    recorded_at = recorded_at or datetime.now()
+    recorded_at = recorded_at.replace(microsecond=recorded_at.microsecond // 1000 * 1000)
+
+    if spectra_in_db:
+        raw_path, raw_row = run_dir, None
+    else:
+        debug_print(f"Attempting to write spectrum to: {os.path.abspath(run_dir)}")
+        raw_path, raw_row = _write_spectrum("raw", wavenumbers, spectrum, run_dir, stores, recorded_at)
+        debug_print("Spectrum written successfully.")
+
+    metadata = {}
+    treated_path = None
+    treated_spectrum = None
+    if metadata_reader:
+        try:
+            # static fields are cached from the first full read, only refresh what changes per spectrum.
+            with metrics.timed("metadata_read"):
+                if scan_metadata is None:
+                    metadata = dict(metadata_reader.read(PER_SPECTRUM_FIELDS if metadata_reader.values else None))
+                else:
+                    metadata = dict(metadata_reader.read() if not metadata_reader.values else metadata_reader.cached())
+        except Exception as e:
+            metrics.count("metadata_errors")
+            print(f"❌ Error reading probe metadata: {e}")
+            log_error_to_file(context_message="Error reading probe metadata", exception=e)
+        if scan_metadata is not None:
+            # the values of this spectrum's own scan, not of whatever scan is current by now.
+            metadata.update(scan_metadata)
+        if "Last Sample Treated Spectra" in metadata:
+            debug_print("🔍 Treated Spectrum Type:", type(metadata["Last Sample Treated Spectra"]))
+            debug_print("🔍 Treated Spectrum Preview:", str(metadata["Last Sample Treated Spectra"])[:100])
+        else:
+            print("⚠️ 'Last Sample Treated Spectra' not found in metadata")
+        debug_print(f"Probe metadata keys: {list(metadata.keys())}")
+
+        # ✅ Treated spectrum save block (sanitized and validated)
+        treated_data = metadata.get("Last Sample Treated Spectra", None)
+
+        try:
+            if isinstance(treated_data, str):
+                print(f"⚠️ Treated spectrum is a string. Skipping: {treated_data}")
+                treated_data = None
+
+            elif isinstance(treated_data, (list, tuple)):
+                # Handle nested list [[x1, x2, ...]]
+                if len(treated_data) == 1 and isinstance(treated_data[0], (list, tuple)):
+                    treated_data = treated_data[0]
+
+                # Convert to floats
+                treated_data = [float(x) for x in treated_data]
+
+                if len(treated_data) == len(wavenumbers):
+                    treated_spectrum = treated_data
+                    if not spectra_in_db:
+                        treated_path, _ = _write_spectrum("treated", wavenumbers, treated_data, run_dir, stores, recorded_at)
+                        debug_print(f"✅ Treated spectrum saved to {treated_path}")
+                else:
+                    print(f"⚠️ Treated spectrum length mismatch: expected {len(wavenumbers)}, got {len(treated_data)}")
+
+        except Exception as e:
+            print(f"❌ Error processing treated spectrum: {e}")
+            if error_log_path:
+                log_error_to_file(context_message="Error saving treated spectrum", exception=e)
+
+    if db_path and document_ids and (metadata_reader or spectra_in_db):
+        debug_print("Inserting data into DB...")
+        if "ProbeID" not in document_ids and metadata:
+            # one probe row per session, every spectrum then only adds its Samples and Spectra rows.
+            document_ids["ProbeID"] = create_probe(db_path, document_ids["DocumentID"], metadata, writer=db_writer)
+        new_temperature = sample_tracker.is_new_temperature(metadata.get("LatestTemperatureTime")) if sample_tracker else True
+        # with a DBWriter this only times queueing the insert, the commit itself is timed as db_commit.
+        with metrics.timed("db_insert"):
+            insert_probe_sample_and_spectrum(
+                db_path=db_path,
+                document_id=document_ids["DocumentID"],
+                metadata_dict=metadata,
+                spectrum_csv_path=raw_path,
+                row_offset=raw_row,
+                recorded_at=recorded_at.isoformat(),
+                writer=db_writer,
+                wavenumbers=wavenumbers if spectra_in_db else None,
+                intensities=spectrum if spectra_in_db else None,
+                treated_intensities=treated_spectrum if spectra_in_db else None,
+                compress=compress_spectra,
+                probe_id=document_ids.get("ProbeID"),
+                new_temperature=new_temperature
+            )
+    elif any([db_path, document_ids, metadata_reader]):
+        debug_print("Skipping DB insert - incomplete DB parameters.")
+
+    if callback:
+        timestamp = get_current_timestamp_str(recorded_at)
+        try:
+            callback({
+                "timestamp": timestamp,
+                "recorded_at": recorded_at,
+                "wavenumbers": wavenumbers,
+                "raw_spectrum": spectrum,
+                "treated_spectrum": treated_spectrum if treated_spectrum is not None else [],
+                "raw_csv_path": raw_path,
+                "treated_csv_path": treated_path or "<not saved>",
+                "document_id": document_ids["DocumentID"] if document_ids else None,
+                "file_name": f"raw_spectrum_{timestamp}.csv",
+            })
+        except Exception as e:
+            # a failing consumer must never stop acquisition.
+            log_error_to_file(context_message="Error in spectrum logger callback", exception=e)
+
+    return raw_path if raw_row is None else f"{raw_path} (row {raw_row})"
+
+
+def _set_store_wavenumbers(stores, wavenumbers):
+    """ hand the run's wavenumber axis to every spectrum store once it is known."""
+    for store in (stores or {}).values():
+        store.set_wavenumbers(wavenumbers)
+
+
+def _is_running(probe_status):
+    """ the probe status node reports a string such as 'Running' or 'Stopped'."""
+    return isinstance(probe_status, str) and probe_status.lower() == "running"
 
 
 def raw_spectrum_logger(
@@ -25,14 +380,42 @@ def raw_spectrum_logger(
     probe1_node_id=None,
     error_log_path=None,
     stop_event=None,
-    default_delay=5.0
+    default_delay=5.0,
+    use_subscription=False,
+    publishing_interval=500,
+    spectrum_format="csv",
+    callback=None,
+    db_writer=None,
+    compress_spectra=False,
+    sample_stats=None
 ):
-    """ Continuously logs raw spectrum data while the probe is running at each sampling interval. """
+    """ Continuously logs raw spectrum data while the probe is running at each sampling interval.
+        With use_subscription=True the server notifies the logger of every new spectrum instead of
+        the logger polling the spectrum node every sampling interval.
+        spectrum_format="store" appends spectra to the run's binary spectrum store instead of one CSV each,
+        spectrum_format="db" stores them as float32 BLOBs in the Spectra table (zlib compressed with
+        compress_spectra=True) and needs db_path and document_ids.
+        callback is called after every logged spectrum (see _log_spectrum), e.g. to feed a
+        SpectrumStreamProcessor.
+        db_writer (a running DBWriter) queues the database inserts instead of connecting per spectrum.
+        Only new scans are persisted (see SampleTracker); pass a dict as sample_stats to follow the
+        new, duplicate and missed sample counts.
+    """
 
     os.makedirs(output_dir, exist_ok=True)
     print("Waiting for probe to start ...")
 
+    spectra_in_db = spectrum_format == "db"
+    if spectra_in_db and not (db_path and document_ids):
+        raise ValueError('spectrum_format="db" needs db_path and document_ids.')
+
     spectrum_counter = 0
+    sample_tracker = SampleTracker(sample_stats)
+    # the logger adds the session's ProbeID to its own copy.
+    document_ids = dict(document_ids) if document_ids else document_ids
+    stores = None
+    if spectrum_format == "store":
+        stores = {spectrum_type: SpectrumStore(output_dir, spectrum_type) for spectrum_type in ("raw", "treated")}
 
     try:
         while True:
@@ -45,12 +428,51 @@ def raw_spectrum_logger(
                     print("Probe is now running. Beginning data capture ...")
                     break
             except Exception as e:
+                metrics.count("opc_read_errors")
                 error_message = "Error reading probe status before start"
                 print(f"{error_message}: {e}")
                 if error_log_path:
-                    log_error_to_file(error_log_path, error_message, e)
+                    log_error_to_file(context_message=error_message, exception=e)
             time.sleep(1)
 
+        # browse the probe node once, every spectrum then costs a single batched read.
+        metadata_reader = ProbeMetadataReader(client, probe1_node_id) if probe1_node_id else None
+
+        if use_subscription:
+            try:
+                subscription, handler = subscribe_raw_spectrum(client, raw_spectrum_id, probe_status_id, publishing_interval,
+                                                               scan_nodes=per_scan_nodes(metadata_reader))
+            except Exception as e:
+                # fall back to polling if the server refuses the subscription.
+                error_message = "Could not create spectrum subscription. Falling back to polling."
+                print(f"{error_message}: {e}")
+                log_error_to_file(context_message=error_message, exception=e)
+                use_subscription = False
+
+        if use_subscription:
+            spectrum_counter = _subscription_logging_loop(
+                subscription=subscription,
+                handler=handler,
+                output_dir=output_dir,
+                wavenumber_start=wavenumber_start,
+                wavenumber_end=wavenumber_end,
+                db_path=db_path,
+                document_ids=document_ids,
+                metadata_reader=metadata_reader,
+                error_log_path=error_log_path,
+                stop_event=stop_event,
+                stores=stores,
+                callback=callback,
+                db_writer=db_writer,
+                spectra_in_db=spectra_in_db,
+                compress_spectra=compress_spectra,
+                sample_tracker=sample_tracker,
+                scan_timeout=max(0.5, 2 * publishing_interval / 1000)
+            )
+            print(f"\nLogging complete. {spectrum_counter} spectra saved in '{output_dir}'.")
+            _print_sample_stats(sample_tracker.stats)
+            return
+
         delay_seconds = default_delay
 
         if sampling_interval_id:
@@ -62,120 +484,214 @@ def raw_spectrum_logger(
                 error_message = "Could not read sampling interval. Using default delay."
                 print(error_message)
                 if error_log_path:
-                    log_error_to_file(error_log_path, error_message, e)
+                    log_error_to_file(context_message=error_message, exception=e)
 
         # Read initial spectrum
         initial_spectrum = client.get_node(raw_spectrum_id).get_value()
-        print(f"Initial spectrum (sample): {initial_spectrum[:5]}")  # DEBUG
+        debug_print(f"Initial spectrum (sample): {initial_spectrum[:5]}")
 
         if not initial_spectrum:
             raise ValueError("Initial spectrum is empty. Cannot generate wavenumber axis.")
 
         num_points = len(initial_spectrum)
-        print(f"Number of points in spectrum: {num_points}")  # DEBUG
+        debug_print(f"Number of points in spectrum: {num_points}")
 
         wavenumbers = np.linspace(wavenumber_start, wavenumber_end, num_points).round(2).tolist()
-        print(f"Wavenumber axis (sample): {wavenumbers[:5]}")  # DEBUG
+        debug_print(f"Wavenumber axis (sample): {wavenumbers[:5]}")
+        _set_store_wavenumbers(stores, wavenumbers)
 
         print("Logging started. Press Ctrl+C to stop. \n")
 
+        # read the per-scan metadata in the same round trip as the spectrum, so it belongs to that scan.
+        scan_fields = per_scan_nodes(metadata_reader)
+        read_nodes = [client.get_node(raw_spectrum_id)] + list(scan_fields.values())
+
         while True:
             if stop_event and stop_event.is_set():
                 print("Stop event triggered. Exiting logging loop.")
                 break
 
+            delay = delay_seconds
             try:
                 probe_status = client.get_node(probe_status_id).get_value()
                 if probe_status.lower() != "running":
                     print(f"Probe stopped. Final status: {probe_status}")
                     break
 
-                spectrum = client.get_node(raw_spectrum_id).get_value()
-                print(f"Read spectrum (sample): {spectrum[:5]}")  # DEBUG
-
-                timestamp_str = get_current_timestamp_str()
-
-                run_dir = output_dir
-                spectrum_filename = f"raw_spectrum_{timestamp_str}.csv"
-                raw_csv = os.path.join(run_dir, spectrum_filename)
-
-                print(f"Attempting to write spectrum to: {os.path.abspath(raw_csv)}")  # DEBUG
-                write_spectrum_csv(wavenumbers, spectrum, raw_csv)
-                print(f"Spectrum CSV written successfully.")  # DEBUG
-
-                metadata = {}
-                if probe1_node_id:
-                    metadata = dict(get_probe1_data(client, probe1_node_id))
-                    if "Last Sample Treated Spectra" in metadata:
-                        print("🔍 Treated Spectrum Type:", type(metadata["Last Sample Treated Spectra"]))
-                        print("🔍 Treated Spectrum Preview:", str(metadata["Last Sample Treated Spectra"])[:100])
-                    else:
-                        print("⚠️ 'Last Sample Treated Spectra' not found in metadata")
-
-                    print(f"Probe metadata keys: {list(metadata.keys())}")  # DEBUG
-
-                    # ✅ Treated spectrum save block (sanitized and validated)
-                    treated_data = metadata.get("Last Sample Treated Spectra", None)
-
-                    try:
-                        if isinstance(treated_data, str):
-                            print(f"⚠️ Treated spectrum is a string. Skipping: {treated_data}")
-                            treated_data = None
-
-                        elif isinstance(treated_data, (list, tuple)):
-                            # Handle nested list [[x1, x2, ...]]
-                            if len(treated_data) == 1 and isinstance(treated_data[0], (list, tuple)):
-                                treated_data = treated_data[0]
-
-                            # Convert to floats
-                            treated_data = [float(x) for x in treated_data]
-
-                            if len(treated_data) == len(wavenumbers):
-                                treated_filename = f"treated_spectrum_{timestamp_str}.csv"
-                                treated_csv = os.path.join(run_dir, treated_filename)
-                                write_spectrum_csv(wavenumbers, treated_data, treated_csv)
-                                print(f"✅ Treated spectrum saved to {treated_csv}")
-                            else:
-                                print(f"⚠️ Treated spectrum length mismatch: expected {len(wavenumbers)}, got {len(treated_data)}")
-
-                    except Exception as e:
-                        print(f"❌ Error processing treated spectrum: {e}")
-                        if error_log_path:
-                            log_error_to_file(error_log_path, "Error saving treated spectrum", e)
-
-                if db_path and document_ids and probe1_node_id:
-                    print("Inserting data into DB...")  # DEBUG
-                    insert_probe_sample_and_spectrum(
-                        db_path=db_path,
-                        document_id=document_ids["DocumentID"],
-                        metadata_dict=metadata,
-                        spectrum_csv_path=raw_csv
-                    )
-                elif any([db_path, document_ids, probe1_node_id]):
-                    print("Skipping DB insert - incomplete DB parameters.")  # DEBUG
-
-                spectrum_counter += 1
-                print(f"Spectrum logged to {raw_csv} at {datetime.now().strftime('%H-%M-%S')}")
+                with metrics.timed("opc_read"):
+                    spectrum, *values = read_values(read_nodes)
+                scan = {name: value for name, value in zip(scan_fields, values) if value is not None}
+                metrics.count("opc_reads")
+                debug_print(f"Read spectrum (sample): {spectrum[:5] if spectrum else spectrum}")
+
+                if not spectrum:
+                    debug_print("Empty spectrum read, skipped.")
+                elif sample_tracker.is_duplicate(spectrum, *_scan_counters(scan)):
+                    # the instrument has not finished the next scan yet, look again well before a full interval.
+                    debug_print("Spectrum unchanged since the last scan, not saved again.")
+                    delay = min(delay_seconds / 4, 1.0)
+                else:
+                    raw_csv = _log_spectrum(spectrum, wavenumbers, output_dir, db_path, document_ids, metadata_reader, error_log_path, stores, callback, db_writer,
+                                            spectra_in_db, compress_spectra, sample_tracker, scan_metadata=scan if scan_fields else None)
+
+                    spectrum_counter += 1
+                    metrics.count("spectra_logged")
+                    debug_print(f"Spectrum logged to {raw_csv} at {datetime.now().strftime('%H-%M-%S')}")
 
             except UaStatusCodeError as e:
+                metrics.count("opc_read_errors")
                 error_message = "OPC UA error while reading spectrum"
                 print(f"{error_message}: {e}")
                 if error_log_path:
-                    log_error_to_file(error_log_path, error_message, e)
+                    log_error_to_file(context_message=error_message, exception=e)
 
             except Exception as e:
+                metrics.count("spectrum_errors")
                 error_message = "Unexpected error during logging loop"
                 print(f"{error_message}: {e}")
                 if error_log_path:
-                    log_error_to_file(error_log_path, error_message, e)
+                    log_error_to_file(context_message=error_message, exception=e)
 
-            print(f"Sleeping for {delay_seconds} seconds...")
-            time.sleep(delay_seconds)
+            debug_print(f"Sleeping for {delay} seconds...")
+            time.sleep(delay)
 
     except Exception as e:
         error_message = "Critical error during raw spectrum logging"
         print(f"{error_message}: {e}")
         if error_log_path:
-            log_error_to_file(error_log_path, error_message, e)
+            log_error_to_file(context_message=error_message, exception=e)
+
+    finally:
+        for store in (stores or {}).values():
+            store.close()
 
     print(f"\nLogging complete. {spectrum_counter} spectra saved in '{output_dir}'.")
+    _print_sample_stats(sample_tracker.stats)
+
+
+def _scan_time(source_timestamp, last_recorded_at=None):
+    """ local time of a scan from its (UTC) source timestamp, truncated to milliseconds and at least
+        1 ms after the spectrum logged before, so file names and store timestamps never collide.
+    """
+    if source_timestamp is None:
+        recorded_at = datetime.now()
+    else:
+        recorded_at = source_timestamp.replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+    recorded_at = recorded_at.replace(microsecond=recorded_at.microsecond // 1000 * 1000)
+    if last_recorded_at is not None and recorded_at <= last_recorded_at:
+        recorded_at = last_recorded_at + timedelta(milliseconds=1)
+    return recorded_at
+
+
+def _scan_counters(scan):
+    """ (Sample Count, Last Sample Time) of a scan's metadata, None for what was not captured."""
+    if not scan:
+        return None, None
+    return scan.get("Sample Count"), scan.get("Last Sample Time")
+
+
+def _print_sample_stats(stats):
+    if stats["duplicates"] or stats["missed"]:
+        print(f"Skipped {stats['duplicates']} duplicate spectra, {stats['missed']} samples missed by the logger.")
+
+
+def _subscription_logging_loop(
+    subscription,
+    handler,
+    output_dir,
+    wavenumber_start,
+    wavenumber_end,
+    db_path,
+    document_ids,
+    metadata_reader,
+    error_log_path,
+    stop_event,
+    stores=None,
+    callback=None,
+    db_writer=None,
+    spectra_in_db=False,
+    compress_spectra=False,
+    sample_tracker=None,
+    wait_timeout=1.0,
+    scan_timeout=1.0
+):
+    """ Logs every spectrum delivered by the subscription until the probe stops or stop_event is set.
+        Each spectrum is logged with the per-scan metadata of its own scan (handler.scan_metadata,
+        waiting at most scan_timeout seconds for it). Returns the number of spectra logged.
+    """
+    print("Subscribed to raw spectrum node. Press Ctrl+C to stop. \n")
+
+    spectrum_counter = 0
+    wavenumbers = None
+    previous_timestamp = None
+    last_recorded_at = None
+    queue_node = handler.raw_spectrum_nodeid.to_string()
+    metrics.set_gauge("spectrum_queue_depth", handler.spectra.qsize, node=queue_node)
+
+    try:
+        while True:
+            if stop_event and stop_event.is_set():
+                print("Stop event triggered. Exiting logging loop.")
+                break
+
+            try:
+                source_timestamp, spectrum, received_at = handler.spectra.get(timeout=wait_timeout)
+            except queue.Empty:
+                # only stop once every spectrum already notified has been logged.
+                if handler.probe_status is not None and not _is_running(handler.probe_status):
+                    print(f"Probe stopped. Final status: {handler.probe_status}")
+                    break
+                continue
+
+            # time a notified spectrum waited for the logger, grows if logging falls behind the server.
+            metrics.observe("queue_wait", time.perf_counter() - received_at)
+            try:
+                if wavenumbers is None:
+                    # the first notification carries the current spectrum, use it for the axis.
+                    num_points = len(spectrum)
+                    debug_print(f"Number of points in spectrum: {num_points}")
+                    wavenumbers = np.linspace(wavenumber_start, wavenumber_end, num_points).round(2).tolist()
+                    _set_store_wavenumbers(stores, wavenumbers)
+
+                scan = None
+                if handler.scan_nodeids:
+                    scan = handler.scan_metadata(source_timestamp, previous_timestamp, EVERY_SCAN_FIELDS, scan_timeout)
+                previous_timestamp = source_timestamp
+
+                # the scan's own counters (and the content hash) catch a scan re-sent with a new source timestamp.
+                if sample_tracker is not None and sample_tracker.is_duplicate(spectrum, *_scan_counters(scan)):
+                    continue
+
+                # a backlog is logged faster than the scans came in, so name each spectrum after its own scan.
+                recorded_at = _scan_time(source_timestamp, last_recorded_at)
+                last_recorded_at = recorded_at
+                raw_csv = _log_spectrum(spectrum, wavenumbers, output_dir, db_path, document_ids, metadata_reader, error_log_path, stores, callback, db_writer,
+                                        spectra_in_db, compress_spectra, sample_tracker, scan_metadata=scan, recorded_at=recorded_at)
+
+                spectrum_counter += 1
+                metrics.count("spectra_logged")
+                debug_print(f"Spectrum logged to {raw_csv} at {datetime.now().strftime('%H-%M-%S')}")
+
+            except UaStatusCodeError as e:
+                metrics.count("opc_read_errors")
+                error_message = "OPC UA error while logging subscribed spectrum"
+                print(f"{error_message}: {e}")
+                log_error_to_file(context_message=error_message, exception=e)
+
+            except Exception as e:
+                metrics.count("spectrum_errors")
+                error_message = "Unexpected error during subscription logging loop"
+                print(f"{error_message}: {e}")
+                log_error_to_file(context_message=error_message, exception=e)
+
+    finally:
+        metrics.remove_gauge("spectrum_queue_depth", node=queue_node)
+        try:
+            subscription.delete()
+        except Exception as e:
+            log_error_to_file(context_message="Error deleting spectrum subscription", exception=e)
+
+    if handler.duplicate_count:
+        print(f"Ignored {handler.duplicate_count} duplicate spectrum notifications.")
+
+    return spectrum_counter
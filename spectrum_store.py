@@ -0,0 +1,290 @@
+# run level, append-only binary storage of spectra.
+#
+# Each run folder holds one shared wavenumber axis and, per spectrum type ('raw', 'treated'), a
+# float32 matrix with one row per spectrum plus an int64 index of epoch-ms timestamps per row:
+#
+#   wavenumbers.npy        shared axis (np.save)
+#   raw_spectra.f32        n_rows x n_points float32, row major, appended to as spectra arrive
+#   raw_spectra.ts         n_rows int64 epoch-ms timestamps, same row order
+#
+# Row r of a spectrum file starts at byte r * n_points * 4, so the Spectra table only has to
+# store the file path and the row offset.
+import os
+from collections import namedtuple
+from datetime import datetime
+
+import numpy as np
+
+from common_utils import get_current_timestamp_str, parse_timestamp_str
+
+WAVENUMBER_FILE = "wavenumbers.npy"
+SPECTRUM_DTYPE = np.dtype("<f4")
+TIMESTAMP_DTYPE = np.dtype("<i8")
+
+
+def datetime_to_ms(value):
+    """ datetime -> integer epoch milliseconds."""
+    return int(round(value.timestamp() * 1000))
+
+
+def ms_to_timestamp_str(timestamp_ms):
+    """ epoch milliseconds -> the same string format used for spectrum file names."""
+    return get_current_timestamp_str(datetime.fromtimestamp(timestamp_ms / 1000))
+
+
+def store_exists(run_dir, spectrum_type="raw"):
+    """ True if the run folder holds a binary store for this spectrum type."""
+    return os.path.exists(os.path.join(run_dir, f"{spectrum_type}_spectra.f32"))
+
+
+class SpectrumStore:
+    """ Append-only float32 spectrum matrix for one spectrum type of one run."""
+
+    def __init__(self, run_dir, spectrum_type="raw"):
+        self.run_dir = run_dir
+        self.spectrum_type = spectrum_type
+        self.data_path = os.path.join(run_dir, f"{spectrum_type}_spectra.f32")
+        self.index_path = os.path.join(run_dir, f"{spectrum_type}_spectra.ts")
+        self.axis_path = os.path.join(run_dir, WAVENUMBER_FILE)
+
+        self.wavenumbers = np.load(self.axis_path) if os.path.exists(self.axis_path) else None
+        self._data_file = None
+        self._index_file = None
+        self._rows = None
+
+    @property
+    def num_points(self):
+        return 0 if self.wavenumbers is None else len(self.wavenumbers)
+
+    @property
+    def row_bytes(self):
+        return self.num_points * SPECTRUM_DTYPE.itemsize
+
+    def set_wavenumbers(self, wavenumbers):
+        """ Write the shared axis the first time, afterwards check spectra still match it."""
+        wavenumbers = np.asarray(wavenumbers, dtype=np.float64)
+        if self.wavenumbers is None:
+            os.makedirs(self.run_dir, exist_ok=True)
+            if os.path.exists(self.axis_path):
+                self.wavenumbers = np.load(self.axis_path)
+            else:
+                np.save(self.axis_path, wavenumbers)
+                self.wavenumbers = wavenumbers
+        if len(wavenumbers) != self.num_points:
+            raise ValueError(f"Wavenumber axis has {len(wavenumbers)} points, store expects {self.num_points}.")
+        self._rows = None
+
+    def __len__(self):
+        if self._rows is None:
+            self._rows = self._count_rows()
+        return self._rows
+
+    def _count_rows(self):
+        """ number of complete rows present in both the data and index files."""
+        if not self.num_points or not os.path.exists(self.data_path):
+            return 0
+        data_rows = os.path.getsize(self.data_path) // self.row_bytes
+        index_rows = os.path.getsize(self.index_path) // TIMESTAMP_DTYPE.itemsize if os.path.exists(self.index_path) else 0
+        return min(data_rows, index_rows)
+
+    def _open_for_append(self):
+        """ open both files for appending, dropping any half written row left by a crash."""
+        rows = len(self)
+        for path, size in ((self.data_path, rows * self.row_bytes), (self.index_path, rows * TIMESTAMP_DTYPE.itemsize)):
+            if os.path.exists(path) and os.path.getsize(path) != size:
+                with open(path, "r+b") as f:
+                    f.truncate(size)
+        self._data_file = open(self.data_path, "ab")
+        self._index_file = open(self.index_path, "ab")
+
+    def append(self, spectrum, recorded_at=None):
+        """ Append one spectrum, returns its row offset in the store."""
+        if self.wavenumbers is None:
+            raise ValueError("set_wavenumbers() must be called before appending spectra.")
+
+        row = np.asarray(spectrum, dtype=SPECTRUM_DTYPE)
+        if row.shape != (self.num_points,):
+            raise ValueError(f"Spectrum has {row.size} points, store expects {self.num_points}.")
+
+        if self._data_file is None:
+            self._open_for_append()
+
+        recorded_at = recorded_at or datetime.now()
+        row_offset = len(self)
+
+        self._data_file.write(row.tobytes())
+        self._index_file.write(np.array([datetime_to_ms(recorded_at)], dtype=TIMESTAMP_DTYPE).tobytes())
+        self._data_file.flush()
+        self._index_file.flush()
+
+        self._rows += 1
+        return row_offset
+
+    def append_many(self, matrix, timestamps_ms):
+        """ Append a block of spectra in one write, returns the row offset of the first one."""
+        if self.wavenumbers is None:
+            raise ValueError("set_wavenumbers() must be called before appending spectra.")
+
+        matrix = np.asarray(matrix, dtype=SPECTRUM_DTYPE)
+        timestamps_ms = np.asarray(timestamps_ms, dtype=TIMESTAMP_DTYPE)
+        if matrix.ndim != 2 or matrix.shape[1] != self.num_points or len(matrix) != len(timestamps_ms):
+            raise ValueError(f"Expected an (n, {self.num_points}) matrix with n timestamps, got {matrix.shape}.")
+
+        if self._data_file is None:
+            self._open_for_append()
+
+        first_row = len(self)
+        self._data_file.write(np.ascontiguousarray(matrix).tobytes())
+        self._index_file.write(timestamps_ms.tobytes())
+        self._data_file.flush()
+        self._index_file.flush()
+
+        self._rows += len(matrix)
+        return first_row
+
+    def timestamps(self):
+        """ epoch-ms timestamp of every row."""
+        if not len(self):
+            return np.empty(0, dtype=TIMESTAMP_DTYPE)
+        return np.fromfile(self.index_path, dtype=TIMESTAMP_DTYPE, count=len(self))
+
+    def read_all(self):
+        """ Returns (wavenumbers, timestamps_ms, matrix) for the whole store in a single read."""
+        rows = len(self)
+        if not rows:
+            return self.wavenumbers, self.timestamps(), np.empty((0, self.num_points), dtype=SPECTRUM_DTYPE)
+        matrix = np.fromfile(self.data_path, dtype=SPECTRUM_DTYPE, count=rows * self.num_points)
+        return self.wavenumbers, self.timestamps(), matrix.reshape(rows, self.num_points)
+
+    def read_row(self, row_offset):
+        """ read a single spectrum by row offset."""
+        with open(self.data_path, "rb") as f:
+            f.seek(row_offset * self.row_bytes)
+            return np.frombuffer(f.read(self.row_bytes), dtype=SPECTRUM_DTYPE)
+
+    def close(self):
+        """ flush everything to disk and close the files."""
+        for f in (self._data_file, self._index_file):
+            if f is not None:
+                f.flush()
+                os.fsync(f.fileno())
+                f.close()
+        self._data_file = None
+        self._index_file = None
+
+
+RunSpectra = namedtuple("RunSpectra", ["matrix", "wavenumbers", "timestamps"])
+RunSpectra.__doc__ = """ A whole run as one (n_spectra x n_points) matrix with its wavenumber axis and
+    epoch-ms timestamp per row."""
+
+
+def _to_ms(value):
+    """ accept datetimes or epoch-ms for time windows."""
+    return datetime_to_ms(value) if isinstance(value, datetime) else int(value)
+
+
+def _window_slices(wavenumbers, timestamps, time_window, wavenumber_range):
+    """ row and column slices for a time window and wavenumber range. Slices (not masks) keep
+        the result a view of the memory map, so nothing is read until the data is used.
+    """
+    rows = slice(None)
+    if time_window is not None:
+        start, end = time_window
+        first = 0 if start is None else int(np.searchsorted(timestamps, _to_ms(start), side="left"))
+        last = len(timestamps) if end is None else int(np.searchsorted(timestamps, _to_ms(end), side="right"))
+        rows = slice(first, last)
+
+    columns = slice(None)
+    if wavenumber_range is not None:
+        low, high = sorted(wavenumber_range)
+        inside = np.nonzero((wavenumbers >= low) & (wavenumbers <= high))[0]
+        columns = slice(int(inside[0]), int(inside[-1]) + 1) if inside.size else slice(0, 0)
+
+    return rows, columns
+
+
+def _is_header(line):
+    """ True unless the first field of the line is a number (e.g. '-0.5', '.25', '+1e3')."""
+    try:
+        float(line.split(",", 1)[0])
+        return False
+    except ValueError:
+        return True
+
+
+def _read_csv_columns(path):
+    """ vectorised read of a two column spectrum CSV, skipping the header if there is one."""
+    with open(path, "r") as f:
+        skiprows = 1 if _is_header(f.readline()) else 0
+        f.seek(0)
+        data = np.loadtxt(f, delimiter=",", skiprows=skiprows, ndmin=2)
+    return data[:, 0], data[:, 1]
+
+
+def _load_csv_run(run_dir, spectrum_type):
+    """ build the run matrix from the per spectrum CSV files of an older run (no binary store)."""
+    prefix = f"{spectrum_type}_spectrum_"
+    entries = []
+    for file_name in os.listdir(run_dir):
+        if file_name.startswith(prefix) and file_name.endswith(".csv"):
+            recorded_at = parse_timestamp_str(file_name[len(prefix):-len(".csv")])
+            entries.append((datetime_to_ms(recorded_at), file_name))
+    entries.sort()
+
+    wavenumbers = None
+    rows = []
+    for _, file_name in entries:
+        file_wavenumbers, values = _read_csv_columns(os.path.join(run_dir, file_name))
+        if wavenumbers is None:
+            wavenumbers = file_wavenumbers
+        elif len(file_wavenumbers) != len(wavenumbers):
+            raise ValueError(f"'{file_name}' has {len(file_wavenumbers)} points, run expects {len(wavenumbers)}.")
+        rows.append(values)
+
+    timestamps = np.array([timestamp_ms for timestamp_ms, _ in entries], dtype=TIMESTAMP_DTYPE)
+    matrix = np.vstack(rows).astype(SPECTRUM_DTYPE) if rows else np.empty((0, 0), dtype=SPECTRUM_DTYPE)
+    return wavenumbers if wavenumbers is not None else np.empty(0), timestamps, matrix
+
+
+def load_run(run_dir, spectrum_type="raw", time_window=None, wavenumber_range=None):
+    """ Load a whole run (a spectrum_run_<timestamp> folder) as one 2-D array.
+
+        With a binary store the matrix is a read-only memory map, so loading costs no parsing and
+        slicing by time_window (start, end as datetimes or epoch-ms, either may be None) or
+        wavenumber_range (low, high in cm-1) only touches the rows/columns used. Runs that only
+        have CSV files are parsed into memory, convert_csv_run() turns them into a store once.
+    """
+    if store_exists(run_dir, spectrum_type):
+        store = SpectrumStore(run_dir, spectrum_type)
+        rows = len(store)
+        wavenumbers = store.wavenumbers
+        timestamps = store.timestamps()
+        if rows:
+            matrix = np.memmap(store.data_path, dtype=SPECTRUM_DTYPE, mode="r", shape=(rows, store.num_points))
+        else:
+            matrix = np.empty((0, store.num_points), dtype=SPECTRUM_DTYPE)
+    else:
+        wavenumbers, timestamps, matrix = _load_csv_run(run_dir, spectrum_type)
+
+    row_slice, column_slice = _window_slices(wavenumbers, timestamps, time_window, wavenumber_range)
+    return RunSpectra(matrix[row_slice, column_slice], wavenumbers[column_slice], timestamps[row_slice])
+
+
+def convert_csv_run(run_dir, spectrum_type="raw"):
+    """ Write the CSV spectra of an older run into a binary store next to them so later loads
+        are memory mapped. The CSV files are left in place. Returns the number of rows written.
+    """
+    if store_exists(run_dir, spectrum_type):
+        return 0
+
+    wavenumbers, timestamps, matrix = _load_csv_run(run_dir, spectrum_type)
+    if not len(timestamps):
+        return 0
+
+    store = SpectrumStore(run_dir, spectrum_type)
+    store.set_wavenumbers(wavenumbers)
+    try:
+        store.append_many(matrix, timestamps)
+    finally:
+        store.close()
+    return len(timestamps)
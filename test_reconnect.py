@@ -0,0 +1,90 @@
+# ManagedClient against the local OPC UA simulator killed and restarted on the same port.
+#
+#   python -m pytest test_reconnect.py     (or: python test_reconnect.py)
+import time
+import logging
+import threading
+
+from connect import ManagedClient
+from simulator import IRSimulator
+from test_subscription_logger import _free_port, PROBE
+
+
+class _CountHandler:
+    """ collects the Sample Count data changes of the subscription."""
+
+    def __init__(self):
+        self.values = []
+        self.changed = threading.Condition()
+
+    def datachange_notification(self, node, val, data):
+        with self.changed:
+            self.values.append(val)
+            self.changed.notify_all()
+
+    def wait_for(self, predicate, timeout):
+        with self.changed:
+            return self.changed.wait_for(lambda: predicate(self.values), timeout)
+
+
+def _wait(predicate, timeout):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.1)
+    return True
+
+
+def _new_counts(values):
+    return sorted({value for value in values if value > 0})
+
+
+def run_reconnect(interval=0.2, downtime=2.0):
+    """ subscribe to Sample Count, kill the simulator, start a new one on the same endpoint after
+        downtime seconds and wait for the client to come back. Returns (health, counts after restart).
+    """
+    logging.getLogger("opcua").setLevel(logging.CRITICAL)
+    endpoint = f"opc.tcp://127.0.0.1:{_free_port()}/sim"
+    simulator = IRSimulator(endpoint=endpoint, interval=interval, start_delay=0.5).start()
+    managed = ManagedClient(endpoint, base_delay=0.5, max_delay=2.0, watchdog_interval=0.5)
+    handler = _CountHandler()
+    try:
+        assert managed.start()
+        subscription = managed.create_subscription(100, handler)
+        subscription.subscribe_data_change(managed.get_node(f"{PROBE}.SampleCount"))
+        assert handler.wait_for(lambda values: any(value >= 2 for value in values), timeout=10)
+
+        simulator.stop()
+        assert _wait(lambda: not managed.connected, timeout=10), "the watchdog did not notice the server going away"
+        time.sleep(downtime)
+        with handler.changed:
+            handler.values.clear()
+
+        # the restarted server counts from 0 again; the re-created subscription first reports the current
+        # count, so a second count of the new run is a data change received after the restart.
+        simulator = IRSimulator(endpoint=endpoint, interval=interval, start_delay=0.5).start()
+        assert _wait(lambda: managed.health()["reconnects"] > 0, timeout=30), "the client did not reconnect"
+        assert handler.wait_for(lambda values: len(_new_counts(values)) >= 2, timeout=10), "data changes did not resume"
+        with handler.changed:
+            return managed.health(), list(handler.values)
+    finally:
+        managed.disconnect()
+        simulator.stop()
+
+
+def check_reconnected(health, counts):
+    assert health["reconnects"] == 1
+    assert health["connected"] is True
+    assert health["downtime_s"] > 0
+    new_counts = _new_counts(counts)
+    assert len(new_counts) >= 2 and new_counts[-1] > new_counts[0]
+
+
+def test_reconnect_after_server_restart():
+    check_reconnected(*run_reconnect())
+
+
+if __name__ == "__main__":
+    check_reconnected(*run_reconnect())
+    print("✅ the client reconnected and the subscription resumed after a server restart.")
@@ -0,0 +1,101 @@
+# AcquisitionSession against the local OPC UA simulator serving several probes.
+#
+#   python -m pytest test_session.py     (or: python test_session.py)
+import os
+import asyncio
+import sqlite3
+import logging
+import tempfile
+import contextlib
+from io import StringIO
+
+from opcua import Client
+
+from simulator import IRSimulator
+from session_manager import AcquisitionSession, load_session_config, discover_probes
+from test_subscription_logger import _free_port
+
+PROBES = 2
+SPECTRA = 5
+PROBE_ROOTS = [f"ns=2;s=Local.iCIR.Probe{i + 1}" for i in range(PROBES)]
+
+
+def run_session(folder, probes=PROBES, spectra=SPECTRA, interval=0.2):
+    """ run a session with "auto" probe discovery against a simulator with probes probes publishing
+        spectra spectra each. Returns (db path, discovered probe roots, throughput, report output).
+    """
+    logging.getLogger("opcua").setLevel(logging.ERROR)
+    endpoint = f"opc.tcp://127.0.0.1:{_free_port()}/sim"
+    simulator = IRSimulator(endpoint=endpoint, probes=probes, interval=interval, spectra=spectra, points=64,
+                            start_delay=1.0).start()
+
+    config = load_session_config()
+    config.update(
+        endpoints=[{"url": endpoint, "probes": "auto"}],
+        db_path=os.path.join(folder, "test.db"),
+        logs_dir=os.path.join(folder, "logs"),
+        trend_interval_sec=0.5,
+        trends_ready_timeout=10,
+        report_interval_sec=0
+    )
+    session = AcquisitionSession(config)
+    try:
+        client = Client(endpoint)
+        client.connect()
+        try:
+            discovered = discover_probes(client)
+        finally:
+            client.disconnect()
+        throughput = asyncio.run(session.run())
+    finally:
+        simulator.stop()
+
+    report = StringIO()
+    with contextlib.redirect_stdout(report):
+        session.report()
+    return config["db_path"], discovered, throughput, report.getvalue()
+
+
+def check_session(db_path, discovered, throughput, report, probes=PROBES, spectra=SPECTRA):
+    assert discovered == PROBE_ROOTS[:probes]
+
+    with sqlite3.connect(db_path) as conn:
+        documents = conn.execute("SELECT DocumentID FROM Documents ORDER BY DocumentID").fetchall()
+        probe_rows = conn.execute("SELECT ProbeID, DocumentID, Description FROM Probes ORDER BY ProbeID").fetchall()
+        counts = dict(conn.execute("""
+            SELECT Samples.ProbeID, COUNT(*) FROM Spectra
+            JOIN Samples ON Samples.SampleID = Spectra.SampleID
+            JOIN Probes ON Probes.ProbeID = Samples.ProbeID AND Probes.DocumentID = Spectra.DocumentID
+            WHERE Spectra.Type = 'raw' GROUP BY Samples.ProbeID
+        """).fetchall())
+
+    # a Document and a Probes row of its own for every probe, each holding that probe's spectra.
+    assert len(documents) == probes
+    assert len(probe_rows) == probes
+    assert len({document_id for _, document_id, _ in probe_rows}) == probes
+    for i, (probe_id, _, description) in enumerate(probe_rows):
+        assert f"Probe {i + 1};" in description
+        assert counts.get(probe_id) == spectra
+
+    assert [stats["probe"] for stats in throughput] == [f"Probe {i + 1}" for i in range(probes)]
+    for stats in throughput:
+        assert stats["status"] == "done"
+        assert stats["spectra"] == spectra
+        assert stats["spectra_per_min"] > 0
+        assert stats["trend_ticks"] > 0
+        assert (stats["duplicates"], stats["missed"], stats["dropped"]) == (0, 0, 0)
+
+    lines = report.splitlines()
+    for stats in throughput:
+        line = next(line for line in lines if line.startswith(stats["probe"]))
+        assert line.split()[2:7] == ["done", str(spectra), f"{stats['spectra_per_min']:.1f}", "0", "0"]
+
+
+def test_session_logs_every_probe(tmp_path):
+    check_session(*run_session(str(tmp_path)))
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as folder:
+        check_session(*run_session(folder))
+    print("✅ every simulated probe was discovered and logged to its own document.")
@@ -0,0 +1,93 @@
+# subscription mode of raw_spectrum_logger against the local OPC UA simulator.
+#
+#   python -m pytest test_subscription_logger.py     (or: python test_subscription_logger.py)
+import os
+import time
+import socket
+import sqlite3
+import logging
+import tempfile
+
+import numpy as np
+from opcua import Client
+
+from simulator import IRSimulator
+from db_utils import setup_database, create_new_document
+from spectrum_logger import raw_spectrum_logger
+from spectrum_store import _read_csv_columns
+
+SPECTRA = 15
+PROBE = "ns=2;s=Local.iCIR.Probe1"
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run_subscription_logger(folder, spectra=SPECTRA, interval=0.2, log_delay=0.3):
+    """ log a simulated run of spectra scans with a consumer slower than the instrument (log_delay
+        seconds per spectrum), so the logger works through a backlog. Returns (db path, run folder, stats).
+    """
+    logging.getLogger("opcua").setLevel(logging.ERROR)
+    db_path = os.path.join(folder, "test.db")
+    run_dir = os.path.join(folder, "spectrum_run")
+    setup_database(db_path)
+    document_id = create_new_document(db_path, "Subscription_Test", None)
+
+    endpoint = f"opc.tcp://127.0.0.1:{_free_port()}/sim"
+    simulator = IRSimulator(endpoint=endpoint, interval=interval, spectra=spectra, points=64, start_delay=1.0).start()
+    client = Client(endpoint)
+    client.connect()
+    stats = {}
+    try:
+        raw_spectrum_logger(
+            client, f"{PROBE}.ProbeStatus", f"{PROBE}.SpectraRaw",
+            output_dir=run_dir,
+            db_path=db_path,
+            document_ids={"DocumentID": document_id},
+            probe1_node_id=PROBE,
+            use_subscription=True,
+            publishing_interval=100,
+            callback=lambda spectrum: time.sleep(log_delay),
+            sample_stats=stats
+        )
+    finally:
+        client.disconnect()
+        simulator.stop()
+    return db_path, run_dir, stats
+
+
+def check_every_scan_logged_once(db_path, run_dir, stats, spectra=SPECTRA):
+    with sqlite3.connect(db_path) as conn:
+        rows = conn.execute("""
+            SELECT Samples.SampleCount, Samples.LastSampleTime, Spectra.FilePath, Spectra.RecordedAt
+            FROM Spectra JOIN Samples ON Samples.SampleID = Spectra.SampleID
+            WHERE Spectra.Type = 'raw' ORDER BY Spectra.SpectraID
+        """).fetchall()
+
+    # every published scan once, in order, each with its own counters.
+    assert [count for count, _, _, _ in rows] == list(range(1, spectra + 1))
+    assert len({sample_time for _, sample_time, _, _ in rows}) == spectra
+    # recorded at the scan's own time, so a backlog logged within one millisecond never shares a file name.
+    assert len({recorded_at for _, _, _, recorded_at in rows}) == spectra
+    assert stats == {"new": spectra, "duplicates": 0, "missed": 0}
+
+    # the treated spectrum saved next to each raw spectrum is that scan's (the simulator publishes raw = 10^-treated).
+    for _, _, raw_path, _ in rows:
+        _, raw = _read_csv_columns(raw_path)
+        _, treated = _read_csv_columns(raw_path.replace("raw_spectrum_", "treated_spectrum_"))
+        assert np.allclose(raw, 10 ** -treated, atol=1e-6)
+
+    assert len(os.listdir(run_dir)) == 2 * spectra
+
+
+def test_subscription_logs_every_scan_once(tmp_path):
+    check_every_scan_logged_once(*run_subscription_logger(str(tmp_path)))
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as folder:
+        check_every_scan_logged_once(*run_subscription_logger(folder))
+    print("✅ every simulated scan was logged once with its own metadata.")
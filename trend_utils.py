@@ -0,0 +1,153 @@
+# windowed, downsampled reads of trend data (TrendSeries/TrendPoints) for plotting long runs.
+#
+# query_trend() splits the requested window into at most max_points time buckets and returns the
+# min, max and mean of every bucket, computed in SQLite from an indexed range scan per series.
+# With the optional rollup tier enabled (enable_trend_rollups), every sample is also folded into a
+# 1 minute TrendRollups row as it is inserted, and windows with buckets of a minute or more are
+# answered from those rows: a 12 hour trend then reads 720 rows per series instead of 21600.
+import sqlite3
+from datetime import datetime
+
+import pandas as pd
+
+from spectrum_store import datetime_to_ms
+
+ROLLUP_MS = 60_000
+TREND_COLUMNS = ["Label", "Kind", "Time", "Min", "Max", "Mean", "Count"]
+
+
+def _to_ms(value):
+    return datetime_to_ms(value) if isinstance(value, datetime) else value
+
+
+def rollups_enabled(conn):
+    """ True if the rollup trigger exists, i.e. TrendRollups is complete and kept up to date."""
+    row = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'TrendPoints_rollup'").fetchone()
+    return row is not None
+
+
+def enable_trend_rollups(db_path):
+    """ Create the 1 minute rollup table and the trigger that maintains it, and backfill it from the
+        samples already stored. Safe to call on every start.
+    """
+    with sqlite3.connect(db_path) as conn:
+        if rollups_enabled(conn):
+            return
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS TrendRollups (
+                SeriesID INTEGER NOT NULL,
+                BucketMs INTEGER NOT NULL,
+                Min REAL,
+                Max REAL,
+                Sum REAL,
+                Count INTEGER,
+                PRIMARY KEY (SeriesID, BucketMs)
+            ) WITHOUT ROWID
+        """)
+        conn.execute("DELETE FROM TrendRollups")
+        conn.execute(f"""
+            INSERT INTO TrendRollups (SeriesID, BucketMs, Min, Max, Sum, Count)
+            SELECT SeriesID, TimeMs - TimeMs % {ROLLUP_MS}, MIN(Value), MAX(Value), SUM(Value), COUNT(Value)
+            FROM TrendPoints WHERE Value IS NOT NULL
+            GROUP BY SeriesID, TimeMs - TimeMs % {ROLLUP_MS}
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER TrendPoints_rollup AFTER INSERT ON TrendPoints
+            WHEN NEW.Value IS NOT NULL
+            BEGIN
+                INSERT INTO TrendRollups (SeriesID, BucketMs, Min, Max, Sum, Count)
+                VALUES (NEW.SeriesID, NEW.TimeMs - NEW.TimeMs % {ROLLUP_MS}, NEW.Value, NEW.Value, NEW.Value, 1)
+                ON CONFLICT (SeriesID, BucketMs) DO UPDATE SET
+                    Min = min(Min, excluded.Min),
+                    Max = max(Max, excluded.Max),
+                    Sum = Sum + excluded.Sum,
+                    Count = Count + 1;
+            END
+        """)
+
+
+def disable_trend_rollups(db_path):
+    """ Stop maintaining rollups (one write less per sample) and drop the table."""
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("DROP TRIGGER IF EXISTS TrendPoints_rollup")
+        conn.execute("DROP TABLE IF EXISTS TrendRollups")
+
+
+def get_trend_series(conn, trend_id, labels=None):
+    """ (SeriesID, Kind, Label) of a trend's series. The probe series is labelled by its description.
+        labels limits the result to those peak labels / probe descriptions.
+    """
+    rows = conn.execute("""
+        SELECT SeriesID, Kind, CASE WHEN Kind = 'probe' THEN COALESCE(Description, NodeID) ELSE Label END
+        FROM TrendSeries WHERE TrendID = ? ORDER BY SeriesID
+    """, (trend_id,)).fetchall()
+    if labels is not None:
+        labels = set(labels)
+        rows = [row for row in rows if row[2] in labels]
+    return rows
+
+
+def _series_extent(conn, series_ids):
+    """ first and last sample time over the series, two PK lookups per series."""
+    first, last = None, None
+    for series_id in series_ids:
+        low, high = conn.execute(
+            "SELECT (SELECT MIN(TimeMs) FROM TrendPoints WHERE SeriesID = ?), (SELECT MAX(TimeMs) FROM TrendPoints WHERE SeriesID = ?)",
+            (series_id, series_id)
+        ).fetchone()
+        if low is not None:
+            first = low if first is None else min(first, low)
+            last = high if last is None else max(last, high)
+    return first, last
+
+
+def query_trend(db_path, trend_id, labels=None, start=None, end=None, max_points=1000, use_rollups=True):
+    """ Downsampled trend data as a DataFrame with one row per (series, time bucket):
+        Label, Kind, Time (bucket start), Min, Max, Mean, Count.
+
+        start/end are datetimes or epoch-ms (default: the whole trend) and max_points is the number of
+        buckets per series. Buckets of a minute or more come from TrendRollups when rollups are enabled,
+        in which case the window edges are rounded out to whole minutes.
+    """
+    with sqlite3.connect(db_path) as conn:
+        series = get_trend_series(conn, trend_id, labels)
+        if not series:
+            return pd.DataFrame(columns=TREND_COLUMNS)
+
+        start_ms, end_ms = _to_ms(start), _to_ms(end)
+        if start_ms is None or end_ms is None:
+            first, last = _series_extent(conn, [series_id for series_id, _, _ in series])
+            if first is None:
+                return pd.DataFrame(columns=TREND_COLUMNS)
+            start_ms = first if start_ms is None else start_ms
+            end_ms = last if end_ms is None else end_ms
+
+        bucket_ms = max(1, -(-(end_ms - start_ms + 1) // max(1, max_points)))
+        from_rollups = use_rollups and bucket_ms >= ROLLUP_MS and rollups_enabled(conn)
+
+        # buckets are counted from the window start, which is rounded down to a minute for rollups so
+        # that each rollup row falls into exactly one bucket.
+        if from_rollups:
+            bucket_ms = -(-bucket_ms // ROLLUP_MS) * ROLLUP_MS
+            start_ms -= start_ms % ROLLUP_MS
+            sql = """
+                SELECT :start + ((BucketMs - :start) / :bucket) * :bucket, MIN(Min), MAX(Max), SUM(Sum) / SUM(Count), SUM(Count)
+                FROM TrendRollups
+                WHERE SeriesID = :series AND BucketMs BETWEEN :start AND :end
+                GROUP BY (BucketMs - :start) / :bucket ORDER BY 1
+            """
+        else:
+            sql = """
+                SELECT :start + ((TimeMs - :start) / :bucket) * :bucket, MIN(Value), MAX(Value), AVG(Value), COUNT(Value)
+                FROM TrendPoints
+                WHERE SeriesID = :series AND TimeMs BETWEEN :start AND :end
+                GROUP BY (TimeMs - :start) / :bucket ORDER BY 1
+            """
+
+        rows = []
+        for series_id, kind, label in series:
+            params = {"series": series_id, "bucket": bucket_ms, "start": start_ms, "end": end_ms}
+            # local times, like the timestamps everywhere else in the logs.
+            rows.extend((label, kind, datetime.fromtimestamp(row[0] / 1000)) + row[1:] for row in conn.execute(sql, params))
+
+    return pd.DataFrame(rows, columns=TREND_COLUMNS)